@@ -57,6 +57,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'images.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -141,6 +142,62 @@ MEDIA_URL = '/static/media/'
 STATIC_ROOT = '/vol/web/static'
 MEDIA_ROOT = '/vol/web/media'
 
+# Thumbnails rendered on demand by GET /image/{id}/thumb/{size}/.
+DERIVATIVE_CACHE_ROOT = os.environ.get(
+    'DERIVATIVE_CACHE_ROOT', '/vol/web/cache')
+DERIVATIVE_CACHE_MAX_BYTES = int(
+    os.environ.get('DERIVATIVE_CACHE_MAX_BYTES', 1024 ** 3))
+# Formats offered to clients listing them in Accept, in order of
+# preference. Formats the Pillow build can't encode are skipped.
+THUMBNAIL_FORMATS = [
+    ftype for ftype in os.environ.get(
+        'THUMBNAIL_FORMATS', 'AVIF,WEBP').upper().split(',') if ftype
+]
+
+# Partial files of resumable uploads (POST /upload/).
+UPLOAD_SESSION_ROOT = os.environ.get('UPLOAD_SESSION_ROOT', '/vol/web/uploads')
+UPLOAD_SESSION_MAX_BYTES = int(
+    os.environ.get('UPLOAD_SESSION_MAX_BYTES', 200 * 1024 ** 2))
+# Seconds after which unfinished upload sessions and their files are
+# deleted by the garbage collection drain.
+UPLOAD_SESSION_EXPIRY = int(
+    os.environ.get('UPLOAD_SESSION_EXPIRY', 24 * 3600))
+
+# Process pool for Pillow jobs and its limits. IMAGE_WORKERS=0 runs jobs
+# in the calling process.
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_WORKER_MAX_JOBS = int(os.environ.get('IMAGE_WORKER_MAX_JOBS', 100))
+IMAGE_WORKER_MAX_RSS = int(
+    os.environ.get('IMAGE_WORKER_MAX_RSS', 1024 ** 3))
+IMAGE_JOB_TIMEOUT = int(os.environ.get('IMAGE_JOB_TIMEOUT', 30))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 50000000))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 50 * 1024 ** 2))
+
+# Celery prefork workers are daemonic, so image tasks run Pillow jobs in
+# the worker itself. It is replaced like a pool worker (memory is checked
+# after each task, in KiB), and image tasks get IMAGE_TASK_TIME_LIMIT
+# seconds before SoftTimeLimitExceeded (30 more before being killed).
+CELERY_WORKER_MAX_TASKS_PER_CHILD = IMAGE_WORKER_MAX_JOBS or None
+CELERY_WORKER_MAX_MEMORY_PER_CHILD = IMAGE_WORKER_MAX_RSS // 1024 or None
+IMAGE_TASK_TIME_LIMIT = int(os.environ.get('IMAGE_TASK_TIME_LIMIT', 120))
+CELERY_TASK_ANNOTATIONS = {
+    task: {
+        'soft_time_limit': IMAGE_TASK_TIME_LIMIT,
+        'time_limit': IMAGE_TASK_TIME_LIMIT + 30,
+    }
+    for task in (
+        'app.tasks.generate_thumbnails_task',
+        'app.tasks.regenerate_thumbnails_task',
+    )
+}
+
+# Timing histograms served at /metrics.
+METRICS_ENABLED = bool(int(os.environ.get('METRICS_ENABLED', 0)))
+
+# POST /image/batch/ limits and thumbnailing threads.
+BATCH_UPLOAD_MAX_FILES = int(os.environ.get('BATCH_UPLOAD_MAX_FILES', 500))
+BATCH_UPLOAD_WORKERS = int(os.environ.get('BATCH_UPLOAD_WORKERS', 4))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
@@ -152,6 +209,10 @@ REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
 
+# Default and maximum number of images per page of GET /image/.
+IMAGES_PAGE_SIZE = int(os.environ.get('IMAGES_PAGE_SIZE', 25))
+IMAGES_MAX_PAGE_SIZE = int(os.environ.get('IMAGES_MAX_PAGE_SIZE', 100))
+
 SPECTACULAR_SETTINGS = {
     'COMPONENT_SPLIT_REQUEST': True,
 }
@@ -159,9 +220,87 @@ SPECTACULAR_SETTINGS = {
 CELERY_BROKER_URL = "redis://redis:6379"
 CELERY_RESULT_BACKEND = "redis://redis:6379"
 
+# Redis redelivers tasks not acknowledged within visibility_timeout,
+# which includes ETA tasks still waiting in a worker. It must outlast the
+# longest link expiry (30000 seconds), or expiry tasks run repeatedly.
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "visibility_timeout": int(
+        os.environ.get("CELERY_VISIBILITY_TIMEOUT", 36000)),
+}
+
+# Links delete themselves when they expire (an ETA task sent when they
+# are created); the hourly sweep only reconciles links whose task was lost.
 CELERY_BEAT_SCHEDULE = {
     "delete_expired_links_task": {
         "task": "app.tasks.delete_expired_links_task",
+        "schedule": schedules.crontab(minute=0),
+    },
+    # Files of deleted images are logged and removed by this drain.
+    "drain_pending_deletions_task": {
+        "task": "app.tasks.drain_pending_deletions_task",
+        "schedule": schedules.crontab(minute="*"),
+    },
+    # Least recently used thumbnails rendered on demand are evicted by
+    # this task, run by workers sharing DERIVATIVE_CACHE_ROOT.
+    "evict_derivatives_task": {
+        "task": "app.tasks.evict_derivatives_task",
+        "schedule": schedules.crontab(minute="*"),
+    },
+    # Thumbnail tasks that couldn't be sent or died with their worker.
+    "requeue_stalled_thumbnails_task": {
+        "task": "app.tasks.requeue_stalled_thumbnails_task",
         "schedule": schedules.crontab(minute="*/5"),
     },
 }
+
+# Seconds after which images still pending or processing are taken to
+# have lost their thumbnail task, and queued again.
+THUMBNAIL_STALLED_AFTER = int(
+    os.environ.get('THUMBNAIL_STALLED_AFTER', 900))
+
+# Directory levels (two hex characters each) uploads are spread over,
+# e.g. uploads/images/ab/cd/<uuid>.jpg at 2. After changing it, run
+# shard_media to move existing files.
+MEDIA_SHARD_DEPTH = int(os.environ.get('MEDIA_SHARD_DEPTH', 2))
+
+# Images per second regenerate_thumbnails queues, so regeneration after
+# an account type change doesn't starve uploads of Celery workers.
+REGENERATE_THUMBNAILS_RATE = float(
+    os.environ.get('REGENERATE_THUMBNAILS_RATE', 20))
+
+# Seconds an AccountType row may be served from the per-process cache.
+ACCOUNT_TYPE_CACHE_TIMEOUT = 60
+
+# Cache shared by all processes (e.g. redis://redis:6379/1). Without it
+# each process has its own in-memory cache.
+if os.environ.get('CACHE_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['CACHE_URL'],
+        },
+    }
+
+# Seconds token users are kept in the shared cache, and in the
+# per-process cache in front of it (which also bounds how long other
+# processes see a deleted token or changed user).
+AUTH_TOKEN_CACHE_TIMEOUT = int(os.environ.get('AUTH_TOKEN_CACHE_TIMEOUT', 300))
+AUTH_TOKEN_LOCAL_TIMEOUT = int(os.environ.get('AUTH_TOKEN_LOCAL_TIMEOUT', 5))
+AUTH_TOKEN_LOCAL_MAX_ENTRIES = 10000
+
+# Seconds a user's library version (used for ETags) stays cached.
+LIBRARY_STATE_CACHE_TIMEOUT = 300
+
+# Return HMAC signed binary image links checked without database lookups
+# instead of storing a BinaryImageLink per link.
+SIGNED_LINKS = bool(int(os.environ.get('SIGNED_LINKS', 0)))
+
+# Let the web server send files: 'nginx' (X-Accel-Redirect to an internal
+# location at SENDFILE_URL_PREFIX mapped to MEDIA_ROOT) or 'apache'
+# (X-Sendfile). Empty streams files from Django.
+SENDFILE_BACKEND = os.environ.get('SENDFILE_BACKEND', '')
+SENDFILE_URL_PREFIX = os.environ.get('SENDFILE_URL_PREFIX', '/protected/')
+
+# Generate thumbnails in a Celery worker instead of during the upload
+# request. Keep it off to thumbnail synchronously (e.g. when testing).
+THUMBNAILS_ASYNC = bool(int(os.environ.get('THUMBNAILS_ASYNC', 0)))
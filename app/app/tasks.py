@@ -2,9 +2,142 @@ from app import celery
 
 from celery import shared_task
 from celery import utils
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.utils.log import get_task_logger
 
 from django.core.management import call_command
+from django.db import transaction
+from django.utils import timezone
+
+from PIL import UnidentifiedImageError
+
+
+logger = get_task_logger(__name__)
+
 
 @shared_task
 def delete_expired_links_task():
     call_command("delete_expired_links",)
+
+
+@shared_task(ignore_result=True)
+def drain_pending_deletions_task():
+    """Delete files logged for deletion that are no longer used.
+
+    Abandoned upload sessions and their files are expired on the way.
+    """
+    from images import gc
+
+    gc.drain()
+    gc.expire_upload_sessions()
+
+
+@shared_task(ignore_result=True)
+def evict_derivatives_task():
+    """Shrink the on-demand thumbnail cache to its size cap."""
+    from images import derivatives
+
+    derivatives.evict()
+
+
+@shared_task(ignore_result=True)
+def delete_expired_link_task(link_id):
+    """Delete a binary image link scheduled at its expiration date."""
+    from images import links
+
+    links.expire(link_id)
+
+
+@shared_task(bind=True, max_retries=3, default_retry_delay=10)
+def generate_thumbnails_task(self, image_id):
+    """Generate thumbnails for an uploaded image.
+
+    The image is marked as processing in a short transaction and rendered
+    without holding a lock. Images already processed, or being processed
+    by another delivery of the task, are skipped, so running it twice for
+    the same image never leaves duplicate thumbnail files behind. Images
+    processing for longer than THUMBNAIL_STALLED_AFTER were left by a
+    worker that died and are taken over. Images Pillow can't decode, or
+    can't render in IMAGE_TASK_TIME_LIMIT, fail at once; storage errors
+    are retried.
+    """
+    from images import metrics
+    from images.executor import ImageRejected
+    from images.models import Image, PendingDeletion, User
+    from images.processing import stalled_before
+
+    with transaction.atomic():
+        image = Image.objects.select_for_update().filter(pk=image_id).first()
+        if image is None or image.status == Image.Status.READY:
+            return
+        if (image.status == Image.Status.PROCESSING
+                and not self.request.retries
+                and image.status_changed_at >= stalled_before()):
+            return
+
+        image.status = Image.Status.PROCESSING
+        image.status_changed_at = timezone.now()
+        image.save(update_fields=['status', 'status_changed_at'])
+        User.objects.touch_library(image.user_id)
+
+    try:
+        created = image.make_thumbnail()
+    except (UnidentifiedImageError, ImageRejected, SoftTimeLimitExceeded):
+        created = False
+    except OSError as exc:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc)
+        created = False
+
+    image.status = Image.Status.READY if created else Image.Status.FAILED
+    image.status_changed_at = timezone.now()
+    with metrics.span('thumbnail', 'db'), transaction.atomic():
+        if not Image.objects.select_for_update().filter(pk=image_id).exists():
+            # Deleted while rendering, so the new thumbnails are unused.
+            PendingDeletion.objects.log([
+                thumb.name for thumb in (
+                    image.thumbnail_size1, image.thumbnail_size2) if thumb])
+            return
+        image.save(update_fields=[
+            *Image.THUMBNAIL_FIELDS, 'status', 'status_changed_at'])
+        User.objects.touch_library(image.user_id)
+
+
+@shared_task(ignore_result=True)
+def requeue_stalled_thumbnails_task():
+    """Queue thumbnails of images whose task was lost."""
+    from images import processing
+
+    count = processing.requeue_stalled()
+    if count:
+        logger.warning('Requeued thumbnails of %s stalled images.', count)
+
+
+@shared_task(acks_late=True)
+def regenerate_thumbnails_task(image_ids):
+    """Regenerate stale thumbnails of images.
+
+    Acknowledged only when done, so a batch lost with its worker is run
+    again; images already regenerated are skipped. When the time limit
+    is reached the image being rendered is skipped and the rest of the
+    batch queued as a new task.
+    """
+    from images.executor import ImageRejected
+    from images.regenerate import regenerate
+    for index, image_id in enumerate(image_ids):
+        try:
+            regenerate(image_id)
+        except (OSError, ImageRejected) as err:
+            logger.warning('Could not regenerate image %s: %s', image_id, err)
+        except SoftTimeLimitExceeded:
+            logger.warning('Regenerating image %s timed out.', image_id)
+            if image_ids[index + 1:]:
+                regenerate_thumbnails_task.delay(image_ids[index + 1:])
+            return
+
+
+@shared_task
+def regenerate_thumbnails_command_task(account_types=None, users=None):
+    """Run regenerate_thumbnails for account types or users."""
+    call_command(
+        'regenerate_thumbnails', account_type=account_types, user=users)
@@ -13,29 +13,32 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from drf_spectacular.views import (
     SpectacularAPIView,
     SpectacularSwaggerView,
 )
 from django.contrib import admin
-from django.urls import path, include
-from django.conf.urls.static import static
+from django.urls import path, re_path, include
 from django.conf import settings
 
+from images.metrics import metrics_view
+from images.views import media
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('images.urls')),
     path('user/', include('user.urls')),
+    path('metrics', metrics_view, name='metrics'),
     path('schema/', SpectacularAPIView.as_view(), name='api-schema'),
     path(
         'docs/',
         SpectacularSwaggerView.as_view(url_name='api-schema'),
         name='api-docs'),
+    re_path(
+        r'^%s(?P<name>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')),
+        media,
+        name='media'),
 ]
-
-if settings.DEBUG:
-    urlpatterns += static(
-        settings.MEDIA_URL,
-        document_root=settings.MEDIA_ROOT,
-    )
@@ -0,0 +1,96 @@
+"""
+Benchmark POST /image/batch/ against one POST /image/ per file.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_batch_upload [images]
+"""
+import sys
+import time
+import zipfile
+from io import BytesIO
+
+from benchmarks.corpus import make_photo
+from benchmarks.utils import setup_django
+
+
+def named_file(data, name):
+    """Return an in memory upload of data."""
+    from django.core.files.base import File
+
+    return File(BytesIO(data), name=name)
+
+
+def make_archive(sources):
+    """Return a ZIP archive of the sources as an upload."""
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+        for number, data in enumerate(sources):
+            zip_file.writestr(f'photo{number}.jpg', data)
+
+    return named_file(buffer.getvalue(), 'photos.zip')
+
+
+def single_uploads(client, sources):
+    """Upload every source with its own request."""
+    from django.urls import reverse
+
+    url = reverse('image-list')
+    for number, data in enumerate(sources):
+        payload = {
+            'title': f'photo{number}',
+            'image': named_file(data, f'photo{number}.jpg'),
+        }
+        res = client.post(url, payload, format='multipart')
+        assert res.status_code == 201, res.status_code
+
+
+def batch_upload(client, sources):
+    """Upload all sources as files of one batch request."""
+    from django.urls import reverse
+
+    payload = {'images': [
+        named_file(data, f'photo{number}.jpg')
+        for number, data in enumerate(sources)
+    ]}
+    res = client.post(reverse('image-batch'), payload, format='multipart')
+    assert res.status_code == 201, res.status_code
+
+
+def archive_upload(client, sources):
+    """Upload all sources as one ZIP archive."""
+    from django.urls import reverse
+
+    payload = {'archive': make_archive(sources)}
+    res = client.post(reverse('image-batch'), payload, format='multipart')
+    assert res.status_code == 201, res.status_code
+
+
+def main(count):
+    setup_django()
+
+    from django.contrib.auth import get_user_model
+    from rest_framework.test import APIClient
+
+    from images.models import AccountType
+
+    account_type = AccountType.objects.create(
+        title='Premium', thumb_size1=400, thumb_size2=200)
+    user = get_user_model().objects.create_user(
+        email='bench@example.com', password='pass123',
+        account_type=account_type)
+    client = APIClient()
+    client.force_authenticate(user)
+
+    for upload in (single_uploads, batch_upload, archive_upload):
+        # Fresh sources per run, so deduplication doesn't skip any work.
+        sources = [make_photo((1600, 1200)) for _ in range(count)]
+        started = time.perf_counter()
+        upload(client, sources)
+        elapsed = time.perf_counter() - started
+        print(f'{upload.__name__:>15}: {elapsed:6.2f}s '
+              f'{count / elapsed:6.1f} images/s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,76 @@
+"""
+Compare thumbnail bytes and encode CPU time per encoder profile.
+
+Sources are decoded and resized once; only encoding is timed.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_encoders
+"""
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+from PIL import Image as Img
+
+from benchmarks.corpus import make_photo, make_screenshot
+from images.thumbnails import encode
+
+
+SIZES = (400, 200)
+ROUNDS = 20
+
+DEFAULT = {
+    'jpeg_quality': 75,
+    'jpeg_progressive': False,
+    'png_optimize': False,
+    'png_compress_level': 6,
+    'png_quantize_colors': None,
+    'keep_exif': False,
+}
+
+PROFILES = {
+    'pillow defaults': None,
+    'account defaults': {},
+    'jpeg q85 progressive': {'jpeg_quality': 85, 'jpeg_progressive': True},
+    'jpeg q60 progressive': {'jpeg_quality': 60, 'jpeg_progressive': True},
+    'png optimize': {'png_optimize': True, 'png_compress_level': 9},
+    'png 64 colours': {'png_quantize_colors': 64, 'png_optimize': True},
+    'keep exif': {'keep_exif': True},
+}
+
+
+def main():
+    corpus = (
+        ('photo.jpg', 'JPEG', make_photo()),
+        ('screenshot.png', 'PNG', make_screenshot()),
+    )
+    for name, ftype, data in corpus:
+        with Img.open(BytesIO(data)) as original:
+            info = original.info
+            thumbs = []
+            for size in SIZES:
+                thumb = original.copy()
+                thumb.thumbnail((size, size), Img.LANCZOS)
+                thumbs.append(thumb)
+
+        baseline = None
+        for label, params in PROFILES.items():
+            profile = None
+            if params is not None:
+                profile = SimpleNamespace(**dict(DEFAULT, **params))
+            started = time.process_time()
+            for _ in range(ROUNDS):
+                total = sum(
+                    len(encode(thumb, ftype, profile, info))
+                    for thumb in thumbs)
+            cpu = (time.process_time() - started) * 1000 / ROUNDS
+            if baseline is None:
+                baseline = total
+            saved = (total - baseline) / baseline
+            print(f'{name:15} {label:22} {total / 1024:7.1f} KiB '
+                  f'({saved:+6.1%})  encode cpu {cpu:6.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""
+Compare thumbnail size and encode time per output format.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_formats
+"""
+import time
+from io import BytesIO
+
+from benchmarks.corpus import make_photo, make_screenshot
+from images.thumbnails import can_encode, render_thumbnails
+
+
+SIZES = (400, 200)
+ROUNDS = 5
+
+
+def main():
+    corpus = (
+        ('photo.jpg', 'JPEG', make_photo()),
+        ('screenshot.png', 'PNG', make_screenshot()),
+    )
+    for name, source_ftype, data in corpus:
+        for ftype in (source_ftype, 'WEBP', 'AVIF'):
+            if not can_encode(ftype):
+                print(f'{name:15} {ftype:5} not supported by this Pillow')
+                continue
+            started = time.perf_counter()
+            for _ in range(ROUNDS):
+                rendered = render_thumbnails(BytesIO(data), SIZES, ftype)
+            elapsed = (time.perf_counter() - started) * 1000 / ROUNDS
+            sizes = '  '.join(
+                f'{size}px {len(rendered[size]) / 1024:6.1f} KiB'
+                for size in SIZES)
+            print(f'{name:15} {ftype:5} {elapsed:7.1f} ms  {sizes}')
+
+
+if __name__ == '__main__':
+    main()
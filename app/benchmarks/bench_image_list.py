@@ -0,0 +1,88 @@
+"""
+Benchmark cursor pages of GET /image/ deep into a large library.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_image_list [rows]
+"""
+import sys
+import time
+from base64 import b64encode
+from urllib.parse import urlencode
+
+from benchmarks.utils import setup_django
+
+
+ROUNDS = 20
+BATCH_SIZE = 10000
+
+
+def create_library(user, rows):
+    """Bulk insert rows images for user without touching storage."""
+    from images.models import Image
+
+    for start in range(0, rows, BATCH_SIZE):
+        Image.objects.bulk_create(
+            Image(
+                user=user,
+                title=f'sample{number}',
+                image=f'uploads/images/{number}.png',
+                status=Image.Status.READY,
+            )
+            for number in range(start, min(start + BATCH_SIZE, rows))
+        )
+
+
+def cursor_for(position):
+    """Encode a DRF cursor pointing right after position."""
+    query = urlencode({'p': position})
+
+    return b64encode(query.encode('ascii')).decode('ascii')
+
+
+def time_get(client, url, params):
+    """Return average milliseconds of GET url with params."""
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        res = client.get(url, params)
+        assert res.status_code == 200, res.status_code
+
+    return (time.perf_counter() - started) * 1000 / ROUNDS
+
+
+def main(rows):
+    setup_django()
+
+    from django.contrib.auth import get_user_model
+    from django.urls import reverse
+    from rest_framework.test import APIClient
+
+    from images.models import AccountType, Image
+
+    account_type = AccountType.objects.create(
+        title='Premium', thumb_size1=400, thumb_size2=200)
+    user = get_user_model().objects.create_user(
+        email='bench@example.com', password='pass123',
+        account_type=account_type)
+
+    started = time.perf_counter()
+    create_library(user, rows)
+    print(f'inserted {rows} images in {time.perf_counter() - started:.1f}s')
+
+    client = APIClient()
+    client.force_authenticate(user)
+    url = reverse('image-list')
+    ids = Image.objects.filter(user=user).order_by('-id').values_list(
+        'id', flat=True)
+
+    for fraction in (0, 0.5, 0.99):
+        offset = int(rows * fraction)
+        params = {}
+        if offset:
+            params['cursor'] = cursor_for(ids[offset])
+        elapsed = time_get(client, url, params)
+        print(f'page at row {offset:>9}: {elapsed:6.2f} ms')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
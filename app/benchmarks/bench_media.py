@@ -0,0 +1,118 @@
+"""
+Benchmark the media view against Django's static file handler.
+
+Views are called directly, so the numbers compare the handlers alone
+(including the media view's token and authorization queries) without
+middleware.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_media [requests]
+"""
+import os
+import sys
+import time
+
+from benchmarks.utils import setup_django
+
+
+SIZES = (100 * 1024, 10 * 1024 ** 2)
+
+
+def consume(response):
+    """Read the whole body and return its length."""
+    assert response.status_code in (200, 206), response.status_code
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+
+    return len(response.content)
+
+
+def get(name, **headers):
+    """Return a GET request for the stored file name."""
+    from django.conf import settings
+    from django.contrib.auth.models import AnonymousUser
+    from django.test import RequestFactory
+
+    request = RequestFactory().get(settings.MEDIA_URL + name, **headers)
+    request.user = AnonymousUser()
+
+    return request
+
+
+def static_handler(name, headers):
+    """GET through django.views.static.serve, as DEBUG used to."""
+    from django.conf import settings
+    from django.views.static import serve
+
+    return consume(
+        serve(get(name), name, document_root=settings.MEDIA_ROOT))
+
+
+def media_view(name, headers):
+    """GET through the authorizing media view streaming the file."""
+    from images.views import media
+
+    return consume(media(get(name, **headers), name))
+
+
+def media_view_range(name, headers):
+    """GET the second half of the file through the media view."""
+    from django.core.files.storage import default_storage
+
+    from images.views import media
+
+    size = default_storage.size(name)
+    request = get(name, HTTP_RANGE=f'bytes={size // 2}-', **headers)
+
+    return consume(media(request, name))
+
+
+def media_view_offloaded(name, headers):
+    """GET through the media view handing the transfer to nginx."""
+    from django.test import override_settings
+
+    from images.views import media
+
+    with override_settings(SENDFILE_BACKEND='nginx'):
+        return consume(media(get(name, **headers), name))
+
+
+def main(count):
+    setup_django()
+
+    from django.contrib.auth import get_user_model
+    from django.core.files.base import ContentFile
+    from django.core.files.storage import default_storage
+    from rest_framework.authtoken.models import Token
+
+    from images.models import AccountType, Image
+
+    account_type = AccountType.objects.create(
+        title='Premium', thumb_size1=400, thumb_size2=200,
+        link_to_original=True)
+    user = get_user_model().objects.create_user(
+        email='bench@example.com', password='pass123',
+        account_type=account_type)
+    token = Token.objects.create(user=user)
+    headers = {'HTTP_AUTHORIZATION': f'Token {token.key}'}
+
+    for size in SIZES:
+        name = default_storage.save(
+            'uploads/images/bench.png', ContentFile(os.urandom(size)))
+        Image.objects.bulk_create([
+            Image(user=user, title='bench', image=name)])
+        for handler in (static_handler, media_view, media_view_range,
+                        media_view_offloaded):
+            sent = 0
+            started = time.perf_counter()
+            for _ in range(count):
+                sent += handler(name, headers)
+            elapsed = time.perf_counter() - started
+            print(f'{size // 1024:>6} KiB {handler.__name__:>21}: '
+                  f'{count / elapsed:8.1f} req/s '
+                  f'{sent / elapsed / 1024 ** 2:8.1f} MiB/s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,90 @@
+"""
+Benchmark single-decode thumbnail rendering against per-size decoding.
+
+Run from the app directory:
+
+    python -m benchmarks.bench_thumbnails
+"""
+import multiprocessing
+import time
+from io import BytesIO
+
+from PIL import Image as Img
+
+from benchmarks.utils import peak_rss_kb
+from images.thumbnails import render_thumbnails
+
+
+SIZES = (400, 200)
+ROUNDS = 5
+
+
+CORPUS = (
+    ('JPEG', (6000, 4000)),
+    ('PNG', (3000, 2000)),
+)
+
+
+def make_source(ftype, size):
+    """Return bytes of a source image with some detail to decode."""
+    img = Img.radial_gradient('L').resize(size).convert('RGB')
+    buffer = BytesIO()
+    img.save(buffer, ftype)
+
+    return buffer.getvalue()
+
+
+def per_size_decode(data, ftype):
+    """Thumbnailing as done before: open and resize the original per size."""
+    for size in SIZES:
+        img = Img.open(BytesIO(data))
+        img.thumbnail((size, size), Img.LANCZOS)
+        img.save(BytesIO(), ftype)
+
+
+def single_decode(data, ftype):
+    """Thumbnailing with one draft decode cascading down the sizes."""
+    render_thumbnails(BytesIO(data), SIZES, ftype)
+
+
+def measure(func, data, ftype, queue):
+    """Time func in a fresh process and report CPU and peak RSS."""
+    baseline_rss = peak_rss_kb()
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    for _ in range(ROUNDS):
+        func(data, ftype)
+    queue.put({
+        'cpu_ms': (time.process_time() - cpu) * 1000 / ROUNDS,
+        'wall_ms': (time.perf_counter() - wall) * 1000 / ROUNDS,
+        'peak_rss_kb': peak_rss_kb() - baseline_rss,
+    })
+
+
+def run(func, data, ftype):
+    """Run measure() in a child process so peak RSS isn't shared."""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(
+        target=measure, args=(func, data, ftype, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
+
+
+def main():
+    for ftype, size in CORPUS:
+        data = make_source(ftype, size)
+        for func in (per_size_decode, single_decode):
+            result = run(func, data, ftype)
+            print(
+                f"{ftype:5} {func.__name__:16} "
+                f"cpu {result['cpu_ms']:8.1f} ms  "
+                f"wall {result['wall_ms']:8.1f} ms  "
+                f"peak rss +{result['peak_rss_kb'] / 1024:7.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
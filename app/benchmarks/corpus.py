@@ -0,0 +1,35 @@
+"""
+Generated sample images for the benchmarks.
+"""
+import random
+from io import BytesIO
+
+from PIL import Image as Img, ImageDraw
+
+
+def make_photo(size=(3000, 2000)):
+    """Return JPEG bytes of a noisy, photo like image."""
+    gradient = Img.radial_gradient('L').resize(size)
+    noise = Img.effect_noise(size, 40)
+    img = Img.merge('RGB', (gradient, noise, Img.linear_gradient('L').resize(
+        size)))
+    buffer = BytesIO()
+    img.save(buffer, 'JPEG', quality=90)
+
+    return buffer.getvalue()
+
+
+def make_screenshot(size=(1920, 1080)):
+    """Return PNG bytes of a flat coloured, screenshot like image."""
+    rng = random.Random(0)
+    img = Img.new('RGB', size, (245, 245, 245))
+    draw = ImageDraw.Draw(img)
+    for _ in range(400):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle(
+            (x, y, x + rng.randrange(20, 300), y + rng.randrange(8, 40)),
+            fill=rng.choice([(30, 30, 30), (0, 102, 204), (220, 220, 220)]))
+    buffer = BytesIO()
+    img.save(buffer, 'PNG')
+
+    return buffer.getvalue()
@@ -0,0 +1,25 @@
+"""
+Django settings for running benchmarks locally against SQLite.
+"""
+import os
+import tempfile
+
+from app.settings import *  # noqa: F401,F403
+
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get(
+            'BENCH_DB', os.path.join(tempfile.gettempdir(), 'bench.sqlite3')),
+    }
+}
+
+MEDIA_ROOT = tempfile.mkdtemp(prefix='bench-media-')
+DERIVATIVE_CACHE_ROOT = tempfile.mkdtemp(prefix='bench-cache-')
+ALLOWED_HOSTS = ['testserver', '127.0.0.1']
+# Render in the benchmark process so its CPU time and peak RSS include
+# the Pillow work.
+IMAGE_WORKERS = 0
+# Tasks (e.g. link expiry) are published to an in-memory broker.
+CELERY_BROKER_URL = 'memory://'
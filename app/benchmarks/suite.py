@@ -0,0 +1,348 @@
+"""
+Benchmark suite for the image hot paths with a regression check.
+
+Every case runs in a fresh process against its own SQLite database and
+records wall time, CPU time, peak RSS and query count of the measured
+part. Run from the app directory:
+
+    python -m benchmarks.suite [--only NAME] [--output FILE]
+                               [--baseline FILE] [--update-baseline]
+
+The run fails (exit status 1) when a case is slower or uses more memory
+than its baseline by more than --tolerance, or runs more queries.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+
+from benchmarks.utils import peak_rss_kb, reset_peak_rss, setup_django
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+ROUNDS = 5
+LINK_BATCH_SIZE = 10000
+
+# Differences below these are noise, whatever the tolerance.
+NOISE = {'wall_ms': 1, 'peak_rss_kb': 1024}
+
+
+def create_user(**account_params):
+    """Create a user of a Premium account type with account_params."""
+    from django.contrib.auth import get_user_model
+
+    from images.models import AccountType
+
+    params = {'title': 'Premium', 'thumb_size1': 400, 'thumb_size2': 200}
+    params.update(account_params)
+    account_type = AccountType.objects.create(**params)
+
+    return get_user_model().objects.create_user(
+        email='bench@example.com', password='pass123',
+        account_type=account_type)
+
+
+def store_image(user, data, ext, number=0):
+    """Store data as a legacy (not deduplicated) image of user."""
+    from django.core.files.base import ContentFile
+    from django.core.files.storage import default_storage
+
+    from images.models import Image
+
+    name = default_storage.save(
+        f'uploads/images/bench{number}{ext}', ContentFile(data))
+
+    return Image.objects.bulk_create([
+        Image(user=user, title=f'bench{number}', image=name)])[0]
+
+
+def source(ftype, size):
+    """Return corpus bytes and extension of an image."""
+    from benchmarks.corpus import make_photo, make_screenshot
+
+    if ftype == 'JPEG':
+        return make_photo(size), '.jpg'
+
+    return make_screenshot(size), '.png'
+
+
+def bench_make_thumbnail(measure, ftype, size):
+    """Image.make_thumbnail() of one image, rendered again each round."""
+    user = create_user()
+    data, ext = source(ftype, size)
+    image = store_image(user, data, ext)
+
+    with measure(ROUNDS):
+        for _ in range(ROUNDS):
+            assert image.make_thumbnail()
+
+
+def bench_get_link(measure):
+    """POST /image/{id}/get-link/ of images without a binary image yet."""
+    from django.urls import reverse
+    from rest_framework.test import APIClient
+
+    user = create_user(link_to_binary=True)
+    data, ext = source('JPEG', (1600, 1200))
+    images = [store_image(user, data, ext, number)
+              for number in range(ROUNDS + 1)]
+    client = APIClient()
+    client.force_authenticate(user)
+
+    def get_link(image):
+        res = client.post(
+            reverse('image-get-link', args=[image.id]),
+            {'expiring_time': 300}, format='json')
+        assert res.status_code == 200, res.data
+
+    # Warm up the Celery producer publishing the link's expiry task.
+    get_link(images.pop())
+    with measure(ROUNDS):
+        for image in images:
+            get_link(image)
+
+
+def bench_upload_rejected(measure, ftype, size, name):
+    """POST /image/ of a file rejected for its content or pixel count.
+
+    The account type allows 10 megapixels, so sources over that fail the
+    pixel limit, and a name whose extension doesn't match the content
+    fails the format check.
+    """
+    from django.core.files.base import ContentFile
+    from django.urls import reverse
+    from rest_framework.test import APIClient
+
+    from images.models import Blob
+
+    user = create_user(max_pixels=10000000)
+    data, ext = source(ftype, size)
+    client = APIClient()
+    client.force_authenticate(user)
+    url = reverse('image-list')
+
+    with measure(ROUNDS):
+        for _ in range(ROUNDS):
+            res = client.post(url, {
+                'title': 'bench',
+                'image': ContentFile(data, name=name),
+            }, format='multipart')
+            assert res.status_code == 400, res.status_code
+
+    assert not Blob.objects.exists()
+
+
+def bench_list_images(measure, rows):
+    """GET /image/ first page of a library of rows images."""
+    from django.urls import reverse
+    from rest_framework.test import APIClient
+
+    from benchmarks.bench_image_list import create_library
+
+    user = create_user()
+    create_library(user, rows)
+    client = APIClient()
+    client.force_authenticate(user)
+    url = reverse('image-list')
+
+    # Warm up the cached library state, as any repeated request finds it.
+    client.get(url)
+    with measure(ROUNDS):
+        for _ in range(ROUNDS):
+            res = client.get(url)
+            assert res.status_code == 200, res.status_code
+
+
+def bench_delete_expired_links(measure, rows):
+    """delete_expired_links sweeping rows expired links."""
+    from io import StringIO
+
+    from django.core.management import call_command
+    from django.utils import timezone
+
+    from images.models import BinaryImageLink
+
+    user = create_user()
+    expired = timezone.now() - datetime.timedelta(hours=1)
+    for start in range(0, rows, LINK_BATCH_SIZE):
+        BinaryImageLink.objects.bulk_create(
+            BinaryImageLink(
+                user=user,
+                binary_image=f'uploads/binary/{number}.png',
+                expiring_time=300,
+                expiration_date=expired,
+            )
+            for number in range(start, min(start + LINK_BATCH_SIZE, rows))
+        )
+
+    with measure(1):
+        call_command('delete_expired_links', stdout=StringIO())
+
+    assert not BinaryImageLink.objects.exists()
+
+
+CASES = {
+    'make_thumbnail[JPEG 3000x2000]': (
+        bench_make_thumbnail, ('JPEG', (3000, 2000))),
+    'make_thumbnail[JPEG 1024x768]': (
+        bench_make_thumbnail, ('JPEG', (1024, 768))),
+    'make_thumbnail[PNG 1920x1080]': (
+        bench_make_thumbnail, ('PNG', (1920, 1080))),
+    'make_thumbnail[PNG 800x600]': (
+        bench_make_thumbnail, ('PNG', (800, 600))),
+    'get_link': (bench_get_link, ()),
+    'upload_rejected[PNG 4000x3000 over limit]': (
+        bench_upload_rejected, ('PNG', (4000, 3000), 'bench.png')),
+    'upload_rejected[JPEG 3000x2000 named .png]': (
+        bench_upload_rejected, ('JPEG', (3000, 2000), 'bench.png')),
+    'list_images[10]': (bench_list_images, (10,)),
+    'list_images[1000]': (bench_list_images, (1000,)),
+    'list_images[100000]': (bench_list_images, (100000,)),
+    'delete_expired_links[1000000]': (
+        bench_delete_expired_links, (1000000,)),
+}
+
+
+def run_case(name):
+    """Set up a fresh database and run one case, returning its metrics."""
+    os.environ['BENCH_DB'] = os.path.join(
+        tempfile.gettempdir(), f'bench-{os.getpid()}.sqlite3')
+    setup_django()
+    # BinaryImageLink computes its dates in naive local time.
+    warnings.filterwarnings(
+        'ignore', message='DateTimeField .* received a naive datetime')
+
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    result = {}
+
+    @contextmanager
+    def measure(rounds):
+        reset_peak_rss()
+        rss = peak_rss_kb()
+        with CaptureQueriesContext(connection) as queries:
+            cpu = time.process_time()
+            wall = time.perf_counter()
+            yield
+            result['wall_ms'] = (time.perf_counter() - wall) * 1000 / rounds
+            result['cpu_ms'] = (time.process_time() - cpu) * 1000 / rounds
+        result['peak_rss_kb'] = peak_rss_kb() - rss
+        result['queries'] = len(queries) / rounds
+
+    func, args = CASES[name]
+    try:
+        func(measure, *args)
+    finally:
+        os.remove(os.environ['BENCH_DB'])
+
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Return descriptions of results that regressed past baseline."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key, noise in NOISE.items():
+            limit = max(base[key] * (1 + tolerance), base[key] + noise)
+            if result[key] > limit:
+                regressions.append(
+                    f'{name}: {key} {result[key]:.1f} > {base[key]:.1f}')
+        if result['queries'] > base['queries']:
+            regressions.append(
+                f"{name}: queries {result['queries']:g} > "
+                f"{base['queries']:g}")
+
+    return regressions
+
+
+def environment():
+    """Return versions the results depend on."""
+    import django
+    import PIL
+
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'pillow': PIL.__version__,
+        'machine': platform.machine(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--only', action='append',
+        help='Run cases whose name contains this text (repeatable).')
+    parser.add_argument(
+        '--output', default='benchmark-results.json',
+        help='File to write results to.')
+    parser.add_argument(
+        '--baseline', default=BASELINE,
+        help='Results file to compare against.')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='Allowed slowdown or memory growth as a fraction.')
+    parser.add_argument(
+        '--update-baseline', action='store_true',
+        help='Store the results as the new baseline instead of comparing.')
+    options = parser.parse_args(argv)
+
+    names = [
+        name for name in CASES
+        if not options.only or any(text in name for text in options.only)
+    ]
+    results = {}
+    for name in names:
+        with ProcessPoolExecutor(
+                max_workers=1, mp_context=get_context('spawn')) as pool:
+            result = results[name] = pool.submit(run_case, name).result()
+        print(
+            f"{name:32} wall {result['wall_ms']:9.1f} ms  "
+            f"cpu {result['cpu_ms']:9.1f} ms  "
+            f"peak rss +{result['peak_rss_kb'] / 1024:7.1f} MiB  "
+            f"queries {result['queries']:g}")
+
+    report = {'environment': environment(), 'results': results}
+    with open(options.output, 'w') as output:
+        json.dump(report, output, indent=2)
+
+    if options.update_baseline:
+        baseline = {}
+        if os.path.exists(options.baseline):
+            with open(options.baseline) as baseline_file:
+                baseline = json.load(baseline_file)['results']
+        baseline.update(results)
+        report['results'] = baseline
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        return 0
+
+    if not os.path.exists(options.baseline):
+        print(f'No baseline at {options.baseline}, nothing to compare.')
+        return 0
+    with open(options.baseline) as baseline_file:
+        baseline = json.load(baseline_file)['results']
+
+    regressions = compare(results, baseline, options.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+"""
+Helpers shared by the benchmarks.
+"""
+import os
+import resource
+
+
+def setup_django(fresh=True):
+    """Configure Django with benchmark settings and migrate the database.
+
+    With fresh set the SQLite database from a previous run is removed.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    os.environ.setdefault('ALLOWED_HOSTS', '127.0.0.1')
+
+    import django
+    from django.conf import settings
+
+    django.setup()
+
+    database = settings.DATABASES['default']['NAME']
+    if fresh and os.path.exists(database):
+        os.remove(database)
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def peak_rss_kb():
+    """Return the process peak RSS in KiB.
+
+    VmHWM is read where available because ru_maxrss survives exec() and
+    would report the parent's peak in a spawned child.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+    """Reset the peak RSS to the current RSS where Linux allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
@@ -8,6 +8,15 @@ from django.utils.translation import gettext_lazy as _
 from images import models
 
 
+def queue_regeneration(modeladmin, request, **scope):
+    """Queue regenerate_thumbnails for scope and tell the admin."""
+    from app.tasks import regenerate_thumbnails_command_task
+
+    regenerate_thumbnails_command_task.delay(**scope)
+    modeladmin.message_user(
+        request, _('Regeneration of stale thumbnails has been queued.'))
+
+
 class UserAdmin(BaseUserAdmin):
     """Define the admin pages for users."""
     ordering = ['id']
@@ -51,6 +60,14 @@ class UserAdmin(BaseUserAdmin):
             )
         }),
     )
+    actions = ['regenerate_thumbnails']
+
+    @admin.action(description=_('Regenerate stale thumbnails'))
+    def regenerate_thumbnails(self, request, queryset):
+        """Regenerate thumbnails of users moved to another account type."""
+        queue_regeneration(
+            self, request,
+            users=list(queryset.values_list('id', flat=True)))
 
 
 class AccountAdmin(admin.ModelAdmin):
@@ -77,7 +94,27 @@ class AccountAdmin(admin.ModelAdmin):
             'link_to_original',
             'link_to_binary',
             )}),
+        (_('Encoding'), {'fields': (
+            'jpeg_quality',
+            'jpeg_progressive',
+            'png_optimize',
+            'png_compress_level',
+            'png_quantize_colors',
+            'keep_exif',
+            )}),
+        (_('Upload limits'), {'fields': (
+            'max_pixels',
+            'max_dimension',
+            )}),
     )
+    actions = ['regenerate_thumbnails']
+
+    @admin.action(description=_('Regenerate stale thumbnails'))
+    def regenerate_thumbnails(self, request, queryset):
+        """Regenerate thumbnails after thumbnail sizes were edited."""
+        queue_regeneration(
+            self, request,
+            account_types=list(queryset.values_list('id', flat=True)))
 
 
 admin.site.register(models.User, UserAdmin)
@@ -0,0 +1,89 @@
+"""
+Authentication for images app.
+"""
+import pickle
+import time
+
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+
+
+_local_tokens = {}
+
+
+def token_cache_key(key):
+    """Return the shared cache key of a token's user."""
+    return f'auth-token:{key}'
+
+
+def forget_tokens(keys):
+    """Drop cached users of token keys from this process and the cache.
+
+    Other processes may keep using their local copy for at most
+    AUTH_TOKEN_LOCAL_TIMEOUT seconds.
+    """
+    keys = list(keys)
+    for key in keys:
+        _local_tokens.pop(key, None)
+    cache.delete_many([token_cache_key(key) for key in keys])
+
+
+class AccountTokenAuthentication(TokenAuthentication):
+    """Token authentication loading the user's account type in one query."""
+
+    def authenticate_credentials(self, key):
+        model = self.get_model()
+        try:
+            token = model.objects.select_related(
+                'user__account_type').get(key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(
+                _('User inactive or deleted.'))
+
+        return (token.user, token)
+
+
+class CachedTokenAuthentication(AccountTokenAuthentication):
+    """Token authentication served from a two level cache.
+
+    The user of a token is kept pickled in a small per-process dict for
+    AUTH_TOKEN_LOCAL_TIMEOUT seconds, in front of the shared cache (Redis)
+    holding it for AUTH_TOKEN_CACHE_TIMEOUT, so warm tokens authenticate
+    without database queries. Every request unpickles its own copy of the
+    user. Failed lookups aren't cached. Entries are dropped when the token
+    is deleted or its user changes (see forget_tokens()). The account
+    type isn't cached with the user but comes from the account type row
+    cache, so changing one doesn't touch the tokens of its users.
+    """
+
+    def authenticate_credentials(self, key):
+        from images.models import AccountType
+
+        now = time.monotonic()
+        entry = _local_tokens.get(key)
+        if entry is None or entry[1] < now:
+            data = cache.get(token_cache_key(key))
+            if data is None:
+                user, token = super().authenticate_credentials(key)
+                if user.account_type is not None:
+                    AccountType.objects.remember(user.account_type)
+                type(user).account_type.field.delete_cached_value(user)
+                data = pickle.dumps((user, token))
+                cache.set(
+                    token_cache_key(key), data,
+                    settings.AUTH_TOKEN_CACHE_TIMEOUT)
+            if len(_local_tokens) >= settings.AUTH_TOKEN_LOCAL_MAX_ENTRIES:
+                _local_tokens.clear()
+            entry = (data, now + settings.AUTH_TOKEN_LOCAL_TIMEOUT)
+            _local_tokens[key] = entry
+
+        user, token = pickle.loads(entry[0])
+        AccountType.objects.for_user(user)
+
+        return user, token
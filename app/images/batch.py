@@ -0,0 +1,93 @@
+"""
+Batch ingestion of many images in one request.
+"""
+import os
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.utils import timezone
+
+from images import metadata, thumbnails
+from images.executor import ImageRejected
+
+
+class EntryError(ValueError):
+    """Raised for a batch entry that can't be ingested."""
+
+
+def count_entries(archive):
+    """Return how many results archive_entries() yields, extracting none."""
+    try:
+        with zipfile.ZipFile(archive) as zip_file:
+            return sum(not info.is_dir() for info in zip_file.infolist())
+    except zipfile.BadZipFile:
+        return 1
+
+
+def archive_entries(archive):
+    """Yield (name, file) for the image entries of a ZIP archive.
+
+    Entries are streamed into temporary files on disk one at a time, so
+    neither the archive nor an entry is held in memory. The caller should
+    close each file before taking the next one. Entries over the upload
+    size limits aren't extracted.
+    """
+    max_bytes = min(
+        settings.UPLOAD_SESSION_MAX_BYTES, settings.IMAGE_MAX_BYTES)
+    try:
+        with zipfile.ZipFile(archive) as zip_file:
+            for info in zip_file.infolist():
+                if info.is_dir():
+                    continue
+                name = os.path.basename(info.filename)
+                if info.file_size > max_bytes:
+                    yield name, EntryError('File is too large.')
+                    continue
+                temp_file = TemporaryUploadedFile(
+                    name, None, info.file_size, None)
+                with zip_file.open(info) as entry:
+                    shutil.copyfileobj(entry, temp_file)
+                temp_file.seek(0)
+                yield name, temp_file
+    except zipfile.BadZipFile:
+        yield archive.name, EntryError('Archive is not a valid ZIP file.')
+
+
+def check_entry(name, file, account_type):
+    """Return the header metadata of an entry, checked like POST /image/.
+
+    Raises EntryError unless file is a PNG or JPEG image within
+    IMAGE_MAX_BYTES and the limits of account_type.
+    """
+    ftype = thumbnails.image_format(name)
+    if ftype is None:
+        raise EntryError('Only .png, .jpg and .jpeg files can be uploaded.')
+    try:
+        return metadata.check_upload(file, ftype, account_type)
+    except ImageRejected as err:
+        raise EntryError(str(err))
+
+
+def make_thumbnails(images):
+    """Generate thumbnails of saved images in a thread pool.
+
+    Pillow releases the GIL while decoding and encoding, so images are
+    thumbnailed in parallel. Updates status of each image in place.
+    """
+    now = timezone.now()
+
+    def make_thumbnail(image):
+        try:
+            created = image.make_thumbnail()
+        except (OSError, ValueError):
+            created = False
+        image.status = (
+            image.Status.READY if created else image.Status.FAILED)
+        image.status_changed_at = now
+
+    with ThreadPoolExecutor(
+            max_workers=settings.BATCH_UPLOAD_WORKERS) as pool:
+        list(pool.map(make_thumbnail, images))
@@ -0,0 +1,134 @@
+"""
+Disk cache of thumbnails rendered on demand.
+"""
+import fcntl
+import hashlib
+import os
+import uuid
+
+from django.conf import settings
+
+from images import executor, thumbnails
+
+
+def negotiate_format(accept, image):
+    """Pick the thumbnail format for an Accept header.
+
+    The first of THUMBNAIL_FORMATS that the client names explicitly and
+    Pillow can encode wins; otherwise the original's format is kept.
+    Wildcards don't count since they don't promise a decoder.
+    """
+    accepted = set()
+    for media_range in accept.split(','):
+        media_type, *params = media_range.strip().split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if quality > 0:
+            accepted.add(media_type.strip().lower())
+
+    for ftype in settings.THUMBNAIL_FORMATS:
+        if (thumbnails.MIME_TYPES[ftype] in accepted
+                and thumbnails.can_encode(ftype)):
+            return ftype
+
+    return thumbnails.image_format(image.image.name)
+
+
+def cache_path(image, size, ftype, profile=None):
+    """Return cache file path for an image rendered at size in ftype."""
+    key = hashlib.sha1(image.image.name.encode()).hexdigest()
+    ext = thumbnails.EXTENSIONS[ftype]
+    profile = thumbnails.profile_key(profile)
+
+    return os.path.join(
+        settings.DERIVATIVE_CACHE_ROOT, key[:2],
+        f'{key}_{size}_{profile}{ext}')
+
+
+def render(image, size, ftype, profile, path):
+    """Render a derivative to path unless another process already has.
+
+    Rendering happens under an exclusive lock on the lock file of the
+    derivative's directory, so concurrent requests for the same missing
+    derivative (from any worker process) wait for a single render instead
+    of repeating it. Lock files are never deleted: a lock held on an
+    unlinked file wouldn't exclude anyone.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(os.path.join(os.path.dirname(path), '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            data = executor.render_thumbnails(
+                image.image, [size], ftype, profile)[size]
+
+            temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(temp_path, 'wb') as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+
+
+def get_or_render(image, size, ftype=None, profile=None):
+    """Return the cached derivative opened for reading, rendering a miss.
+
+    The file is opened before its use is recorded, so an eviction running
+    meanwhile can't take it away; one evicted before it is opened is
+    rendered again. Without ftype the original's format is used; profile
+    is the encoder profile (account type) applied.
+    """
+    if ftype is None:
+        ftype = thumbnails.image_format(image.image.name)
+    path = cache_path(image, size, ftype, profile)
+    while True:
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            render(image, size, ftype, profile, path)
+            continue
+        os.utime(file.fileno())
+
+        return file
+
+
+def evict(max_bytes=None):
+    """Delete least recently used derivatives until the cache fits.
+
+    Cache hits refresh the file mtime, so the oldest mtime is the least
+    recently used entry. Lock files are kept (see render()). Run
+    periodically by evict_derivatives_task. Returns the number of bytes
+    removed.
+    """
+    if max_bytes is None:
+        max_bytes = settings.DERIVATIVE_CACHE_MAX_BYTES
+
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(settings.DERIVATIVE_CACHE_ROOT):
+        for name in files:
+            if name.endswith(('.lock', '.tmp')):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    removed = 0
+    entries.sort()
+    for mtime, size, path in entries:
+        if total - removed <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed += size
+
+    return removed
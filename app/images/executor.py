@@ -0,0 +1,231 @@
+"""
+Bounded process pool running Pillow jobs away from request workers.
+"""
+import atexit
+import multiprocessing
+import os
+import resource
+import threading
+import time
+import warnings
+from io import BytesIO
+
+from django.conf import settings
+
+from PIL import Image as Img
+
+from images import metrics, thumbnails
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+# Unfinished jobs of each pool, and pools waiting to be terminated.
+_jobs = {}
+_retired = set()
+
+
+class ImageRejected(ValueError):
+    """Raised for an image that exceeds the processing limits."""
+
+
+def init_worker(max_pixels, max_rss):
+    """Apply Pillow's pixel limit and the memory cap in a pool worker.
+
+    The cap is set on the address space, the limit the kernel enforces,
+    so an oversized allocation raises MemoryError instead of getting the
+    worker killed.
+    """
+    Img.MAX_IMAGE_PIXELS = max_pixels
+    if max_rss:
+        resource.setrlimit(resource.RLIMIT_AS, (max_rss, max_rss))
+
+
+def check_pixels(file, max_pixels):
+    """Raise ImageRejected if the image header declares too many pixels."""
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Img.DecompressionBombWarning)
+            with Img.open(file) as img:
+                width, height = img.size
+    except Img.DecompressionBombError as err:
+        raise ImageRejected(str(err))
+    finally:
+        file.seek(0)
+    if width * height > max_pixels:
+        raise ImageRejected(
+            f'Image has more than {max_pixels} pixels.')
+
+
+def local_path(source):
+    """Return the path of source on the local disk, or None.
+
+    Uploads spooled to disk and files of a FileSystemStorage have one.
+    """
+    if hasattr(source, 'temporary_file_path'):
+        return source.temporary_file_path()
+    try:
+        path = source.path
+    except (AttributeError, NotImplementedError, ValueError):
+        return None
+
+    return path if os.path.isfile(path) else None
+
+
+def open_source(source):
+    """Return a file of a job's source, an image path or its bytes."""
+    if isinstance(source, str):
+        return open(source, 'rb')
+
+    return BytesIO(source)
+
+
+def run_job(func, source, max_pixels, collect_metrics, *args):
+    """Run func on an image once it passes the pixel limit.
+
+    source is the path of the image file or its bytes. Returns the result
+    and, with collect_metrics, the metrics observed while producing it.
+    Images Pillow can't decode (corrupt or truncated data) are rejected
+    like images over the limits.
+    """
+    observations = []
+    with open_source(source) as file:
+        try:
+            check_pixels(file, max_pixels)
+            if not collect_metrics:
+                return func(file, *args), observations
+            with metrics.capture() as observations:
+                return func(file, *args), observations
+        except MemoryError:
+            raise ImageRejected('Image needs too much memory to process.')
+        except (OSError, SyntaxError, Img.DecompressionBombError) as err:
+            raise ImageRejected(f'Image could not be decoded: {err}')
+
+
+def get_pool():
+    """Return this process's worker pool, starting it on first use.
+
+    Workers are replaced after IMAGE_WORKER_MAX_JOBS jobs. The pool is
+    recreated after a fork, since pools don't survive one.
+    """
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = multiprocessing.Pool(
+                settings.IMAGE_WORKERS,
+                initializer=init_worker,
+                initargs=(
+                    settings.IMAGE_MAX_PIXELS,
+                    settings.IMAGE_WORKER_MAX_RSS,
+                ),
+                maxtasksperchild=settings.IMAGE_WORKER_MAX_JOBS or None,
+            )
+            _pool_pid = os.getpid()
+
+        return _pool
+
+
+def retire(pool):
+    """Stop using pool and terminate it once its other jobs are done.
+
+    Called when a job timed out: the next submit() starts a new pool,
+    while jobs already sent to this one keep running to their own
+    deadlines instead of being killed with the stuck worker. The pool is
+    terminated when they have all returned, or after IMAGE_JOB_TIMEOUT.
+    """
+    global _pool
+
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+        if pool in _retired:
+            return
+        _retired.add(pool)
+    pool.close()
+
+    def reap():
+        deadline = time.monotonic() + settings.IMAGE_JOB_TIMEOUT
+        while _jobs.get(pool) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        pool.terminate()
+        pool.join()
+        with _pool_lock:
+            _retired.discard(pool)
+            _jobs.pop(pool, None)
+
+    threading.Thread(target=reap, daemon=True).start()
+
+
+def shutdown():
+    """Terminate the worker pool, killing any running jobs."""
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.terminate()
+            _pool.join()
+        _pool = None
+
+
+atexit.register(shutdown)
+
+
+def submit(func, source, *args):
+    """Run func(file, *args) on the contents of source in the pool.
+
+    Sources over IMAGE_MAX_BYTES and images over IMAGE_MAX_PIXELS are
+    rejected before decoding. Sources on the local disk are opened by the
+    job from their path; others are read into memory and sent to it. A
+    job running longer than IMAGE_JOB_TIMEOUT is rejected and its pool
+    retired (see retire()). Jobs run in the calling process when
+    IMAGE_WORKERS is 0 or inside a daemonic process (such as a Celery
+    prefork worker, limited by the Celery settings instead), which can't
+    have children.
+    """
+    if source.size > settings.IMAGE_MAX_BYTES:
+        raise ImageRejected(
+            f'Image is larger than {settings.IMAGE_MAX_BYTES} bytes.')
+    data = local_path(source)
+    if data is None:
+        source.seek(0)
+        data = source.read()
+        source.seek(0)
+
+    if (not settings.IMAGE_WORKERS
+            or multiprocessing.current_process().daemon):
+        result, observations = run_job(
+            func, data, settings.IMAGE_MAX_PIXELS, False, *args)
+    else:
+        pool = get_pool()
+        job = pool.apply_async(run_job, (
+            func, data, settings.IMAGE_MAX_PIXELS,
+            settings.METRICS_ENABLED) + args)
+        with _pool_lock:
+            _jobs.setdefault(pool, set()).add(job)
+        try:
+            result, observations = job.get(
+                timeout=settings.IMAGE_JOB_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            retire(pool)
+            raise ImageRejected('Image processing timed out.')
+        finally:
+            with _pool_lock:
+                _jobs.get(pool, set()).discard(job)
+    metrics.replay(observations)
+
+    return result
+
+
+def render_thumbnails(source, sizes, ftype, profile=None):
+    """Run thumbnails.render_thumbnails() in the pool."""
+    return submit(
+        thumbnails.render_thumbnails, source, list(sizes), ftype,
+        thumbnails.profile_values(profile))
+
+
+def render_binary(source, ftype, profile=None):
+    """Run thumbnails.render_binary() in the pool."""
+    return submit(
+        thumbnails.render_binary, source, ftype,
+        thumbnails.profile_values(profile))
@@ -0,0 +1,203 @@
+"""
+Garbage collection of stored files no row refers to anymore.
+"""
+import datetime
+import os
+import re
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from images.links import delete_file
+from images import uploads
+from images.models import (
+    BinaryImageLink,
+    Blob,
+    Image,
+    PendingDeletion,
+    UploadSession,
+)
+
+
+REFERENCES = (
+    (Blob, 'file'),
+    (Image, 'image'),
+    (Image, 'thumbnail_size1'),
+    (Image, 'thumbnail_size2'),
+    (Image, 'binary_image'),
+    (BinaryImageLink, 'binary_image'),
+)
+
+SHA256 = re.compile(r'^[0-9a-f]{64}$')
+
+
+def blob_sha256(name):
+    """Return the SHA-256 of the blob whose derivatives hold name, or ''."""
+    parts = name.rstrip('/').split('/')
+    if len(parts) > 2 and parts[1] in ('thumbs', 'binary'):
+        for part in parts[2:]:
+            if SHA256.match(part):
+                return part
+
+    return ''
+
+
+def referenced(names):
+    """Return the names that are still in use.
+
+    A name is used when a row stores it, or when it is in the derivative
+    directory of a live blob (derivatives are reused by new images).
+    Every lookup is an indexed IN query.
+    """
+    names = list(names)
+    used = set()
+    for model, field in REFERENCES:
+        used.update(model.objects.filter(
+            **{f'{field}__in': names}).values_list(field, flat=True))
+
+    shas = {blob_sha256(name) for name in names} - {''}
+    live = set(Blob.objects.filter(
+        sha256__in=shas).values_list('sha256', flat=True))
+    used.update(name for name in names if blob_sha256(name) in live)
+
+    return used
+
+
+def delete_name(name):
+    """Delete a stored file, or the files of a directory ending in /.
+
+    Returns the number of bytes reclaimed.
+    """
+    if not name.endswith('/'):
+        return delete_file(name)
+
+    directory = name.rstrip('/')
+    try:
+        files = default_storage.listdir(directory)[1]
+    except FileNotFoundError:
+        return 0
+    reclaimed = sum(delete_file(f'{directory}/{file}') for file in files)
+    try:
+        os.rmdir(default_storage.path(directory))
+    except (NotImplementedError, OSError):
+        pass
+
+    return reclaimed
+
+
+def drain(batch_size=500):
+    """Delete logged files that nothing references, batch by batch.
+
+    Each batch is locked (skipping batches other drains hold) until its
+    files are deleted, so a blob taking back logged files waits for the
+    drain instead of racing it. Returns the number of log entries
+    processed and the bytes reclaimed.
+    """
+    processed = reclaimed = 0
+    while True:
+        with transaction.atomic():
+            batch = list(PendingDeletion.objects.select_for_update(
+                skip_locked=True).order_by('id')[:batch_size])
+            if not batch:
+                break
+            names = {entry.name for entry in batch}
+            for name in sorted(names - referenced(names)):
+                reclaimed += delete_name(name)
+            PendingDeletion.objects.filter(
+                id__in=[entry.id for entry in batch]).delete()
+        processed += len(batch)
+
+    return processed, reclaimed
+
+
+def expire_upload_sessions():
+    """Delete upload sessions older than UPLOAD_SESSION_EXPIRY seconds.
+
+    Their .part files are removed too, along with any .part file left
+    unchanged since the cutoff: the files of live sessions are all
+    younger. Returns the number of sessions deleted.
+    """
+    cutoff = timezone.now() - datetime.timedelta(
+        seconds=settings.UPLOAD_SESSION_EXPIRY)
+    expired = list(UploadSession.objects.filter(
+        created_at__lt=cutoff).only('id'))
+    deleted = UploadSession.objects.filter(
+        id__in=[session.id for session in expired]).delete()[0]
+    for session in expired:
+        uploads.remove(session.path)
+
+    try:
+        entries = list(os.scandir(settings.UPLOAD_SESSION_ROOT))
+    except FileNotFoundError:
+        return deleted
+    for entry in entries:
+        if (entry.name.endswith('.part') and entry.is_file()
+                and entry.stat().st_mtime < cutoff.timestamp()):
+            uploads.remove(entry.path)
+
+    return deleted
+
+
+def walk(directory='uploads'):
+    """Yield names of stored files under directory, depth first.
+
+    Only one directory listing is held at a time.
+    """
+    try:
+        dirs, files = default_storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in sorted(files):
+        yield f'{directory}/{name}'
+    for name in sorted(dirs):
+        yield from walk(f'{directory}/{name}')
+
+
+def batches(names, size):
+    """Yield lists of up to size items of the iterable names."""
+    batch = []
+    for name in names:
+        batch.append(name)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def reconcile(batch_size=500, min_age=3600, delete=False):
+    """Compare the media tree with the database, a batch at a time.
+
+    Files no row refers to, older than min_age seconds (younger ones may
+    belong to an upload in progress), are counted as reclaimable and,
+    with delete, logged for drain(). Returns a dict of counts and bytes.
+    """
+    report = {'files': 0, 'orphans': 0, 'reclaimable_bytes': 0}
+    cutoff = timezone.now() - datetime.timedelta(seconds=min_age)
+    for batch in batches(walk(), batch_size):
+        report['files'] += len(batch)
+        unused = set(batch) - referenced(batch)
+        if not unused:
+            continue
+
+        candidates = unused | {os.path.dirname(name) + '/' for name in unused}
+        pending = set(PendingDeletion.objects.filter(
+            name__in=candidates).values_list('name', flat=True))
+        orphans = []
+        for name in sorted(unused):
+            try:
+                if default_storage.get_modified_time(name) > cutoff:
+                    continue
+                report['reclaimable_bytes'] += default_storage.size(name)
+            except FileNotFoundError:
+                continue
+            report['orphans'] += 1
+            if (name not in pending
+                    and os.path.dirname(name) + '/' not in pending):
+                orphans.append(name)
+        if delete:
+            PendingDeletion.objects.log(orphans)
+
+    return report
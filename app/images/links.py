@@ -0,0 +1,91 @@
+"""
+Expiry of binary image links.
+"""
+import datetime
+import logging
+
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from images.models import BinaryImageLink, Image
+
+
+logger = logging.getLogger(__name__)
+
+
+def delete_file(name):
+    """Delete a stored file and return the number of bytes reclaimed."""
+    try:
+        size = default_storage.size(name)
+        default_storage.delete(name)
+    except FileNotFoundError:
+        return 0
+
+    return size
+
+
+def unreferenced_files(names):
+    """Return names no longer used by an image or a remaining link.
+
+    Binary files are shared by an image and all of its links, so only
+    files of links that owned their own copy are deleted.
+    """
+    if not names:
+        return []
+    used = set(Image.objects.filter(
+        binary_image__in=names).values_list('binary_image', flat=True))
+    used.update(BinaryImageLink.objects.filter(
+        binary_image__in=names).values_list('binary_image', flat=True))
+
+    return sorted(names - used)
+
+
+def seconds_left(expiration_date):
+    """Return seconds until expiration_date, which may be naive local."""
+    if timezone.is_aware(expiration_date):
+        now = timezone.now()
+    else:
+        now = datetime.datetime.now()
+
+    return (expiration_date - now).total_seconds()
+
+
+def schedule_expiry(link):
+    """Queue deletion of link at its expiration date.
+
+    The task is sent with a countdown once the link is committed. Links
+    whose task is lost, or can't be sent because the broker is down, are
+    left to the periodic delete_expired_links reconciliation.
+    """
+    from app.tasks import delete_expired_link_task
+
+    countdown = max(0, seconds_left(link.expiration_date))
+
+    def send():
+        try:
+            delete_expired_link_task.apply_async(
+                (link.pk,), countdown=countdown)
+        except Exception as err:
+            logger.warning(
+                'Could not schedule expiry of link %s: %s', link.pk, err)
+
+    transaction.on_commit(send)
+
+
+def expire(link_id):
+    """Delete link link_id if it has expired, with its own binary file.
+
+    Returns the number of bytes reclaimed. Deleting an already deleted
+    or not yet expired link is a no-op, so duplicate deliveries are safe.
+    """
+    link = BinaryImageLink.objects.filter(
+        pk=link_id, expiration_date__lte=timezone.now()).first()
+    if link is None:
+        return 0
+
+    link.delete()
+    names = unreferenced_files(
+        {link.binary_image.name} if link.binary_image else set())
+
+    return sum(delete_file(name) for name in names)
@@ -0,0 +1,107 @@
+"""
+Django command to store metadata of images uploaded before it was kept.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from images.metadata import read_stored
+from images.models import CommandCheckpoint, Image, User
+
+
+FILE_FIELDS = ('image', 'thumbnail_size1', 'thumbnail_size2')
+
+METADATA_FIELDS = (
+    'width',
+    'height',
+    'format',
+    'file_size',
+    'orientation',
+    'thumbnail_size1_width',
+    'thumbnail_size1_height',
+    'thumbnail_size2_width',
+    'thumbnail_size2_height',
+)
+
+
+class Command(BaseCommand):
+    """Read the headers of stored files and save their metadata.
+
+    Images without dimensions are scanned in id ordered batches. The
+    headers of each batch's originals and thumbnails (each file once, as
+    blobs are shared) are read by --workers threads, then the rows are
+    written with one bulk update. The last id is checkpointed so an
+    interrupted run resumes.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=200,
+            help='Number of images read and updated at a time.',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help='Number of threads reading file headers.',
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore the checkpoint of a previous run.',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        images = Image.objects.filter(width=None).exclude(image='').exclude(
+            image=None).order_by('id').only('id', 'user_id', *FILE_FIELDS)
+
+        checkpoint, created = CommandCheckpoint.objects.get_or_create(
+            scope='backfill_image_metadata')
+        if options['restart']:
+            checkpoint.last_id = 0
+        elif not created:
+            self.stdout.write(f'Resuming after image {checkpoint.last_id}.')
+
+        updated = failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                batch = list(images.filter(
+                    id__gt=checkpoint.last_id)[:options['batch_size']])
+                if not batch:
+                    break
+
+                names = sorted({
+                    getattr(image, field).name for image in batch
+                    for field in FILE_FIELDS if getattr(image, field)
+                })
+                headers = dict(zip(names, pool.map(read_stored, names)))
+
+                changed = []
+                for image in batch:
+                    header = headers[image.image.name]
+                    if not header:
+                        self.stderr.write(
+                            f'Could not read {image.image.name}, skipped.')
+                        failed += 1
+                        continue
+                    image.set_metadata(header)
+                    for field in FILE_FIELDS[1:]:
+                        thumb = headers.get(getattr(image, field).name, {})
+                        setattr(image, f'{field}_width', thumb.get('width'))
+                        setattr(image, f'{field}_height', thumb.get('height'))
+                    changed.append(image)
+
+                Image.objects.bulk_update(changed, METADATA_FIELDS)
+                for user_id in {image.user_id for image in changed}:
+                    User.objects.touch_library(user_id)
+
+                checkpoint.last_id = batch[-1].id
+                checkpoint.save(update_fields=['last_id', 'updated_at'])
+                updated += len(changed)
+
+        checkpoint.delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored metadata of {updated} images, {failed} unreadable.'))
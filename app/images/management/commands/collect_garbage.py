@@ -0,0 +1,60 @@
+"""
+Django command to delete stored files no longer in use.
+"""
+from django.core.management.base import BaseCommand
+
+from images import gc
+
+
+class Command(BaseCommand):
+    """Drain the pending deletion log, or reconcile the media tree.
+
+    Deleted images and blobs log their files for deletion; by default
+    the log is drained now (Celery beat also drains it every minute),
+    and expired upload sessions are deleted with their files.
+    --reconcile streams the media tree against the database instead and
+    reports the files nothing refers to; with --delete they are logged
+    for the next drain.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reconcile',
+            action='store_true',
+            help='Report stored files no row refers to.',
+        )
+        parser.add_argument(
+            '--delete',
+            action='store_true',
+            help='With --reconcile, log the unreferenced files for deletion.',
+        )
+        parser.add_argument(
+            '--min-age',
+            type=int,
+            default=3600,
+            help='Seconds a file must be unchanged to be reclaimable.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of names checked per query.',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        if not options['reconcile']:
+            processed, reclaimed = gc.drain(options['batch_size'])
+            expired = gc.expire_upload_sessions()
+            self.stdout.write(self.style.SUCCESS(
+                f'Processed {processed} pending deletions, '
+                f'{reclaimed} bytes reclaimed, '
+                f'{expired} upload sessions expired.'))
+            return
+
+        report = gc.reconcile(
+            options['batch_size'], options['min_age'], options['delete'])
+        action = 'logged for deletion' if options['delete'] else 'reclaimable'
+        self.stdout.write(self.style.SUCCESS(
+            f"Scanned {report['files']} files, {report['orphans']} "
+            f"unreferenced, {report['reclaimable_bytes']} bytes {action}."))
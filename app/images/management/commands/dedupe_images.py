@@ -0,0 +1,54 @@
+"""
+Django command to move originals into content addressed blobs.
+"""
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from images.models import Blob, Image, User, log_rolled_back_files
+
+
+class Command(BaseCommand):
+    """Point images stored before deduplication at shared blobs."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of images fetched per query.',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        pending = Image.objects.filter(blob__isnull=True).exclude(
+            image='').exclude(image__isnull=True).only(
+                'id', 'user_id', 'image')
+
+        moved = 0
+        reclaimed = 0
+        for image in pending.iterator(chunk_size=options['batch_size']):
+            old_name = image.image.name
+            try:
+                with default_storage.open(old_name, 'rb') as original:
+                    with transaction.atomic():
+                        blob = Blob.objects.acquire(
+                            File(original, name=old_name))
+                        Image.objects.filter(pk=image.pk).update(
+                            blob=blob, image=blob.file.name)
+                        User.objects.touch_library(image.user_id)
+            except FileNotFoundError:
+                self.stderr.write(f'Missing file {old_name} of image '
+                                  f'{image.pk}, skipped.')
+                continue
+            finally:
+                log_rolled_back_files()
+
+            if old_name != blob.file.name:
+                reclaimed += default_storage.size(old_name)
+                default_storage.delete(old_name)
+            moved += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved {moved} images into blobs, {reclaimed} bytes reclaimed.'))
@@ -1,41 +1,72 @@
 """
 Django command to delete expired binary images links.
 """
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from django.utils import timezone
 from django.core.management.base import BaseCommand
 
+from images import links, metrics
 from images.models import BinaryImageLink
 
-from pytz import timezone as tz
-from django.conf import settings
-
 
 class Command(BaseCommand):
-    """Searching for expired links and removing them."""
+    """Searching for expired links and removing them.
 
-    def handle(self, *args, **options):
-        """Entrypoint for command"""
+    Links are deleted by their own task when they expire; this sweep
+    only catches links whose task was lost.
+    """
 
-        settings_time_zone = tz(settings.TIME_ZONE)
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of links deleted per query.',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=8,
+            help='Number of threads deleting files.',
+        )
 
-        today = timezone.now()
-        today_aware = today.astimezone(settings_time_zone)
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        started = time.monotonic()
+        now = timezone.now()
+        expired = BinaryImageLink.objects.filter(
+            expiration_date__lt=now).order_by('id')
 
-        links = BinaryImageLink.objects.all()
         link_count = 0
+        file_count = 0
+        reclaimed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                with metrics.span('sweep', 'db'):
+                    batch = list(expired.values_list(
+                        'id', 'binary_image')[:options['batch_size']])
+                    if not batch:
+                        break
+
+                    ids = [link_id for link_id, name in batch]
+                    link_count += BinaryImageLink.objects.filter(
+                        id__in=ids).delete()[0]
 
-        for link in links:
-            link_date = link.expiration_date.astimezone(
-                settings_time_zone)
-            if link_date < today_aware:
-                self.stdout.write(
-                    f"Log at {today_aware}. {link.binary_image.name} will be deleted. It's time expired at {link_date}.")
-                link.delete()
-                link_count += 1
+                    names = links.unreferenced_files(
+                        {name for link_id, name in batch if name})
+                file_count += len(names)
+                with metrics.span('sweep', 'store'):
+                    reclaimed += sum(pool.map(links.delete_file, names))
 
+        elapsed = time.monotonic() - started
         if link_count > 0:
             self.stdout.write(
-                f"Periodic taks ended. The number of deleted links: {link_count}")
+                f"Periodic taks ended. The number of deleted links: "
+                f"{link_count}, files: {file_count}, bytes reclaimed: "
+                f"{reclaimed}, elapsed: {elapsed:.2f}s")
         else:
             self.stdout.write(
-                f"Log at {today_aware}. Periodic taks ended. There was nothing to delete.")
+                f"Log at {now}. Periodic taks ended. "
+                f"There was nothing to delete.")
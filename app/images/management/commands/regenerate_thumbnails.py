@@ -0,0 +1,103 @@
+"""
+Django command to regenerate thumbnails left at old account type sizes.
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from images.models import AccountType, CommandCheckpoint, Image
+from images.regenerate import is_stale
+
+
+class Command(BaseCommand):
+    """Find stale thumbnails and queue their regeneration on Celery.
+
+    Images are scanned in id order and the last scanned id is stored in a
+    checkpoint per scope (the --account-type and --user options), so an
+    interrupted run resumes where it stopped. Stale images are queued in
+    batches at no more than --rate images per second.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--account-type',
+            type=int,
+            action='append',
+            help='Only images of users of this account type (repeatable).',
+        )
+        parser.add_argument(
+            '--user',
+            type=int,
+            action='append',
+            help='Only images of this user (repeatable).',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Number of images scanned per query.',
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=settings.REGENERATE_THUMBNAILS_RATE,
+            help='Images queued per second, 0 for no limit.',
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore the checkpoint of a previous run.',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        from app.tasks import regenerate_thumbnails_task
+
+        account_types = sorted(options['account_type'] or [])
+        users = sorted(options['user'] or [])
+        images = Image.objects.filter(status=Image.Status.READY).exclude(
+            image='').select_related('blob', 'user').order_by('id')
+        if account_types:
+            images = images.filter(user__account_type__in=account_types)
+        if users:
+            images = images.filter(user__in=users)
+
+        scope = (f'regenerate_thumbnails account_types={account_types} '
+                 f'users={users}')
+        checkpoint, created = CommandCheckpoint.objects.get_or_create(
+            scope=scope)
+        if options['restart']:
+            checkpoint.last_id = 0
+        elif not created:
+            self.stdout.write(
+                f'Resuming after image {checkpoint.last_id}.')
+
+        started = time.monotonic()
+        scanned = queued = 0
+        while True:
+            batch = list(images.filter(
+                id__gt=checkpoint.last_id)[:options['batch_size']])
+            if not batch:
+                break
+
+            ids = []
+            for image in batch:
+                account_type = AccountType.objects.for_user(image.user)
+                if account_type is not None and is_stale(image, account_type):
+                    ids.append(image.id)
+            if ids:
+                regenerate_thumbnails_task.delay(ids)
+
+            checkpoint.last_id = batch[-1].id
+            checkpoint.save(update_fields=['last_id', 'updated_at'])
+            scanned += len(batch)
+            queued += len(ids)
+            if options['rate'] > 0:
+                delay = started + queued / options['rate'] - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+        checkpoint.delete()
+        self.stdout.write(self.style.SUCCESS(
+            f'Scanned {scanned} images, queued {queued} for regeneration.'))
@@ -0,0 +1,273 @@
+"""
+Django command to move stored files into the sharded media layout.
+"""
+import os
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, F, Q, Value, When
+
+from images.models import (
+    BinaryImageLink,
+    Blob,
+    CommandCheckpoint,
+    Image,
+    MediaMove,
+    User,
+    sharded_name,
+)
+
+
+FIELDS = (
+    (Blob, ('file',)),
+    (Image, ('image', 'thumbnail_size1', 'thumbnail_size2', 'binary_image')),
+    (BinaryImageLink, ('binary_image',)),
+)
+
+
+def link_file(source, target):
+    """Store the file source under the name target as well.
+
+    A hard link is made when the storage is on a local file system, so
+    no data is copied; other storages get a copy.
+    """
+    try:
+        source_path = default_storage.path(source)
+        target_path = default_storage.path(target)
+    except NotImplementedError:
+        if not default_storage.exists(target):
+            with default_storage.open(source, 'rb') as file:
+                default_storage.save(target, file)
+        return
+
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    try:
+        os.link(source_path, target_path)
+    except FileExistsError:
+        pass
+
+
+def remove_file(name):
+    """Delete a stored file and the directories it leaves empty."""
+    default_storage.delete(name)
+    try:
+        directory = os.path.dirname(default_storage.path(name))
+        root = default_storage.path('uploads')
+    except NotImplementedError:
+        return
+    while directory.startswith(root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+def blob_derivatives(blob):
+    """Return names in the derivative directories next to blob's file.
+
+    Blob thumbnails and binary images (of any encoder profile) live in
+    uploads/<kind>/<shard dirs>/<sha256>/, in the layout of the original.
+    """
+    parts = blob.file.name.split('/')
+    names = []
+    for kind in ('thumbs', 'binary'):
+        directory = '/'.join(['uploads', kind, *parts[2:-1], blob.sha256])
+        if default_storage.exists(directory):
+            names += [
+                f'{directory}/{name}'
+                for name in default_storage.listdir(directory)[1]
+            ]
+
+    return names
+
+
+def rename_rows(model, field, rows, renames):
+    """Set field of rows to its new name where it still has the old one.
+
+    Rows changed since they were read keep their current value.
+    """
+    whens = []
+    for row in rows:
+        old = getattr(row, field).name
+        whens.append(When(
+            Q(pk=row.pk, **{field: old}), then=Value(renames[old])))
+    model.objects.filter(pk__in=[row.pk for row in rows]).update(**{
+        field: Case(
+            *whens, default=F(field),
+            output_field=model._meta.get_field(field)),
+    })
+
+
+class Command(BaseCommand):
+    """Move stored files to the layout of MEDIA_SHARD_DEPTH, online.
+
+    Blobs, images and links are rewritten in id ordered batches, with the
+    last id of each model kept in a checkpoint so an interrupted run
+    resumes. Every file is first hard linked (or copied) to its new name
+    and journaled in MediaMove; rows are then rewritten with conditional
+    updates, so concurrent changes win. Old names are deleted only after
+    every row has been rewritten, so a file is always reachable under the
+    name the database has, and owners of rewritten images get new ETags.
+    --rollback restores the journaled names and --clear-journal forgets
+    them once the new layout is final.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of rows rewritten per transaction.',
+        )
+        parser.add_argument(
+            '--rollback',
+            action='store_true',
+            help='Move journaled files back to their old names.',
+        )
+        parser.add_argument(
+            '--clear-journal',
+            action='store_true',
+            help='Forget journaled moves; they can no longer be rolled back.',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command"""
+        if options['clear_journal']:
+            count = MediaMove.objects.all().delete()[0]
+            self.stdout.write(self.style.SUCCESS(
+                f'Forgot {count} moved files.'))
+            return
+
+        rollback = options['rollback']
+        direction = 'rollback' if rollback else 'forward'
+        rewritten = 0
+        for model, fields in FIELDS:
+            scope = f'shard_media {direction} {model._meta.label}'
+            checkpoint, created = CommandCheckpoint.objects.get_or_create(
+                scope=scope)
+            if not created:
+                self.stdout.write(f'Resuming {model._meta.label} after '
+                                  f'{checkpoint.last_id}.')
+            rewritten += self.rewrite(
+                model, fields, checkpoint, options['batch_size'], rollback)
+
+        if rollback:
+            files = self.finish_rollback()
+        else:
+            files = self.finish_forward()
+        CommandCheckpoint.objects.filter(
+            scope__startswith=f'shard_media {direction} ').delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rewrote {rewritten} names, '
+            f'{"restored" if rollback else "moved"} {files} files.'))
+
+    def rewrite(self, model, fields, checkpoint, batch_size, rollback):
+        """Rewrite the names in fields of model rows after the checkpoint."""
+        loaded = {Blob: ('sha256',), Image: ('user_id',)}.get(model, ())
+        rows = model.objects.order_by('id').only('id', *loaded, *fields)
+
+        rewritten = 0
+        while True:
+            batch = list(rows.filter(id__gt=checkpoint.last_id)[:batch_size])
+            if not batch:
+                break
+
+            names = {
+                getattr(row, field).name
+                for row in batch for field in fields if getattr(row, field)
+            }
+            if rollback:
+                renames = self.restore(names)
+            else:
+                if model is Blob:
+                    for blob in batch:
+                        names.update(blob_derivatives(blob))
+                renames = self.move(names)
+
+            with transaction.atomic():
+                owners = set()
+                for field in fields:
+                    renamed = [
+                        row for row in batch
+                        if getattr(row, field).name in renames
+                    ]
+                    if not renamed:
+                        continue
+                    rename_rows(model, field, renamed, renames)
+                    rewritten += len(renamed)
+                    if model is Image:
+                        owners.update(row.user_id for row in renamed)
+                for user_id in owners:
+                    User.objects.touch_library(user_id)
+                checkpoint.last_id = batch[-1].id
+                checkpoint.save(update_fields=['last_id', 'updated_at'])
+
+        return rewritten
+
+    def move(self, names):
+        """Link names to their sharded names, journaling each move.
+
+        Returns old to new names of files that exist. Names moved by an
+        earlier batch or run are taken from the journal.
+        """
+        targets = {
+            name: sharded_name(name) for name in names
+            if sharded_name(name) != name
+        }
+        renames = dict(MediaMove.objects.filter(
+            old_name__in=targets).values_list('old_name', 'new_name'))
+
+        moves = []
+        for old, new in targets.items():
+            if old in renames:
+                continue
+            if not default_storage.exists(old):
+                self.stderr.write(f'Missing file {old}, skipped.')
+                continue
+            link_file(old, new)
+            moves.append(MediaMove(old_name=old, new_name=new))
+            renames[old] = new
+        MediaMove.objects.bulk_create(moves, ignore_conflicts=True)
+
+        return renames
+
+    def restore(self, names):
+        """Make sure journaled old names exist again for the new names.
+
+        Returns new to old names.
+        """
+        renames = dict(MediaMove.objects.filter(
+            new_name__in=names).values_list('new_name', 'old_name'))
+        for new, old in renames.items():
+            if (not default_storage.exists(old)
+                    and default_storage.exists(new)):
+                link_file(new, old)
+
+        return renames
+
+    def finish_forward(self):
+        """Delete the old names of journaled files now nothing uses them."""
+        removed = 0
+        for move in MediaMove.objects.order_by('id').iterator():
+            if default_storage.exists(move.old_name):
+                remove_file(move.old_name)
+                removed += 1
+
+        return removed
+
+    def finish_rollback(self):
+        """Delete the new names of journaled files and the journal."""
+        restored = 0
+        moves = MediaMove.objects.order_by('id')
+        for move in moves.iterator():
+            if default_storage.exists(move.new_name):
+                if not default_storage.exists(move.old_name):
+                    link_file(move.new_name, move.old_name)
+                remove_file(move.new_name)
+            restored += 1
+        moves.delete()
+
+        return restored
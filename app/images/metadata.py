@@ -0,0 +1,131 @@
+"""
+Image metadata read from file headers.
+"""
+import warnings
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from PIL import Image as Img, UnidentifiedImageError
+
+from images.executor import ImageRejected
+
+
+ORIENTATION_TAG = 0x0112
+
+MAGIC_NUMBERS = (
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'\xff\xd8\xff', 'JPEG'),
+)
+
+# Formats Pillow names after a variant of the file type they belong to:
+# phone cameras store multi-picture JPEGs, which Pillow opens as MPO.
+FORMAT_ALIASES = {
+    'MPO': 'JPEG',
+}
+
+
+def sniff_format(file):
+    """Return the Pillow format file's magic bytes name, or None."""
+    file.seek(0)
+    head = file.read(8)
+    file.seek(0)
+    for magic, ftype in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return ftype
+
+    return None
+
+
+def exif_orientation(img):
+    """Return the EXIF orientation (1-8) of an opened image.
+
+    Only EXIF data Pillow read with the header is looked at (the APP1
+    segment of a JPEG, an eXIf chunk before the image data of a PNG), so
+    nothing is decoded to find it. Images without one are upright (1).
+    """
+    data = img.info.get('exif')
+    if not data:
+        return 1
+    exif = Img.Exif()
+    try:
+        exif.load(data)
+    except (OSError, SyntaxError, ValueError):
+        return 1
+    orientation = exif.get(ORIENTATION_TAG)
+    if orientation not in range(1, 9):
+        return 1
+
+    return orientation
+
+
+def read_header(file):
+    """Return Image metadata field values read from file's header alone.
+
+    Pillow's open() parses the header without decoding pixel data.
+    Variants of a format are reported as the format (see FORMAT_ALIASES).
+    Returns an empty dict for files that aren't images. Raises
+    ImageRejected for images too large for Pillow to open at all.
+    """
+    file.seek(0)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Img.DecompressionBombWarning)
+            with Img.open(file) as img:
+                width, height = img.size
+                return {
+                    'width': width,
+                    'height': height,
+                    'format': FORMAT_ALIASES.get(img.format, img.format),
+                    'file_size': file.size,
+                    'orientation': exif_orientation(img),
+                }
+    except Img.DecompressionBombError as err:
+        raise ImageRejected(str(err))
+    except (UnidentifiedImageError, OSError):
+        return {}
+    finally:
+        file.seek(0)
+
+
+def check_upload(file, ftype, account_type):
+    """Return read_header() of an upload after checking it's acceptable.
+
+    The size, the magic bytes (which must name ftype, the format of the
+    file's extension) and the header's dimensions are checked against
+    IMAGE_MAX_BYTES and the limits of account_type (which may be None),
+    so nothing is decoded or stored. Raises ImageRejected otherwise.
+    """
+    if file.size > settings.IMAGE_MAX_BYTES:
+        raise ImageRejected(
+            f'Image is larger than {settings.IMAGE_MAX_BYTES} bytes.')
+    content = sniff_format(file)
+    if content is None:
+        raise ImageRejected('File is not a valid image.')
+    if content != ftype:
+        raise ImageRejected(f'File content is {content}, not {ftype}.')
+    header = read_header(file)
+    if not header or header['format'] != ftype:
+        raise ImageRejected('File is not a valid image.')
+
+    max_pixels = settings.IMAGE_MAX_PIXELS
+    if account_type is not None:
+        max_pixels = account_type.pixel_limit
+        max_dimension = account_type.max_dimension
+        if max_dimension and max(
+                header['width'], header['height']) > max_dimension:
+            raise ImageRejected(
+                f'Image is larger than {max_dimension} pixels on a side.')
+    if header['width'] * header['height'] > max_pixels:
+        raise ImageRejected(f'Image has more than {max_pixels} pixels.')
+
+    return header
+
+
+def read_stored(name):
+    """Return read_header() of a stored file, or {} if it is missing."""
+    try:
+        with default_storage.open(name, 'rb') as file:
+            return read_header(file)
+    except (OSError, ImageRejected):
+        return {}
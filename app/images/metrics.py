@@ -0,0 +1,201 @@
+"""
+Timing spans, histograms and a Prometheus text /metrics endpoint.
+
+Metrics are kept per process; with several app workers each one serves
+its own. Nothing is recorded unless METRICS_ENABLED is set.
+"""
+import bisect
+import contextlib
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.http import Http404, HttpResponse
+
+
+SECONDS_BUCKETS = (
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_disabled = contextlib.nullcontext()
+_capture = threading.local()
+
+
+class Histogram:
+    """Prometheus style cumulative histogram with labelled series."""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        """Add value to the series of labels (a tuple of pairs)."""
+        with self.lock:
+            counts, total = self.series.get(
+                labels, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.series[labels] = counts, total + value
+
+    def render(self):
+        """Return the histogram in Prometheus text exposition format."""
+        lines = [
+            f'# HELP {self.name} {self.help_text}',
+            f'# TYPE {self.name} histogram',
+        ]
+        with self.lock:
+            series = sorted(self.series.items())
+        for labels, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = format_labels(labels + (('le', bound),))
+                lines.append(
+                    f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+            lines.append(
+                f'{self.name}_count{format_labels(labels)} {cumulative}')
+
+        return '\n'.join(lines)
+
+
+def format_labels(labels):
+    """Return labels as a Prometheus label set."""
+    pairs = ','.join(f'{key}="{value}"' for key, value in labels)
+
+    return '{' + pairs + '}'
+
+
+STAGE_SECONDS = Histogram(
+    'image_stage_seconds',
+    'Time spent in each stage of image operations.',
+    SECONDS_BUCKETS)
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds',
+    'Request latency per view and DRF action.',
+    SECONDS_BUCKETS)
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries',
+    'Database queries run per request.',
+    QUERY_BUCKETS)
+
+HISTOGRAMS = {
+    histogram.name: histogram
+    for histogram in (STAGE_SECONDS, REQUEST_SECONDS, REQUEST_QUERIES)
+}
+
+
+def record(name, labels, value):
+    """Observe value, or keep it for the capture() around this call."""
+    observations = getattr(_capture, 'observations', None)
+    if observations is not None:
+        observations.append((name, labels, value))
+    else:
+        HISTOGRAMS[name].observe(labels, value)
+
+
+@contextlib.contextmanager
+def _span(operation, stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(
+            STAGE_SECONDS.name,
+            (('operation', operation), ('stage', stage)),
+            time.perf_counter() - started)
+
+
+def span(operation, stage):
+    """Return a context manager timing stage of operation.
+
+    Stages are decode, resize (convert for binary images), encode, store
+    and db. With metrics disabled, and outside capture(), a shared no-op
+    context manager is returned.
+    """
+    if (not settings.METRICS_ENABLED
+            and getattr(_capture, 'observations', None) is None):
+        return _disabled
+
+    return _span(operation, stage)
+
+
+@contextlib.contextmanager
+def capture():
+    """Collect observations made in this thread instead of recording them.
+
+    Used by image pool workers, whose observations are sent back with
+    the job result and replayed in the requesting process.
+    """
+    _capture.observations = []
+    try:
+        yield _capture.observations
+    finally:
+        del _capture.observations
+
+
+def replay(observations):
+    """Record observations collected by capture()."""
+    for name, labels, value in observations:
+        HISTOGRAMS[name].observe(labels, value)
+
+
+class MetricsMiddleware:
+    """Record latency and query count of every request.
+
+    DRF responses are labelled with the view and action that handled
+    them, other responses with the URL name.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        queries = 0
+
+        def count_query(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count_query):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        view = getattr(response, 'renderer_context', {}).get('view')
+        if view is not None:
+            labels = (
+                ('view', type(view).__name__),
+                ('action', getattr(view, 'action', None) or
+                 request.method.lower()),
+            )
+        else:
+            match = request.resolver_match
+            labels = (
+                ('view', match.url_name if match else 'unresolved'),
+                ('action', request.method.lower()),
+            )
+
+        REQUEST_SECONDS.observe(
+            labels + (('status', response.status_code),), elapsed)
+        REQUEST_QUERIES.observe(labels, queries)
+
+        return response
+
+
+def metrics_view(request):
+    """Serve all histograms in Prometheus text format."""
+    if not settings.METRICS_ENABLED:
+        raise Http404('Metrics are disabled.')
+    text = '\n'.join(
+        histogram.render() for histogram in HISTOGRAMS.values())
+
+    return HttpResponse(
+        text + '\n', content_type='text/plain; version=0.0.4')
@@ -0,0 +1,17 @@
+# Generated by Django 4.0.8 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0013_image_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', '-id'], name='image_user_id_desc_idx'),
+        ),
+    ]
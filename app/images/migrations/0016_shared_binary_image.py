@@ -0,0 +1,25 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+import images.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0015_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='binaryimagelink',
+            name='image',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='links', to='images.image'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='binary_image',
+            field=models.ImageField(blank=True, null=True, upload_to=images.models.binary_file_path),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0016_shared_binary_image'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='binaryimagelink',
+            name='expiration_date',
+            field=models.DateTimeField(db_index=True, default=None),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+import images.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0017_binaryimagelink_expiration_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.ImageField(upload_to=images.models.blob_file_path)),
+                ('size', models.BigIntegerField()),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='images', to='images.blob'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.0.10 on 2026-10-18 16:36
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0018_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accounttype',
+            name='jpeg_progressive',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='accounttype',
+            name='jpeg_quality',
+            field=models.PositiveSmallIntegerField(default=75, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(95)]),
+        ),
+        migrations.AddField(
+            model_name='accounttype',
+            name='png_compress_level',
+            field=models.PositiveSmallIntegerField(default=6, validators=[django.core.validators.MaxValueValidator(9)]),
+        ),
+        migrations.AddField(
+            model_name='accounttype',
+            name='png_optimize',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='accounttype',
+            name='png_quantize_colors',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(2), django.core.validators.MaxValueValidator(256)]),
+        ),
+        migrations.AddField(
+            model_name='accounttype',
+            name='strip_metadata',
+            field=models.BooleanField(default=False),
+        ),
+    ]
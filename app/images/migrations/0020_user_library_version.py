@@ -0,0 +1,24 @@
+# Generated by Django 4.0.10 on 2026-10-18 17:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0019_accounttype_encoder_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='library_modified',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='library_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.10 on 2026-10-18 17:05
+
+from django.db import migrations, models
+import images.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0020_user_library_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='binaryimagelink',
+            name='binary_image',
+            field=models.ImageField(blank=True, db_index=True, null=True, upload_to=images.models.binary_file_path),
+        ),
+    ]
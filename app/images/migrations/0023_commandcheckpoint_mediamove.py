@@ -0,0 +1,30 @@
+# Generated by Django 4.0.10 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0022_regenerationcheckpoint'),
+    ]
+
+    operations = [
+        migrations.RenameModel(
+            old_name='RegenerationCheckpoint',
+            new_name='CommandCheckpoint',
+        ),
+        migrations.RenameField(
+            model_name='commandcheckpoint',
+            old_name='last_image_id',
+            new_name='last_id',
+        ),
+        migrations.CreateModel(
+            name='MediaMove',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('old_name', models.CharField(max_length=255, unique=True)),
+                ('new_name', models.CharField(db_index=True, max_length=255)),
+            ],
+        ),
+    ]
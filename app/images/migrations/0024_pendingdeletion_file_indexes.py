@@ -0,0 +1,48 @@
+# Generated by Django 4.0.10 on 2026-10-18 17:29
+
+import django.core.validators
+from django.db import migrations, models
+import images.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0023_commandcheckpoint_mediamove'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='blob',
+            name='file',
+            field=models.ImageField(db_index=True, upload_to=images.models.blob_file_path),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='binary_image',
+            field=models.ImageField(blank=True, db_index=True, null=True, upload_to=images.models.binary_file_path),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='image',
+            field=models.ImageField(db_index=True, null=True, upload_to=images.models.image_file_path, validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['png', 'jpeg', 'jpg'])]),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='thumbnail_size1',
+            field=models.ImageField(blank=True, db_index=True, null=True, upload_to=images.models.thumb_file_path),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='thumbnail_size2',
+            field=models.ImageField(blank=True, db_index=True, null=True, upload_to=images.models.thumb_file_path),
+        ),
+    ]
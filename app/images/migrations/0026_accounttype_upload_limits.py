@@ -0,0 +1,23 @@
+# Generated by Django 4.0.10 on 2026-10-18 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0025_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accounttype',
+            name='max_dimension',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='accounttype',
+            name='max_pixels',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.10 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0026_accounttype_upload_limits'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='accounttype',
+            name='strip_metadata',
+        ),
+        migrations.AddField(
+            model_name='accounttype',
+            name='keep_exif',
+            field=models.BooleanField(default=False),
+        ),
+    ]
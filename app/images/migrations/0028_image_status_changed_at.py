@@ -0,0 +1,19 @@
+# Generated by Django 4.0.10 on 2026-10-18 19:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('images', '0027_accounttype_keep_exif'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='status_changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
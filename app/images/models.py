@@ -1,25 +1,37 @@
 """
 Database models.
 """
+import hashlib
 import uuid
 import os
 import datetime
+import threading
+import time
 
 import os.path
-from PIL import Image as Img
-from io import BytesIO
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import (
     AbstractBaseUser,
     BaseUserManager,
     PermissionsMixin,
 )
+from django.core.cache import cache
 from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.validators import (
     FileExtensionValidator,
+    MaxValueValidator,
+    MinValueValidator,
 )
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from rest_framework.authtoken.models import Token
+
+from images import authentication, executor, metadata, metrics, thumbnails
 
 
 def create_uuid_filename(filename):
@@ -30,19 +42,109 @@ def create_uuid_filename(filename):
     return filename
 
 
+MEDIA_KINDS = ('images', 'thumbs', 'binary')
+
+
+def shard_dirs(key):
+    """Return the MEDIA_SHARD_DEPTH directory levels for a hex key.
+
+    Each level is the next two characters of the key (a UUID or a
+    SHA-256), so at depth 2 a name lands in uploads/<kind>/ab/cd/.
+    """
+    key = key.replace('-', '')
+    return [
+        key[level * 2:level * 2 + 2]
+        for level in range(settings.MEDIA_SHARD_DEPTH)
+    ]
+
+
+def sharded_path(kind, key, *names):
+    """Return the storage name of names under uploads/kind sharded by key."""
+    return os.path.join('uploads', kind, *shard_dirs(key), *names)
+
+
+def sharded_name(name):
+    """Return where a stored name belongs in the current layout.
+
+    Shard directories of another depth are dropped and added again, so
+    the result doesn't depend on the layout name was stored with. Names
+    outside uploads/<kind>/ are returned unchanged.
+    """
+    parts = name.split('/')
+    if len(parts) < 3 or parts[0] != 'uploads' or parts[1] not in MEDIA_KINDS:
+        return name
+    rest = parts[2:]
+    while len(rest) > 1 and len(rest[0]) == 2:
+        rest = rest[1:]
+    key = os.path.splitext(rest[0])[0]
+
+    return sharded_path(parts[1], key, *rest)
+
+
 def image_file_path(instance, filename):
     """Generate file path for image."""
-    return os.path.join('uploads', 'images', create_uuid_filename(filename))
+    filename = create_uuid_filename(filename)
+    return sharded_path('images', filename, filename)
 
 
 def thumb_file_path(instance, filename):
     """Generate file path for thumbnail."""
-    return os.path.join('uploads', 'thumbs', create_uuid_filename(filename))
+    filename = create_uuid_filename(filename)
+    return sharded_path('thumbs', filename, filename)
 
 
 def binary_file_path(instance, filename):
     """Generate file path for binary image."""
-    return os.path.join('uploads', 'binary', create_uuid_filename(filename))
+    filename = create_uuid_filename(filename)
+    return sharded_path('binary', filename, filename)
+
+
+def blob_file_path(instance, filename):
+    """Generate content addressed file path for an original image."""
+    ext = os.path.splitext(filename)[1].lower()
+    return sharded_path('images', instance.sha256, f'{instance.sha256}{ext}')
+
+
+def library_cache_key(user_id):
+    """Return the shared cache key of a user's library state."""
+    return f'library:{user_id}'
+
+
+# Names of files stored by this thread's transactions, until they commit.
+_stored_files = threading.local()
+
+
+def track_stored_file(name):
+    """Remember a file stored in the current transaction until it commits."""
+    names = _stored_files.__dict__.setdefault('names', set())
+    names.add(name)
+    transaction.on_commit(lambda: names.discard(name))
+
+
+def log_rolled_back_files():
+    """Hand files stored by transactions that rolled back to the GC.
+
+    Outside a transaction the on_commit callbacks of every committed one
+    have run, so names still tracked were stored by transactions (or
+    savepoints) that rolled back. The garbage collector keeps the ones
+    a later transaction has taken.
+    """
+    if transaction.get_connection().in_atomic_block:
+        return
+    names = getattr(_stored_files, 'names', None)
+    if names:
+        PendingDeletion.objects.log(sorted(names))
+        names.clear()
+
+
+def file_sha256(file):
+    """Return SHA-256 hex digest of a file read in chunks."""
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+
+    return digest.hexdigest()
 
 
 class UserManager(BaseUserManager):
@@ -58,6 +160,39 @@ class UserManager(BaseUserManager):
 
         return user
 
+    def touch_library(self, user_id):
+        """Record a change to the user's images, invalidating their ETags."""
+        self.filter(pk=user_id).update(
+            library_version=models.F('library_version') + 1,
+            library_modified=timezone.now(),
+        )
+        self.forget_library_state(user_id)
+
+    def library_state(self, user_id):
+        """Return (library_version, library_modified) of a user.
+
+        The pair is read through the shared cache, as users authenticated
+        from the token cache carry the values they had when cached.
+        """
+        key = library_cache_key(user_id)
+        state = cache.get(key)
+        if state is None:
+            state = self.filter(pk=user_id).values_list(
+                'library_version', 'library_modified').get()
+            cache.add(key, state, settings.LIBRARY_STATE_CACHE_TIMEOUT)
+
+        return state
+
+    def forget_library_state(self, user_id):
+        """Drop the cached library state now and once the change commits.
+
+        The second delete discards a state cached from a read that raced
+        with the uncommitted change.
+        """
+        key = library_cache_key(user_id)
+        cache.delete(key)
+        transaction.on_commit(lambda: cache.delete(key))
+
     def create_superuser(self, email, password):
         """Create, save and return a new superuser"""
         user = self.create_user(email, password)
@@ -68,6 +203,61 @@ class UserManager(BaseUserManager):
         return user
 
 
+class AccountTypeManager(models.Manager):
+    """Manager for account types with a process-level row cache."""
+
+    _cache = {}
+
+    def get_cached(self, pk):
+        """Return account type by pk, cached for ACCOUNT_TYPE_CACHE_TIMEOUT.
+
+        Entries are dropped whenever an account type is saved or deleted
+        in this process; the timeout bounds staleness in other processes.
+        """
+        entry = self._cache.get(pk)
+        if entry is None or entry[1] < time.monotonic():
+            entry = self.remember(self.get(pk=pk))
+
+        return entry[0]
+
+    def remember(self, account_type):
+        """Put an account type loaded elsewhere in the row cache."""
+        entry = (
+            account_type,
+            time.monotonic() + settings.ACCOUNT_TYPE_CACHE_TIMEOUT,
+        )
+        self._cache[account_type.pk] = entry
+
+        return entry
+
+    def for_user(self, user):
+        """Return user's account type, resolving it once per user object.
+
+        An account type loaded with the user (select_related) is reused,
+        otherwise it comes from the row cache and is attached to the user.
+        Users cached before their account type was deleted get None, as
+        the database gives them.
+        """
+        if User.account_type.is_cached(user):
+            return user.account_type
+        if user.account_type_id is None:
+            return None
+
+        try:
+            user.account_type = self.get_cached(user.account_type_id)
+        except self.model.DoesNotExist:
+            user.account_type = None
+
+        return user.account_type
+
+    def clear_cache(self, pk=None):
+        """Drop one or all cached account types."""
+        if pk is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(pk, None)
+
+
 class AccountType(models.Model):
     """Account Type object."""
     title = models.CharField(max_length=50, unique=True)
@@ -79,11 +269,53 @@ class AccountType(models.Model):
     thumb_size2 = models.IntegerField(blank=True, null=True)
     link_to_original = models.BooleanField(default=False)
     link_to_binary = models.BooleanField(default=False)
+    jpeg_quality = models.PositiveSmallIntegerField(
+        default=75,
+        validators=[MinValueValidator(1), MaxValueValidator(95)],
+    )
+    jpeg_progressive = models.BooleanField(default=False)
+    png_optimize = models.BooleanField(default=False)
+    png_compress_level = models.PositiveSmallIntegerField(
+        default=6,
+        validators=[MaxValueValidator(9)],
+    )
+    png_quantize_colors = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True,
+        validators=[MinValueValidator(2), MaxValueValidator(256)],
+    )
+    keep_exif = models.BooleanField(default=False)
+    max_pixels = models.PositiveIntegerField(blank=True, null=True)
+    max_dimension = models.PositiveIntegerField(blank=True, null=True)
+
+    objects = AccountTypeManager()
+
+    @property
+    def pixel_limit(self):
+        """Return the most pixels an upload may have (IMAGE_MAX_PIXELS)."""
+        if self.max_pixels:
+            return min(self.max_pixels, settings.IMAGE_MAX_PIXELS)
+
+        return settings.IMAGE_MAX_PIXELS
+
+    @property
+    def max_thumb_size(self):
+        """Return the largest thumbnail height allowed, or None."""
+        sizes = [
+            size for size in (self.thumb_size1, self.thumb_size2) if size]
+
+        return max(sizes, default=None)
 
     def __str__(self):
         return self.title
 
 
+@receiver([post_save, post_delete], sender=AccountType)
+def clear_account_type_cache(sender, instance, **kwargs):
+    """Invalidate cached account type when it changes."""
+    AccountType.objects.clear_cache(instance.pk)
+
+
 class User(AbstractBaseUser, PermissionsMixin):
     """User in the system."""
     account_type = models.ForeignKey(
@@ -98,22 +330,147 @@ class User(AbstractBaseUser, PermissionsMixin):
     name = models.CharField(max_length=255)
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
+    """Bumped whenever the user's images change; used for ETags."""
+    library_version = models.PositiveBigIntegerField(default=0)
+    library_modified = models.DateTimeField(default=timezone.now)
 
     objects = UserManager()
 
     USERNAME_FIELD = 'email'
 
 
+@receiver(post_save, sender=User)
+def forget_user_tokens(sender, instance, created, **kwargs):
+    """Drop cached copies of a user that changes, e.g. is deactivated."""
+    User.objects.forget_library_state(instance.pk)
+    if not created:
+        authentication.forget_tokens(
+            Token.objects.filter(
+                user=instance).values_list('key', flat=True))
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    """Drop the cached user of a deleted token."""
+    authentication.forget_tokens([instance.key])
+
+
+class BlobManager(models.Manager):
+    """Manager for deduplicated original files."""
+
+    def acquire(self, file):
+        """Return the blob holding file's content with one more reference.
+
+        The content is written to storage only when no upload with the
+        same SHA-256 exists yet; if the caller's transaction then rolls
+        back, log_rolled_back_files() hands the file to the GC. Files of
+        a deleted blob with the same content that are still waiting for
+        the garbage collector are taken back first (waiting for a drain
+        holding them to finish).
+        """
+        sha256 = file_sha256(file)
+        with transaction.atomic():
+            blob, created = self.select_for_update().get_or_create(
+                sha256=sha256,
+                defaults={'size': file.size},
+            )
+            if created:
+                blob.file.name = blob_file_path(blob, file.name)
+                PendingDeletion.objects.filter(
+                    name__in=blob.stored_names()).delete()
+                name = blob.file.name
+                if not default_storage.exists(name):
+                    name = default_storage.save(name, file)
+                    track_stored_file(name)
+                blob.file.name = name
+                blob.save(update_fields=['file'])
+            self.filter(pk=blob.pk).update(
+                ref_count=models.F('ref_count') + 1)
+
+        return blob
+
+    def release(self, pk):
+        """Drop one reference and delete the blob when none are left.
+
+        The original and the directories of all derivatives made from it
+        are handed to the garbage collector.
+        """
+        with transaction.atomic():
+            blob = self.select_for_update().filter(pk=pk).first()
+            if blob is None:
+                return
+            blob.ref_count -= 1
+            if blob.ref_count > 0:
+                blob.save(update_fields=['ref_count'])
+                return
+            blob.delete()
+            PendingDeletion.objects.log(blob.stored_names())
+
+
+class Blob(models.Model):
+    """Original image file shared by every identical upload."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.ImageField(upload_to=blob_file_path, db_index=True)
+    size = models.BigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+
+    objects = BlobManager()
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.file.name)[1].lower()
+
+    def thumb_name(self, size, profile=None):
+        """Return storage name of a thumbnail of this blob."""
+        key = thumbnails.profile_key(profile)
+        return sharded_path(
+            'thumbs', self.sha256, self.sha256,
+            f'{size}_{key}{self.extension}')
+
+    def binary_name(self, profile=None):
+        """Return storage name of a binary derivative of this blob."""
+        key = thumbnails.profile_key(profile)
+        return sharded_path(
+            'binary', self.sha256, self.sha256, f'{key}{self.extension}')
+
+    def stored_names(self):
+        """Return the original and its derivative directories (ending /)."""
+        return [
+            self.file.name,
+            os.path.dirname(self.thumb_name(0)) + '/',
+            os.path.dirname(self.binary_name()) + '/',
+        ]
+
+    def __str__(self):
+        return self.sha256
+
+
 class Image(models.Model):
     """Image object."""
+
+    class Status(models.TextChoices):
+        """Thumbnail processing status."""
+        PENDING = 'pending'
+        PROCESSING = 'processing'
+        READY = 'ready'
+        FAILED = 'failed'
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         related_name='images',
         on_delete=models.CASCADE,
     )
     title = models.CharField(max_length=255)
+    blob = models.ForeignKey(
+        Blob,
+        related_name='images',
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+    )
     image = models.ImageField(
         null=True, blank=False,
+        db_index=True,
         upload_to=image_file_path,
         validators=[
             FileExtensionValidator(allowed_extensions=['png', 'jpeg', 'jpg'])
@@ -122,83 +479,322 @@ class Image(models.Model):
     thumbnail_size1 = models.ImageField(
         null=True,
         blank=True,
+        db_index=True,
         upload_to=thumb_file_path
         )
     thumbnail_size2 = models.ImageField(
         null=True,
         blank=True,
+        db_index=True,
         upload_to=thumb_file_path
         )
+    binary_image = models.ImageField(
+        null=True,
+        blank=True,
+        db_index=True,
+        upload_to=binary_file_path
+        )
+    status = models.CharField(
+        max_length=10,
+        choices=Status.choices,
+        default=Status.PENDING,
+        )
+    status_changed_at = models.DateTimeField(default=timezone.now)
+    # Read from the header of the original when it is stored.
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    format = models.CharField(max_length=10, blank=True)
+    file_size = models.BigIntegerField(null=True, blank=True)
+    orientation = models.PositiveSmallIntegerField(null=True, blank=True)
+    thumbnail_size1_width = models.PositiveIntegerField(null=True, blank=True)
+    thumbnail_size1_height = models.PositiveIntegerField(
+        null=True, blank=True)
+    thumbnail_size2_width = models.PositiveIntegerField(null=True, blank=True)
+    thumbnail_size2_height = models.PositiveIntegerField(
+        null=True, blank=True)
+
+    # Fields set by make_thumbnail().
+    THUMBNAIL_FIELDS = (
+        'thumbnail_size1',
+        'thumbnail_size1_width',
+        'thumbnail_size1_height',
+        'thumbnail_size2',
+        'thumbnail_size2_width',
+        'thumbnail_size2_height',
+    )
 
-    def save(self, *args, **kwargs):
-        """Save instance."""
-
-        if not self.make_thumbnail():
-            """Set to a default thumbnail."""
-            raise Exception(
-                'Could not create thumbnail - is the file type valid?')
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['user', '-id'],
+                name='image_user_id_desc_idx',
+            ),
+        ]
 
-        super(Image, self).save(*args, **kwargs)
+    def save(self, *args, **kwargs):
+        """Save instance.
+
+        A new upload is stored as (or pointed at) the blob with the same
+        content. Thumbnails are generated only when the image is first
+        created: in place when THUMBNAILS_ASYNC is off, otherwise by a
+        Celery task queued once the row has been committed. A stored
+        original whose row is rolled back is logged for deletion.
+        """
+        adding = self._state.adding
+        try:
+            with transaction.atomic():
+                if adding and self.image and not self.image._committed:
+                    if self.width is None:
+                        self.set_metadata(metadata.read_header(self.image))
+                    with metrics.span('upload', 'store'):
+                        self.blob = Blob.objects.acquire(self.image)
+                    self.image = self.blob.file.name
+
+                if adding and not settings.THUMBNAILS_ASYNC:
+                    if not self.make_thumbnail():
+                        raise executor.ImageRejected(
+                            'Could not create thumbnail - '
+                            'is the file type valid?')
+                    self.status = self.Status.READY
+
+                with metrics.span('upload' if adding else 'image', 'db'):
+                    super(Image, self).save(*args, **kwargs)
+                    if adding:
+                        User.objects.touch_library(self.user_id)
+        finally:
+            if adding:
+                log_rolled_back_files()
+
+        if adding and settings.THUMBNAILS_ASYNC:
+            from images import processing
+            processing.queue_thumbnails([self.pk])
+
+    def set_metadata(self, fields):
+        """Set the metadata fields of the original from read_header()."""
+        for field_name, value in fields.items():
+            setattr(self, field_name, value)
+
+    def set_thumbnail_dimensions(self, thumb_sizes):
+        """Set the dimensions of thumbnails fitting the given box sizes.
+
+        They are computed from the original's dimensions the way
+        thumbnails are rendered, so no thumbnail file is read.
+        """
+        for field_name in ('thumbnail_size1', 'thumbnail_size2'):
+            size = thumb_sizes.get(field_name)
+            width = height = None
+            if size is not None and self.width and self.height:
+                width, height = thumbnails.fit_size(
+                    (self.width, self.height), size)
+            setattr(self, f'{field_name}_width', width)
+            setattr(self, f'{field_name}_height', height)
 
     def make_thumbnail(self):
-        """Generate a thumbnail from a photo."""
+        """Generate thumbnails from a photo."""
+        account_type = AccountType.objects.for_user(self.user)
         thumb_sizes = {}
-        t1 = AccountType.objects.filter(users=self.user)[0].thumb_size1
-        t2 = AccountType.objects.filter(users=self.user)[0].thumb_size2
-        if t1 is not None:
-            thumb_sizes['thumb1'] = t1
-        if t2 is not None:
-            thumb_sizes['thumb2'] = t2
-
-        for thumb_no in thumb_sizes.keys():
-            size = thumb_sizes[thumb_no]
-            img = Img.open(self.image)
-            img.thumbnail((size, size), Img.ANTIALIAS)
-
-            thumb_name, thumb_extension = os.path.splitext(self.image.name)
-            thumb_extension = thumb_extension.lower()
-
-            thumb_filename = thumb_name + '_thumb' + thumb_extension
-
-            if thumb_extension in ['.jpg', '.jpeg']:
-                FTYPE = 'JPEG'
-            elif thumb_extension == '.png':
-                FTYPE = 'PNG'
-            else:
-                return False
-
-            """Save thumbnail to in-memory file as StringIO"""
-            temp_thumb = BytesIO()
-            img.save(temp_thumb, FTYPE)
-            temp_thumb.seek(0)
-
-            if thumb_no == 'thumb1':
-                self.thumbnail_size1.save(
-                    thumb_filename,
-                    ContentFile(temp_thumb.read()),
-                    save=False)
-            if thumb_no == 'thumb2':
-                self.thumbnail_size2.save(
+        if account_type.thumb_size1 is not None:
+            thumb_sizes['thumbnail_size1'] = account_type.thumb_size1
+        if account_type.thumb_size2 is not None:
+            thumb_sizes['thumbnail_size2'] = account_type.thumb_size2
+
+        FTYPE = thumbnails.image_format(self.image.name)
+        if FTYPE is None:
+            return False
+        self.set_thumbnail_dimensions(thumb_sizes)
+
+        """Thumbnails of a blob are shared by all images using it."""
+        if self.blob_id:
+            for field_name, size in list(thumb_sizes.items()):
+                name = self.blob.thumb_name(size, account_type)
+                if default_storage.exists(name):
+                    getattr(self, field_name).name = name
+                    del thumb_sizes[field_name]
+        if not thumb_sizes:
+            return True
+
+        rendered = executor.render_thumbnails(
+            self.image, thumb_sizes.values(), FTYPE, account_type)
+
+        thumb_name, thumb_extension = os.path.splitext(self.image.name)
+        thumb_filename = thumb_name + '_thumb' + thumb_extension.lower()
+
+        with metrics.span('thumbnail', 'store'):
+            for field_name, size in thumb_sizes.items():
+                thumb = getattr(self, field_name)
+                if self.blob_id:
+                    thumb.name = default_storage.save(
+                        self.blob.thumb_name(size, account_type),
+                        ContentFile(rendered[size]))
+                    continue
+                """Drop files left by a previous run so retries don't
+                pile up."""
+                if thumb:
+                    thumb.delete(save=False)
+                thumb.save(
                     thumb_filename,
-                    ContentFile(temp_thumb.read()),
+                    ContentFile(rendered[size]),
                     save=False)
-            temp_thumb.close()
 
         return True
 
+    def make_binary_image(self):
+        """Return the 1-bit derivative, generating it on first use.
+
+        The file is named after the SHA-256 of the blob (or of its own
+        content for images stored before deduplication) and shared by
+        every link to this image, so creating a link copies nothing.
+        """
+        if self.binary_image:
+            return self.binary_image
+
+        with transaction.atomic():
+            with metrics.span('binary', 'db'):
+                image = Image.objects.select_for_update().get(pk=self.pk)
+            if not image.binary_image:
+                account_type = AccountType.objects.for_user(self.user)
+                name = None
+                if self.blob_id:
+                    name = self.blob.binary_name(account_type)
+                if name is None or not default_storage.exists(name):
+                    FTYPE = thumbnails.image_format(self.image.name)
+                    data = executor.render_binary(
+                        self.image, FTYPE, account_type)
+                    ext = os.path.splitext(self.image.name)[1].lower()
+                    digest = hashlib.sha256(data).hexdigest()
+                    name = name or sharded_path(
+                        'binary', digest, f'{digest}{ext}')
+                with metrics.span('binary', 'store'):
+                    if not default_storage.exists(name):
+                        name = default_storage.save(name, ContentFile(data))
+                image.binary_image.name = name
+                with metrics.span('binary', 'db'):
+                    Image.objects.filter(pk=self.pk).update(
+                        binary_image=name)
+
+        self.binary_image.name = image.binary_image.name
+
+        return self.binary_image
+
     def __str__(self):
         return self.title
 
 
+@receiver(pre_delete, sender=Image)
+def log_image_link_files(sender, instance, **kwargs):
+    """Hand binary files of the links deleted with an image to the GC."""
+    PendingDeletion.objects.log(
+        instance.links.exclude(binary_image='').exclude(
+            binary_image=None).values_list('binary_image', flat=True))
+
+
+@receiver(post_delete, sender=Image)
+def release_image_blob(sender, instance, **kwargs):
+    """Drop the deleted image's reference to its blob.
+
+    Files of images stored before deduplication belong to the image
+    alone and are handed to the garbage collector.
+    """
+    if instance.blob_id:
+        Blob.objects.release(instance.blob_id)
+    else:
+        PendingDeletion.objects.log([
+            instance.image.name,
+            instance.thumbnail_size1.name,
+            instance.thumbnail_size2.name,
+            instance.binary_image.name,
+        ])
+
+
+@receiver(post_delete, sender=Image)
+def touch_image_library(sender, instance, **kwargs):
+    """Invalidate the ETags of the deleted image's owner."""
+    User.objects.touch_library(instance.user_id)
+
+
+class UploadSession(models.Model):
+    """Resumable upload of an image original in chunks."""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name='upload_sessions',
+        on_delete=models.CASCADE,
+    )
+    title = models.CharField(max_length=255)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    checksum = models.CharField(max_length=64)
+    offset = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def path(self):
+        """Path of the file the chunks are written to."""
+        return os.path.join(settings.UPLOAD_SESSION_ROOT, f'{self.id}.part')
+
+    def __str__(self):
+        return self.filename
+
+
+class PendingDeletionManager(models.Manager):
+    """Manager for the garbage collector's log."""
+
+    def log(self, names):
+        """Record stored names (or directories, ending in /) to delete.
+
+        Called in the transaction deleting the rows using them, so
+        nothing is logged when it rolls back. The files are deleted by
+        images.gc.drain() unless they are referenced again by then.
+        """
+        self.bulk_create([self.model(name=name) for name in names if name])
+
+
+class PendingDeletion(models.Model):
+    """Stored file or directory waiting for the garbage collector."""
+    name = models.CharField(max_length=255, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = PendingDeletionManager()
+
+    def __str__(self):
+        return self.name
+
+
+class CommandCheckpoint(models.Model):
+    """Progress of a resumable management command run."""
+    scope = models.CharField(max_length=255, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.scope
+
+
+class MediaMove(models.Model):
+    """Journal entry of a stored file moved by shard_media."""
+    old_name = models.CharField(max_length=255, unique=True)
+    new_name = models.CharField(max_length=255, db_index=True)
+
+    def __str__(self):
+        return f'{self.old_name} -> {self.new_name}'
+
+
 class BinaryImageLink(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         related_name='links',
         on_delete=models.CASCADE,
     )
+    image = models.ForeignKey(
+        Image,
+        related_name='links',
+        on_delete=models.CASCADE,
+        null=True,
+    )
     binary_image = models.ImageField(
         null=True,
         blank=True,
+        db_index=True,
         upload_to=binary_file_path
         )
     expiring_time = models.IntegerField(
@@ -208,14 +804,22 @@ class BinaryImageLink(models.Model):
         editable=False,
         default=datetime.datetime.now()
         )
-    expiration_date = models.DateTimeField(default=None)
+    expiration_date = models.DateTimeField(default=None, db_index=True)
 
     def save(self, *args, **kwargs):
-        """Save instance."""
+        """Save instance.
+
+        A new link schedules its own deletion at its expiration date.
+        """
+        from images import links
+
+        adding = self._state.adding
         if self.expiration_date is None:
             self.expiration_date = datetime.datetime.now() + datetime.timedelta(
                 seconds=self.expiring_time)
         super(BinaryImageLink, self).save(*args, **kwargs)
+        if adding:
+            links.schedule_expiry(self)
 
     def __str__(self):
         return self.binary_image
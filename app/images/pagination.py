@@ -0,0 +1,22 @@
+"""
+Pagination for images app.
+"""
+from django.conf import settings
+
+from rest_framework.pagination import CursorPagination
+
+
+class ImageCursorPagination(CursorPagination):
+    """Keyset pagination over the newest images first.
+
+    Pages are fetched with `id < <cursor>` on the (user, -id) index, so
+    every page costs the same no matter how deep into the library it is.
+    """
+    ordering = '-id'
+    page_size_query_param = 'page_size'
+
+    def get_page_size(self, request):
+        self.page_size = settings.IMAGES_PAGE_SIZE
+        self.max_page_size = settings.IMAGES_MAX_PAGE_SIZE
+
+        return super().get_page_size(request)
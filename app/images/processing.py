@@ -0,0 +1,61 @@
+"""
+Queueing of thumbnail generation for images stored without thumbnails.
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from images.models import Image
+
+
+logger = logging.getLogger(__name__)
+
+
+def stalled_before():
+    """Return when images still pending or processing stalled."""
+    return timezone.now() - datetime.timedelta(
+        seconds=settings.THUMBNAIL_STALLED_AFTER)
+
+
+def queue_thumbnails(image_ids):
+    """Queue thumbnail generation of images once they are committed.
+
+    Images whose task can't be sent because the broker is down stay
+    pending, and are queued again by requeue_stalled().
+    """
+    from app.tasks import generate_thumbnails_task
+
+    image_ids = list(image_ids)
+
+    def send():
+        try:
+            for image_id in image_ids:
+                generate_thumbnails_task.delay(image_id)
+        except Exception as err:
+            logger.warning(
+                'Could not queue thumbnails of images %s: %s',
+                image_ids, err)
+
+    transaction.on_commit(send)
+
+
+def requeue_stalled():
+    """Queue thumbnails of images pending or processing for too long.
+
+    Their task was lost: it couldn't be sent, or its worker died while
+    rendering. They are reset to pending so the new task takes them.
+    Returns the number of images queued.
+    """
+    with transaction.atomic():
+        image_ids = list(Image.objects.select_for_update().filter(
+            status__in=[Image.Status.PENDING, Image.Status.PROCESSING],
+            status_changed_at__lt=stalled_before(),
+        ).values_list('id', flat=True))
+        Image.objects.filter(id__in=image_ids).update(
+            status=Image.Status.PENDING, status_changed_at=timezone.now())
+        queue_thumbnails(image_ids)
+
+    return len(image_ids)
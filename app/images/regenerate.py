@@ -0,0 +1,125 @@
+"""
+Regeneration of thumbnails left at sizes of an old account type.
+"""
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from PIL import Image as Img
+
+from images import thumbnails
+from images.models import AccountType, Image, PendingDeletion, User
+
+
+THUMB_FIELDS = ('thumbnail_size1', 'thumbnail_size2')
+
+
+def expected_sizes(account_type):
+    """Return the size each thumbnail field should have (or None)."""
+    return {
+        'thumbnail_size1': account_type.thumb_size1,
+        'thumbnail_size2': account_type.thumb_size2,
+    }
+
+
+def header_size(name):
+    """Return dimensions of a stored image read from its header."""
+    with default_storage.open(name, 'rb') as file, Img.open(file) as img:
+        return img.size
+
+
+def stored_size(image, field_name):
+    """Return dimensions of image's file in field_name kept on the row."""
+    prefix = '' if field_name == 'image' else f'{field_name}_'
+    width = getattr(image, f'{prefix}width')
+    height = getattr(image, f'{prefix}height')
+    if width and height:
+        return width, height
+
+    return None
+
+
+def is_stale(image, account_type):
+    """Return whether image's thumbnails don't match account_type.
+
+    Blob thumbnails are named after their size and encoder profile, so
+    they are checked by name. Thumbnails of images stored before
+    deduplication are compared by dimensions, taken from the row or, for
+    rows without them, read from the headers.
+    """
+    if thumbnails.image_format(image.image.name) is None:
+        return False
+
+    original_size = stored_size(image, 'image')
+    for field_name, size in expected_sizes(account_type).items():
+        thumb = getattr(image, field_name)
+        if not thumb or size is None:
+            if bool(thumb) != (size is not None):
+                return True
+            continue
+        if image.blob_id:
+            if thumb.name != image.blob.thumb_name(size, account_type):
+                return True
+            continue
+
+        try:
+            if original_size is None:
+                original_size = header_size(image.image.name)
+        except OSError:
+            return False
+        try:
+            thumb_size = (stored_size(image, field_name)
+                          or header_size(thumb.name))
+            if thumb_size != thumbnails.fit_size(original_size, size):
+                return True
+        except OSError:
+            return True
+
+    return False
+
+
+def regenerate(image_id):
+    """Render the thumbnails of an image again if they are stale.
+
+    The thumbnails are rendered without holding a lock, and the new names
+    are saved in a short transaction unless the image changed meanwhile.
+    Replaced files are handed to the garbage collector, which keeps those
+    still in use (blob thumbnails are shared). Returns whether the image
+    was regenerated.
+    """
+    image = Image.objects.select_related('blob', 'user').filter(
+        pk=image_id, status=Image.Status.READY).first()
+    if image is None:
+        return False
+    account_type = AccountType.objects.for_user(image.user)
+    if account_type is None or not is_stale(image, account_type):
+        return False
+
+    old_names = {
+        field_name: getattr(image, field_name).name or ''
+        for field_name in THUMB_FIELDS
+    }
+    for field_name in THUMB_FIELDS:
+        setattr(image, field_name, None)
+    if not image.make_thumbnail():
+        return False
+    new_names = {
+        field_name: getattr(image, field_name).name or ''
+        for field_name in THUMB_FIELDS
+    }
+
+    with transaction.atomic():
+        current = Image.objects.select_for_update().filter(
+            pk=image_id, status=Image.Status.READY).first()
+        if current is None or any(
+                (getattr(current, field_name).name or '') != name
+                for field_name, name in old_names.items()):
+            # Changed while rendering, so the new files are unused.
+            PendingDeletion.objects.log(sorted(
+                set(new_names.values()) - set(old_names.values())))
+            return False
+        image.save(update_fields=Image.THUMBNAIL_FIELDS)
+        User.objects.touch_library(image.user_id)
+        PendingDeletion.objects.log(sorted(
+            set(old_names.values()) - set(new_names.values())))
+
+    return True
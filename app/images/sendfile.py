@@ -0,0 +1,130 @@
+"""
+File responses offloaded to the web server when configured.
+"""
+import mimetypes
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseNotModified,
+    StreamingHttpResponse,
+)
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def sendfile_response(name, request=None):
+    """Return a response sending the stored file name.
+
+    With SENDFILE_BACKEND set to 'nginx' (X-Accel-Redirect) or 'apache'
+    (X-Sendfile) Django only sets a header and the web server transfers
+    the bytes, handling ranges and conditional requests itself.
+    Otherwise the file is streamed by file_response().
+    """
+    backend = settings.SENDFILE_BACKEND
+    if backend == 'nginx':
+        content_type = mimetypes.guess_type(name)[0]
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = quote(
+            settings.SENDFILE_URL_PREFIX + name)
+    elif backend == 'apache':
+        content_type = mimetypes.guess_type(name)[0]
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = default_storage.path(name)
+    else:
+        response = file_response(name, request)
+
+    return response
+
+
+def parse_range(header, size):
+    """Return (start, end) of a single byte range header, both inclusive.
+
+    Returns None when there is no usable range (the whole file is sent)
+    and False when the range can't be satisfied.
+    """
+    match = RANGE.match(header or '')
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return False
+
+    return start, end
+
+
+def read_range(file, length):
+    """Yield length bytes of file from its current position, then close it."""
+    try:
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def file_response(name, request=None):
+    """Stream the stored file name from Django.
+
+    Honours If-Modified-Since and a single-range Range header (with
+    If-Range) of request. Whole files go out as a FileResponse, which WSGI
+    servers like gunicorn send with os.sendfile() through
+    wsgi.file_wrapper.
+    """
+    try:
+        size = default_storage.size(name)
+        mtime = default_storage.get_modified_time(name).timestamp()
+    except FileNotFoundError:
+        raise Http404('File does not exist.')
+    meta = request.META if request is not None else {}
+
+    if not was_modified_since(meta.get('HTTP_IF_MODIFIED_SINCE'), mtime):
+        return HttpResponseNotModified()
+
+    byte_range = None
+    if meta.get('HTTP_IF_RANGE', http_date(mtime)) == http_date(mtime):
+        byte_range = parse_range(meta.get('HTTP_RANGE'), size)
+    content_type = (
+        mimetypes.guess_type(name)[0] or 'application/octet-stream')
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif byte_range is None:
+        response = FileResponse(
+            default_storage.open(name, 'rb'), content_type=content_type)
+        # Used when the server can't sendfile() and iterates instead.
+        response.block_size = CHUNK_SIZE
+    else:
+        start, end = byte_range
+        file = default_storage.open(name, 'rb')
+        file.seek(start)
+        response = StreamingHttpResponse(
+            read_range(file, end - start + 1),
+            status=206,
+            content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    response['Last-Modified'] = http_date(mtime)
+
+    return response
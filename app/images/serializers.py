@@ -1,9 +1,16 @@
 """
 Serializers for images app.
 """
+import re
+
+from django.conf import settings
+
 from rest_framework import serializers
 
-from images.models import Image, AccountType, BinaryImageLink
+from images import metadata
+from images.executor import ImageRejected
+from images.models import Image, AccountType, BinaryImageLink, UploadSession
+from images.thumbnails import image_format
 
 
 class BinaryImageLinkSerializer(serializers.ModelSerializer):
@@ -24,17 +31,131 @@ class BinaryImageLinkSerializer(serializers.ModelSerializer):
 
 
 class ImageSerializer(serializers.ModelSerializer):
+    # Checked by validate_image() from the header, instead of the full
+    # Pillow verify() pass of serializers.ImageField.
+    image = serializers.FileField()
+
     class Meta:
         model = Image
-        fields = ['id', 'title', 'image', 'thumbnail_size1', 'thumbnail_size2']
-        read_only_fields = ['id', 'thumbnail_size1', 'thumbnail_size2']
-        extra_kwargs = {'image': {'required': 'True'}}
+        fields = [
+            'id',
+            'title',
+            'image',
+            'thumbnail_size1',
+            'thumbnail_size2',
+            'status',
+            'width',
+            'height',
+            'format',
+            'file_size',
+            'orientation',
+            'thumbnail_size1_width',
+            'thumbnail_size1_height',
+            'thumbnail_size2_width',
+            'thumbnail_size2_height',
+        ]
+        read_only_fields = [
+            'id',
+            'thumbnail_size1',
+            'thumbnail_size2',
+            'status',
+            'width',
+            'height',
+            'format',
+            'file_size',
+            'orientation',
+            'thumbnail_size1_width',
+            'thumbnail_size1_height',
+            'thumbnail_size2_width',
+            'thumbnail_size2_height',
+        ]
+
+    def validate_image(self, value):
+        """Check the upload from its magic bytes and header alone.
+
+        The format and the dimensions are checked against the limits of
+        the user's account type before anything is decoded or stored.
+        The metadata read from the header is kept for create().
+        """
+        ftype = image_format(value.name)
+        if ftype is None:
+            raise serializers.ValidationError(
+                'Only .png, .jpg and .jpeg files can be uploaded.')
+        account_type = AccountType.objects.for_user(
+            self.context['request'].user)
+        try:
+            header = metadata.check_upload(value, ftype, account_type)
+        except ImageRejected as err:
+            raise serializers.ValidationError(str(err))
+        self.header = header
+
+        return value
+
+    def create(self, validated_data):
+        """Create image, turning images over the limits into 400s."""
+        validated_data.update(getattr(self, 'header', {}))
+        try:
+            return super().create(validated_data)
+        except ImageRejected as err:
+            raise serializers.ValidationError({'image': [str(err)]})
 
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        check = AccountType.objects.filter(users=self.context['request'].user)
-        if check[0].link_to_original is False:
+        account_type = AccountType.objects.for_user(
+            self.context['request'].user)
+        if account_type.link_to_original is False:
             data.pop('image', None)
-        if check[0].thumb_size2 is None:
+        if account_type.thumb_size2 is None:
             data.pop('thumbnail_size2', None)
+            data.pop('thumbnail_size2_width', None)
+            data.pop('thumbnail_size2_height', None)
         return data
+
+
+class BatchUploadSerializer(serializers.Serializer):
+    """Serializer for uploading many images or a ZIP archive of them."""
+    images = serializers.ListField(
+        child=serializers.FileField(), required=False)
+    archive = serializers.FileField(required=False)
+
+    def validate(self, data):
+        """Check that files or an archive were sent."""
+        if not data.get('images') and not data.get('archive'):
+            raise serializers.ValidationError(
+                'Send image files as "images" or a ZIP file as "archive".')
+        return data
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'title', 'filename', 'size', 'checksum', 'offset']
+        read_only_fields = ['id', 'offset']
+
+    def validate_filename(self, value):
+        """Check the file has an image extension."""
+        if image_format(value) is None:
+            raise serializers.ValidationError(
+                'Only .png, .jpg and .jpeg files can be uploaded.')
+        return value
+
+    def validate_size(self, value):
+        """Check the upload isn't empty or above the size limits.
+
+        Both UPLOAD_SESSION_MAX_BYTES and IMAGE_MAX_BYTES apply, so no
+        upload is accepted that finalize would reject.
+        """
+        max_bytes = min(
+            settings.UPLOAD_SESSION_MAX_BYTES, settings.IMAGE_MAX_BYTES)
+        if value <= 0 or value > max_bytes:
+            raise serializers.ValidationError(
+                f'Size should be between 1 and {max_bytes} bytes.')
+        return value
+
+    def validate_checksum(self, value):
+        """Check the checksum is a SHA-256 hex digest."""
+        value = value.lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', value):
+            raise serializers.ValidationError(
+                'Checksum should be a SHA-256 hex digest.')
+        return value
@@ -0,0 +1,37 @@
+"""
+Stateless signed links to binary images.
+"""
+import time
+
+from django.core import signing
+
+
+SALT = 'images.signed-link'
+
+
+def make_token(image, expiring_time):
+    """Return a signed token for image's binary file valid expiring_time."""
+    return signing.dumps(
+        {
+            'i': image.id,
+            'p': image.binary_image.name,
+            'e': int(time.time()) + expiring_time,
+        },
+        salt=SALT,
+        compress=True,
+    )
+
+
+def read_token(token):
+    """Return binary file name of a valid token or None.
+
+    Tokens with a bad signature or past their expiry are rejected.
+    """
+    try:
+        payload = signing.loads(token, salt=SALT)
+    except signing.BadSignature:
+        return None
+    if payload['e'] < time.time():
+        return None
+
+    return payload['p']
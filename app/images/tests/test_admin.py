@@ -2,11 +2,15 @@
 Test for Django admin modifications.
 """
 
+from unittest.mock import patch
+
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.test import Client
 
+from images.models import AccountType
+
 
 class AdminSiteTests(TestCase):
     """Tests for Django admin."""
@@ -46,3 +50,29 @@ class AdminSiteTests(TestCase):
         res = self.client.get(url)
 
         self.assertEqual(res.status_code, 200)
+
+    def test_edit_account_type_page(self):
+        """Test the edit account type page shows encoder settings."""
+        account_type = AccountType.objects.create(
+            title='Basic', is_basic=True, thumb_size1=200)
+        url = reverse(
+            'admin:images_accounttype_change', args=[account_type.id])
+        res = self.client.get(url)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertContains(res, 'jpeg_quality')
+
+    @patch('app.tasks.regenerate_thumbnails_command_task.delay')
+    def test_regenerate_thumbnails_action(self, patched_delay):
+        """Test the account type action queues thumbnail regeneration."""
+        account_type = AccountType.objects.create(
+            title='Basic', is_basic=True, thumb_size1=200)
+        url = reverse('admin:images_accounttype_changelist')
+
+        res = self.client.post(url, {
+            'action': 'regenerate_thumbnails',
+            '_selected_action': [account_type.id],
+        })
+
+        self.assertEqual(res.status_code, 302)
+        patched_delay.assert_called_once_with(account_types=[account_type.id])
@@ -1,13 +1,37 @@
 """
 Test custom Django management commands.
 """
+import tempfile
+from io import BytesIO, StringIO
 from unittest.mock import patch
 
+from celery.exceptions import SoftTimeLimitExceeded
 from psycopg2 import OperationalError as Psycopg2OpError
 
+from PIL import Image as Img
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
 from django.core.management import call_command
+from django.db import connection
 from django.db.utils import OperationalError
-from django.test import SimpleTestCase
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from app.tasks import regenerate_thumbnails_task
+from images.management.commands.shard_media import rename_rows
+from images.models import (
+    AccountType,
+    BinaryImageLink,
+    Blob,
+    CommandCheckpoint,
+    Image,
+    MediaMove,
+    PendingDeletion,
+    sharded_name,
+)
+from images import gc, signing
 
 
 @patch('images.management.commands.wait_for_db.Command.check')
@@ -32,3 +56,521 @@ class CommandTests(SimpleTestCase):
 
         self.assertEqual(patched_check.call_count, 6)
         patched_check.assert_called_with(databases=['default'])
+
+
+class DedupeImagesCommandTests(TestCase):
+    """Test moving originals into deduplicated blobs."""
+
+    def setUp(self):
+        account_type = AccountType.objects.create(
+            title='Basic', is_basic=True, thumb_size1=200)
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='pass123',
+            account_type=account_type,
+        )
+        content = BytesIO()
+        Img.new('RGB', (10, 10)).save(content, 'PNG')
+        self.content = content.getvalue()
+
+    def create_legacy_image(self):
+        """Create an image stored under its own UUID file name."""
+        name = default_storage.save(
+            'uploads/images/legacy.png', ContentFile(self.content))
+        return Image.objects.bulk_create([
+            Image(user=self.user, title='sample', image=name),
+        ])[0]
+
+    def test_dedupe_images_shares_identical_originals(self):
+        """Test identical legacy originals end up in one blob."""
+        images = [self.create_legacy_image() for _ in range(2)]
+        old_names = [image.image.name for image in images]
+
+        call_command('dedupe_images', stdout=StringIO())
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        for image in images:
+            image.refresh_from_db()
+            self.assertEqual(image.blob, blob)
+            self.assertEqual(image.image.name, blob.file.name)
+        for name in old_names:
+            self.assertFalse(default_storage.exists(name))
+        self.assertEqual(blob.file.read(), self.content)
+
+
+@patch('app.tasks.regenerate_thumbnails_task.delay',
+       side_effect=regenerate_thumbnails_task)
+class RegenerateThumbnailsCommandTests(TestCase):
+    """Test regenerating thumbnails after account type changes."""
+
+    def setUp(self):
+        self.account_type = AccountType.objects.create(
+            title='Basic', is_basic=True, thumb_size1=200)
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='pass123',
+            account_type=self.account_type,
+        )
+
+    def create_image(self, color=(255, 0, 0)):
+        """Create an image with thumbnails of its account type."""
+        content = BytesIO()
+        Img.new('RGB', (800, 600), color).save(content, 'PNG')
+        return Image.objects.create(
+            user=self.user, title='sample',
+            image=ContentFile(content.getvalue(), name='sample.png'))
+
+    def regenerate(self, **options):
+        """Run the command, committing its changes."""
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command(
+                'regenerate_thumbnails', rate=0, stdout=StringIO(),
+                **options)
+
+    def test_regenerate_changed_sizes(self, patched_delay):
+        """Test thumbnails are rendered at new sizes, old files logged."""
+        image = self.create_image()
+        old_name = image.thumbnail_size1.name
+        self.account_type.thumb_size1 = 100
+        self.account_type.thumb_size2 = 50
+        self.account_type.save()
+
+        self.regenerate()
+
+        image.refresh_from_db()
+        self.assertEqual(
+            image.thumbnail_size1.name,
+            image.blob.thumb_name(100, self.account_type))
+        self.assertEqual(Img.open(image.thumbnail_size1).size, (100, 75))
+        self.assertEqual(Img.open(image.thumbnail_size2).size, (50, 38))
+        self.assertTrue(PendingDeletion.objects.filter(name=old_name).exists())
+        self.assertFalse(CommandCheckpoint.objects.exists())
+
+        # Derivatives of a live blob are kept: new uploads may reuse them.
+        gc.drain()
+        self.assertTrue(default_storage.exists(old_name))
+
+    def test_regenerate_renders_without_lock(self, patched_delay):
+        """Test thumbnails are rendered outside of a transaction."""
+        self.create_image()
+        self.account_type.thumb_size1 = 100
+        self.account_type.save()
+        test_depth = len(connection.savepoint_ids)
+        depths = []
+        make_thumbnail = Image.make_thumbnail
+
+        def record_depth(image):
+            depths.append(len(connection.savepoint_ids))
+            return make_thumbnail(image)
+
+        with patch.object(Image, 'make_thumbnail', record_depth):
+            self.regenerate()
+
+        self.assertEqual(depths, [test_depth])
+
+    def test_image_changed_while_rendering_kept(self, patched_delay):
+        """Test thumbnails changed during a render aren't overwritten."""
+        image = self.create_image()
+        self.account_type.thumb_size1 = 100
+        self.account_type.save()
+        make_thumbnail = Image.make_thumbnail
+
+        def change_thumbnail(instance):
+            Image.objects.filter(pk=instance.pk).update(
+                thumbnail_size1='uploads/thumbs/other.png')
+            return make_thumbnail(instance)
+
+        with patch.object(Image, 'make_thumbnail', change_thumbnail):
+            self.regenerate()
+
+        image.refresh_from_db()
+        self.assertEqual(
+            image.thumbnail_size1.name, 'uploads/thumbs/other.png')
+        self.assertTrue(PendingDeletion.objects.filter(
+            name=image.blob.thumb_name(100, self.account_type)).exists())
+
+    def test_regenerate_user_moved_to_account_type(self, patched_delay):
+        """Test a user's images follow their new account type."""
+        image = self.create_image()
+        self.user.account_type = AccountType.objects.create(
+            title='Premium', is_premium=True, thumb_size1=400)
+        self.user.save()
+
+        self.regenerate(user=[self.user.id])
+
+        image.refresh_from_db()
+        self.assertEqual(Img.open(image.thumbnail_size1).size, (400, 300))
+
+    def test_shared_thumbnail_kept(self, patched_delay):
+        """Test old files still used by another image aren't deleted."""
+        image = self.create_image()
+        old_name = image.thumbnail_size1.name
+        other_user = get_user_model().objects.create_user(
+            email='other@example.com',
+            password='pass123',
+            account_type=AccountType.objects.create(
+                title='Other', is_basic=True, thumb_size1=200),
+        )
+        other = Image.objects.create(
+            user=other_user, title='same', image=image.blob.file.name)
+        Image.objects.filter(pk=other.pk).update(thumbnail_size1=old_name)
+        self.account_type.thumb_size1 = 100
+        self.account_type.save()
+
+        self.regenerate(account_type=[self.account_type.id])
+        gc.drain()
+
+        self.assertTrue(default_storage.exists(old_name))
+
+    def test_regenerate_legacy_image(self, patched_delay):
+        """Test thumbnails of images without a blob are checked by size."""
+        content = BytesIO()
+        Img.new('RGB', (800, 600)).save(content, 'PNG')
+        name = default_storage.save(
+            'uploads/images/legacy.png', ContentFile(content.getvalue()))
+        image = Image.objects.bulk_create([
+            Image(user=self.user, title='legacy', image=name,
+                  status=Image.Status.READY),
+        ])[0]
+        image.make_thumbnail()
+        image.save()
+        old_name = image.thumbnail_size1.name
+        self.account_type.thumb_size1 = 100
+        self.account_type.save()
+
+        self.regenerate()
+
+        image.refresh_from_db()
+        self.assertEqual(Img.open(image.thumbnail_size1).size, (100, 75))
+        gc.drain()
+        self.assertFalse(default_storage.exists(old_name))
+
+    def test_up_to_date_images_skipped(self, patched_delay):
+        """Test nothing is queued when thumbnails match."""
+        self.create_image()
+
+        self.regenerate()
+
+        patched_delay.assert_not_called()
+
+    def test_resume_from_checkpoint(self, patched_delay):
+        """Test an interrupted run continues after the last scanned image."""
+        first = self.create_image()
+        second = self.create_image(color=(0, 255, 0))
+        self.account_type.thumb_size1 = 100
+        self.account_type.save()
+        CommandCheckpoint.objects.create(
+            scope='regenerate_thumbnails account_types=[] users=[]',
+            last_id=first.id)
+
+        self.regenerate()
+
+        patched_delay.assert_called_once_with([second.id])
+        first.refresh_from_db()
+        self.assertEqual(Img.open(first.thumbnail_size1).size, (200, 150))
+
+    def test_time_limit_queues_rest_of_batch(self, patched_delay):
+        """Test a batch past its time limit continues in a new task."""
+        with patch('images.regenerate.regenerate',
+                   side_effect=[True, SoftTimeLimitExceeded, True, True]):
+            regenerate_thumbnails_task([1, 2, 3, 4])
+
+        patched_delay.assert_called_once_with([3, 4])
+
+
+class ShardMediaCommandTests(TestCase):
+    """Test moving stored files into the sharded layout."""
+
+    def setUp(self):
+        account_type = AccountType.objects.create(
+            title='Basic', is_basic=True, thumb_size1=200)
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='pass123',
+            account_type=account_type,
+        )
+        content = BytesIO()
+        Img.new('RGB', (300, 200), (0, 0, 255)).save(content, 'PNG')
+        with override_settings(MEDIA_SHARD_DEPTH=0):
+            self.image = Image.objects.create(
+                user=self.user, title='sample',
+                image=ContentFile(content.getvalue(), name='sample.png'))
+            self.image.make_binary_image()
+            self.link = BinaryImageLink.objects.create(
+                user=self.user, binary_image=ContentFile(
+                    content.getvalue(), name='link.png'),
+                expiring_time=300)
+        self.image.refresh_from_db()
+        self.old_names = self.names()
+
+    def names(self):
+        """Return all stored names of the image, its blob and the link."""
+        image = Image.objects.get(pk=self.image.pk)
+        return [
+            image.blob.file.name,
+            image.image.name,
+            image.thumbnail_size1.name,
+            image.binary_image.name,
+            BinaryImageLink.objects.get(pk=self.link.pk).binary_image.name,
+        ]
+
+    def test_shard_media_moves_files(self):
+        """Test files are moved to sharded names and old names deleted."""
+        self.assertEqual(self.old_names[0].count('/'), 2)
+
+        call_command('shard_media', stdout=StringIO())
+
+        names = self.names()
+        for old, new in zip(self.old_names, names):
+            self.assertEqual(new, sharded_name(old))
+            self.assertEqual(new.count('/'), old.count('/') + 2)
+            self.assertTrue(default_storage.exists(new))
+            self.assertFalse(default_storage.exists(old))
+        self.assertRegex(
+            names[0], r'^uploads/images/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}')
+        self.assertFalse(CommandCheckpoint.objects.exists())
+
+    def test_shard_media_rollback(self):
+        """Test rolling back restores the old names and files."""
+        call_command('shard_media', stdout=StringIO())
+        moved = self.names()
+
+        call_command('shard_media', rollback=True, stdout=StringIO())
+
+        self.assertEqual(self.names(), self.old_names)
+        for old, new in zip(self.old_names, moved):
+            self.assertTrue(default_storage.exists(old))
+            self.assertFalse(default_storage.exists(new))
+        self.assertFalse(MediaMove.objects.exists())
+
+    def test_shard_media_touches_library(self):
+        """Test owners of moved images get a new library version."""
+        version = get_user_model().objects.get(
+            pk=self.user.pk).library_version
+
+        call_command('shard_media', stdout=StringIO())
+
+        self.assertGreater(get_user_model().objects.get(
+            pk=self.user.pk).library_version, version)
+
+    def test_shard_media_keeps_old_links(self):
+        """Test signed links and media URLs made before a move still work."""
+        token = signing.make_token(self.image, 300)
+        old_binary = self.old_names[3]
+
+        call_command('shard_media', stdout=StringIO())
+
+        res = self.client.get(reverse('signed-link', args=[token]))
+        self.assertEqual(res.status_code, 200)
+        self.client.force_login(self.user)
+        res = self.client.get(reverse('media', args=[old_binary]))
+        self.assertEqual(res.status_code, 200)
+
+    def test_shard_media_resumes(self):
+        """Test an interrupted run resumes and only deletes old files."""
+        with patch(
+                'images.management.commands.shard_media.Command.'
+                'finish_forward', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('shard_media', stdout=StringIO())
+        for name in self.old_names:
+            self.assertTrue(default_storage.exists(name))
+
+        out = StringIO()
+        call_command('shard_media', stdout=out)
+
+        self.assertIn('Resuming images.Image', out.getvalue())
+        self.assertIn('Rewrote 0 names, moved 4 files', out.getvalue())
+        for name in self.old_names:
+            self.assertFalse(default_storage.exists(name))
+
+    def test_concurrent_change_kept(self):
+        """Test names changed while a batch is rewritten aren't reverted."""
+        image = Image.objects.get(pk=self.image.pk)
+        Image.objects.filter(pk=image.pk).update(title='x', image='other')
+
+        rename_rows(Image, 'image', [image], {image.image.name: 'moved'})
+
+        self.assertEqual(Image.objects.get(pk=image.pk).image.name, 'other')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class CollectGarbageCommandTests(TestCase):
+    """Test deleting stored files that are no longer used."""
+
+    def setUp(self):
+        account_type = AccountType.objects.create(
+            title='Basic', is_basic=True, thumb_size1=200)
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='pass123',
+            account_type=account_type,
+        )
+        content = BytesIO()
+        Img.new('RGB', (300, 200), (0, 128, 0)).save(content, 'PNG')
+        self.content = content.getvalue()
+
+    def create_image(self):
+        """Create an image with a thumbnail and a binary image."""
+        image = Image.objects.create(
+            user=self.user, title='sample',
+            image=ContentFile(self.content, name='sample.png'))
+        image.make_binary_image()
+
+        return image
+
+    def drain(self):
+        """Run the drain, returning its output."""
+        out = StringIO()
+        call_command('collect_garbage', stdout=out)
+
+        return out.getvalue()
+
+    def test_deleted_blob_files_drained(self):
+        """Test an image's files are logged and deleted by the drain."""
+        image = self.create_image()
+        names = [
+            image.image.name,
+            image.thumbnail_size1.name,
+            image.binary_image.name,
+        ]
+
+        image.delete()
+        for name in names:
+            self.assertTrue(default_storage.exists(name))
+        out = self.drain()
+
+        for name in names:
+            self.assertFalse(default_storage.exists(name))
+        self.assertFalse(PendingDeletion.objects.exists())
+        self.assertIn('Processed 3 pending deletions', out)
+
+    def test_legacy_image_and_link_files_drained(self):
+        """Test files owned by a legacy image and its link are deleted."""
+        name = default_storage.save(
+            'uploads/images/legacy.png', ContentFile(self.content))
+        image = Image.objects.bulk_create([
+            Image(user=self.user, title='legacy', image=name),
+        ])[0]
+        image.make_thumbnail()
+        image.save()
+        link = BinaryImageLink.objects.create(
+            user=self.user, image=image, expiring_time=300,
+            binary_image=ContentFile(self.content, name='link.png'))
+
+        image.delete()
+        self.drain()
+
+        for stored in (name, image.thumbnail_size1.name,
+                       link.binary_image.name):
+            self.assertFalse(default_storage.exists(stored))
+
+    def test_reuploaded_blob_kept(self):
+        """Test files taken back by a new upload aren't drained."""
+        image = self.create_image()
+        name = image.image.name
+        image.delete()
+
+        again = self.create_image()
+        self.drain()
+
+        self.assertEqual(again.image.name, name)
+        self.assertTrue(default_storage.exists(name))
+        self.assertTrue(default_storage.exists(again.thumbnail_size1.name))
+
+    def test_reconcile_reports_orphans(self):
+        """Test reconciling finds unreferenced files and logs them."""
+        image = self.create_image()
+        orphan = default_storage.save(
+            'uploads/images/zz/orphan.png', ContentFile(b'x' * 100))
+
+        out = StringIO()
+        call_command(
+            'collect_garbage', reconcile=True, min_age=0, stdout=out)
+        self.assertIn('1 unreferenced, 100 bytes reclaimable', out.getvalue())
+        self.assertFalse(PendingDeletion.objects.exists())
+
+        call_command(
+            'collect_garbage', reconcile=True, delete=True, min_age=0,
+            stdout=StringIO())
+        self.drain()
+
+        self.assertFalse(default_storage.exists(orphan))
+        self.assertTrue(default_storage.exists(image.image.name))
+
+    def test_reconcile_skips_recent_files(self):
+        """Test files younger than min_age aren't reclaimable."""
+        default_storage.save(
+            'uploads/images/zz/new.png', ContentFile(b'x' * 100))
+
+        out = StringIO()
+        call_command('collect_garbage', reconcile=True, stdout=out)
+
+        self.assertIn('0 unreferenced', out.getvalue())
+
+
+class BackfillImageMetadataCommandTests(TestCase):
+    """Test storing metadata of images uploaded before it was kept."""
+
+    def setUp(self):
+        account_type = AccountType.objects.create(
+            title='Basic', is_basic=True, thumb_size1=200)
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='pass123',
+            account_type=account_type,
+        )
+
+    def create_image(self):
+        """Create an image and forget its metadata."""
+        content = BytesIO()
+        Img.new('RGB', (400, 100)).save(content, 'PNG')
+        image = Image.objects.create(
+            user=self.user, title='sample',
+            image=ContentFile(content.getvalue(), name='sample.png'))
+        Image.objects.filter(pk=image.pk).update(
+            width=None, height=None, format='', file_size=None,
+            orientation=None, thumbnail_size1_width=None,
+            thumbnail_size1_height=None)
+
+        return image
+
+    def test_backfill_reads_headers(self):
+        """Test originals and thumbnails get their dimensions."""
+        image = self.create_image()
+        missing = Image.objects.bulk_create([
+            Image(user=self.user, title='gone',
+                  image='uploads/images/zz/gone.png'),
+        ])[0]
+
+        out = StringIO()
+        call_command(
+            'backfill_image_metadata', workers=2, stdout=out,
+            stderr=StringIO())
+
+        image.refresh_from_db()
+        self.assertEqual((image.width, image.height), (400, 100))
+        self.assertEqual(image.format, 'PNG')
+        self.assertEqual(image.file_size, image.blob.size)
+        self.assertEqual(image.orientation, 1)
+        self.assertEqual(
+            (image.thumbnail_size1_width, image.thumbnail_size1_height),
+            (200, 50))
+        missing.refresh_from_db()
+        self.assertIsNone(missing.width)
+        self.assertIn('metadata of 1 images, 1 unreadable', out.getvalue())
+        self.assertFalse(CommandCheckpoint.objects.exists())
+
+    def test_backfill_resumes_after_checkpoint(self):
+        """Test images up to the checkpoint are skipped."""
+        first, second = self.create_image(), self.create_image()
+        CommandCheckpoint.objects.create(
+            scope='backfill_image_metadata', last_id=first.id)
+
+        call_command('backfill_image_metadata', stdout=StringIO())
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertIsNone(first.width)
+        self.assertEqual(second.width, 400)
@@ -1,28 +1,60 @@
 """
 Tests for images APIs.
 """
-from django.test import TestCase
+from unittest.mock import patch
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.core.files.base import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
 
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.core.management import call_command
 
 from rest_framework import status
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
+from celery.exceptions import SoftTimeLimitExceeded
 from PIL import Image as Img
 from io import BytesIO
 
 from images.models import (
     AccountType,
+    Blob,
     Image,
     BinaryImageLink,
+    UploadSession,
+)
+from images import (
+    authentication,
+    derivatives,
+    gc,
+    metrics,
+    processing,
+    uploads,
+)
+from images.authentication import CachedTokenAuthentication
+from app.tasks import (
+    delete_expired_link_task,
+    drain_pending_deletions_task,
+    generate_thumbnails_task,
 )
 
+import hashlib
+import os
+import struct
 import tempfile
 import datetime
+import threading
 import time
+import zipfile
+import zlib
+from io import StringIO
+from urllib.parse import urlparse
 
 
 IMAGES_URL = reverse('image-list')
@@ -38,6 +70,34 @@ def get_link_url(image_id):
     return reverse('image-get-link', args=[image_id])
 
 
+def thumb_url(image_id, size):
+    """Create and return an on demand thumbnail URL."""
+    return reverse('image-thumb', args=[image_id, size])
+
+
+UPLOADS_URL = reverse('uploadsession-list')
+
+BATCH_URL = reverse('image-batch')
+
+
+def media_url(name):
+    """Return URL of a stored file."""
+    return reverse('media', args=[name])
+
+
+METRICS_URL = reverse('metrics')
+
+
+def upload_url(session_id):
+    """Create and return an upload session URL."""
+    return reverse('uploadsession-detail', args=[session_id])
+
+
+def finalize_url(session_id):
+    """Create and return an upload session finalize URL."""
+    return reverse('uploadsession-finalize', args=[session_id])
+
+
 def create_user(**params):
     """Create and return a new user."""
     return get_user_model().objects.create_user(**params)
@@ -95,6 +155,21 @@ def get_image_file(name='test.png',
     return File(file_obj, name=name)
 
 
+def png_chunk(chunk_type, data):
+    """Return a PNG chunk with its length and CRC."""
+    return (struct.pack('>I', len(data)) + chunk_type + data
+            + struct.pack('>I', zlib.crc32(chunk_type + data)))
+
+
+def png_header_file(width, height, name='header.png'):
+    """Return a PNG declaring width x height but holding no pixel data."""
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    data = (b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header)
+            + png_chunk(b'IDAT', b''))
+
+    return File(BytesIO(data), name=name)
+
+
 class ImageUploadTests(TestCase):
     """Test for the image upload API."""
 
@@ -118,9 +193,45 @@ class ImageUploadTests(TestCase):
 
         self.assertEqual(res.status_code, status.HTTP_201_CREATED)
         self.assertIn('thumbnail_size1', res.data)
+        self.assertEqual(res.data['status'], Image.Status.READY)
         user_images = Image.objects.filter(user=self.user)
         self.assertEqual(user_images.count(), 1)
 
+    def test_upload_stores_metadata(self):
+        """Test metadata read from the header is stored and returned."""
+        image = get_image_file(size=(800, 600))
+        size = len(image.read())
+        image.seek(0)
+        res = self.client.post(
+            IMAGES_URL, {'title': 'sample', 'image': image},
+            format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            {key: res.data[key] for key in (
+                'width', 'height', 'format', 'file_size', 'orientation',
+                'thumbnail_size1_width', 'thumbnail_size1_height')},
+            {'width': 800, 'height': 600, 'format': 'PNG',
+             'file_size': size, 'orientation': 1,
+             'thumbnail_size1_width': 200, 'thumbnail_size1_height': 150})
+        self.assertNotIn('thumbnail_size2_width', res.data)
+
+    def test_upload_stores_exif_orientation(self):
+        """Test the EXIF orientation of a JPEG is stored."""
+        exif = Img.Exif()
+        exif[0x0112] = 6
+        file_obj = BytesIO()
+        Img.new('RGB', (40, 20)).save(file_obj, 'JPEG', exif=exif)
+        file_obj.seek(0)
+        payload = {'title': 'rotated', 'image': File(file_obj, 'a.jpg')}
+
+        res = self.client.post(IMAGES_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['orientation'], 6)
+        self.assertEqual(res.data['format'], 'JPEG')
+        self.assertEqual((res.data['width'], res.data['height']), (40, 20))
+
     def test_get_images(self):
         """Test retrieving a list of images."""
         Image.objects.create(
@@ -140,6 +251,73 @@ class ImageUploadTests(TestCase):
         self.assertEqual(res.status_code, status.HTTP_200_OK)
         self.assertEqual(images.count(), 2)
 
+    def test_list_images_query_count_constant(self):
+        """Test listing images doesn't query per image."""
+        for title in ('sample1', 'sample2'):
+            Image.objects.create(
+                user=self.user, title=title, image=get_image_file())
+        with CaptureQueriesContext(connection) as small_list:
+            self.client.get(IMAGES_URL)
+
+        for i in range(10):
+            Image.objects.create(
+                user=self.user, title=f'sample{i}', image=get_image_file())
+        with self.assertNumQueries(len(small_list.captured_queries)):
+            res = self.client.get(IMAGES_URL)
+
+        self.assertEqual(len(res.data['results']), 12)
+
+    @override_settings(IMAGES_PAGE_SIZE=2)
+    def test_list_images_cursor_pagination(self):
+        """Test images are listed newest first in cursor pages."""
+        images = [
+            Image.objects.create(
+                user=self.user, title=f'sample{i}', image=get_image_file())
+            for i in range(3)
+        ]
+
+        res = self.client.get(IMAGES_URL)
+        next_res = self.client.get(res.data['next'])
+
+        self.assertEqual(
+            [item['id'] for item in res.data['results']],
+            [images[2].id, images[1].id])
+        self.assertEqual(
+            [item['id'] for item in next_res.data['results']],
+            [images[0].id])
+        self.assertIsNone(next_res.data['next'])
+
+    @override_settings(IMAGES_PAGE_SIZE=2, IMAGES_MAX_PAGE_SIZE=3)
+    def test_list_images_page_size_param(self):
+        """Test clients can pick a page size up to the maximum."""
+        for i in range(4):
+            Image.objects.create(
+                user=self.user, title=f'sample{i}', image=get_image_file())
+
+        res = self.client.get(IMAGES_URL, {'page_size': 10})
+
+        self.assertEqual(len(res.data['results']), 3)
+
+    def test_token_request_loads_account_type_with_user(self):
+        """Test a token authenticated list costs a fixed number of queries.
+
+        The token lookup joins the user and account type, the library
+        state for the ETag is read once, and the images are fetched with
+        one more query. Warm requests only fetch the images.
+        """
+        Image.objects.create(
+            user=self.user, title='sample', image=get_image_file())
+        token = Token.objects.create(user=self.user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+        with self.assertNumQueries(3):
+            res = client.get(IMAGES_URL)
+        with self.assertNumQueries(1):
+            client.get(IMAGES_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
     def test_get_detail_image(self):
         """Test retrieving a detail image."""
         image = Image.objects.create(
@@ -155,6 +333,47 @@ class ImageUploadTests(TestCase):
         self.assertIn('thumbnail_size1', res.data)
         self.assertNotIn('image', res.data)
 
+    def test_identical_uploads_share_blob(self):
+        """Test identical uploads are stored and thumbnailed once."""
+        content = get_image_file().read()
+        for _ in range(2):
+            payload = {
+                'title': 'sample image',
+                'image': File(BytesIO(content), name='test.png'),
+            }
+            res = self.client.post(IMAGES_URL, payload, format='multipart')
+            self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+        first, second = Image.objects.filter(user=self.user)
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(
+            first.thumbnail_size1.name, second.thumbnail_size1.name)
+        self.assertEqual(first.blob.ref_count, 2)
+
+    def test_blob_deleted_with_last_image(self):
+        """Test shared files are only deleted with the last reference."""
+        content = get_image_file().read()
+        first, second = [
+            Image.objects.create(
+                user=self.user,
+                title='sample',
+                image=File(BytesIO(content), name='test.png'),
+            )
+            for _ in range(2)
+        ]
+        names = [first.image.name, first.thumbnail_size1.name]
+
+        self.client.delete(detail_url(first.id))
+        gc.drain()
+        for name in names:
+            self.assertTrue(default_storage.exists(name))
+
+        self.client.delete(detail_url(second.id))
+        gc.drain()
+        for name in names:
+            self.assertFalse(default_storage.exists(name))
+        self.assertFalse(Blob.objects.exists())
+
     def test_delete_image(self):
         """Test deleting an image."""
         image = Image.objects.create(
@@ -188,6 +407,89 @@ class ImageUploadTests(TestCase):
 
         self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
 
+    @override_settings(IMAGE_MAX_PIXELS=10000)
+    def test_upload_image_over_pixel_limit_bad_request(self):
+        """Test images over IMAGE_MAX_PIXELS are rejected with 400."""
+        image = get_image_file(color=(1, 2, 3))
+        payload = {'title': 'sample image', 'image': image}
+        res = self.client.post(IMAGES_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('image', res.data)
+        self.assertFalse(Image.objects.exists())
+
+    def assert_rejected(self, image, message):
+        """Assert uploading image is a 400 before decoding or storing."""
+        payload = {'title': 'sample image', 'image': image}
+        with patch('images.executor.submit') as patched_submit, \
+                patch.object(Blob.objects, 'acquire') as patched_acquire:
+            res = self.client.post(IMAGES_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(message, res.data['image'][0])
+        patched_submit.assert_not_called()
+        patched_acquire.assert_not_called()
+        self.assertFalse(Image.objects.exists())
+
+    def test_upload_mislabeled_image_rejected(self):
+        """Test content not matching the extension is rejected."""
+        self.assert_rejected(
+            get_image_file(name='photo.jpg'), 'File content is PNG, not JPEG')
+
+    def test_upload_truncated_image_rejected(self):
+        """Test a file with image magic bytes but no header is rejected."""
+        self.assert_rejected(
+            File(BytesIO(b'\x89PNG\r\n\x1a\nbroken'), name='a.png'),
+            'File is not a valid image')
+
+    def test_upload_over_account_limits_rejected(self):
+        """Test the account type's dimension and pixel limits apply."""
+        account_type = self.user.account_type
+        account_type.max_dimension = 500
+        account_type.save()
+        self.assert_rejected(
+            get_image_file(size=(600, 100)), 'larger than 500 pixels')
+
+        account_type.max_dimension = None
+        account_type.max_pixels = 250000
+        account_type.save()
+        self.assert_rejected(
+            get_image_file(size=(500, 501)), 'more than 250000 pixels')
+
+        res = self.client.post(IMAGES_URL, {
+            'title': 'sample image',
+            'image': get_image_file(size=(500, 500)),
+        }, format='multipart')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+    def test_upload_multi_picture_jpeg(self):
+        """Test MPO files from phone cameras are uploaded as JPEG."""
+        source = BytesIO()
+        Img.new('RGB', (300, 200)).save(
+            source, 'MPO', save_all=True,
+            append_images=[Img.new('RGB', (300, 200))])
+        image = File(BytesIO(source.getvalue()), name='photo.jpg')
+
+        res = self.client.post(
+            IMAGES_URL, {'title': 'sample', 'image': image},
+            format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Image.objects.get().format, 'JPEG')
+
+    def test_upload_truncated_jpeg_bad_request(self):
+        """Test a valid header over corrupt data is a 400, not a 500."""
+        source = BytesIO()
+        Img.effect_noise((200, 200), 50).save(source, 'JPEG')
+        image = File(BytesIO(source.getvalue()[:600]), name='cut.jpg')
+
+        res = self.client.post(
+            IMAGES_URL, {'title': 'sample', 'image': image},
+            format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Image.objects.exists())
+
     def test_not_allowed_properties_not_in_response_data(self):
         """Test if Enterprise Account Type properties are not visible for
         Basic Account Type user."""
@@ -286,6 +588,1123 @@ class ImageUploadTests(TestCase):
         self.assertNotIn('binary_image', res.data)
 
 
+@override_settings(THUMBNAILS_ASYNC=True)
+class AsyncThumbnailTests(TestCase):
+    """Test generating thumbnails in a Celery task."""
+
+    def setUp(self):
+        self.client = APIClient()
+
+        premium = create_account_type(type='Premium')
+
+        self.user = create_user(
+            email='username@example.com',
+            password='pass123',
+            account_type=premium)
+
+        self.client.force_authenticate(self.user)
+
+    @patch('app.tasks.generate_thumbnails_task.delay')
+    def test_upload_queues_thumbnail_task(self, patched_delay):
+        """Test uploading stores the original and defers thumbnails."""
+        payload = {'title': 'sample image', 'image': get_image_file()}
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(IMAGES_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['status'], Image.Status.PENDING)
+        self.assertIsNone(res.data['thumbnail_size1'])
+        patched_delay.assert_called_once_with(res.data['id'])
+
+    @patch('app.tasks.generate_thumbnails_task.delay')
+    def test_thumbnail_task_is_idempotent(self, patched_delay):
+        """Test running the task twice doesn't create new thumbnails."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+        )
+
+        generate_thumbnails_task(image.id)
+        image.refresh_from_db()
+        thumb1 = image.thumbnail_size1.name
+        thumb2 = image.thumbnail_size2.name
+
+        generate_thumbnails_task(image.id)
+        image.refresh_from_db()
+
+        self.assertEqual(image.status, Image.Status.READY)
+        self.assertEqual(image.thumbnail_size1.name, thumb1)
+        self.assertEqual(image.thumbnail_size2.name, thumb2)
+        self.assertEqual(Img.open(image.thumbnail_size1).height, 400)
+
+    @patch('app.tasks.generate_thumbnails_task.delay')
+    def test_thumbnail_task_invalid_image_failed(self, patched_delay):
+        """Test an undecodable original marks the image as failed."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=File(BytesIO(b'notanimage'), name='broken.png'),
+        )
+
+        generate_thumbnails_task(image.id)
+        image.refresh_from_db()
+
+        self.assertEqual(image.status, Image.Status.FAILED)
+        self.assertFalse(image.thumbnail_size1)
+
+    @patch('app.tasks.generate_thumbnails_task.retry')
+    @patch('app.tasks.generate_thumbnails_task.delay')
+    def test_thumbnail_task_corrupt_image_not_retried(
+            self, patched_delay, patched_retry):
+        """Test corrupt data past a valid header fails without retries."""
+        source = BytesIO()
+        Img.effect_noise((200, 200), 50).save(source, 'JPEG')
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=File(BytesIO(source.getvalue()[:600]), name='cut.jpg'),
+        )
+
+        generate_thumbnails_task(image.id)
+        image.refresh_from_db()
+
+        self.assertEqual(image.status, Image.Status.FAILED)
+        patched_retry.assert_not_called()
+
+    @patch('app.tasks.generate_thumbnails_task.delay')
+    def test_thumbnail_task_time_limit_failed(self, patched_delay):
+        """Test an image not rendered within the time limit fails."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+        )
+
+        with patch.object(Image, 'make_thumbnail',
+                          side_effect=SoftTimeLimitExceeded):
+            generate_thumbnails_task(image.id)
+        image.refresh_from_db()
+
+        self.assertEqual(image.status, Image.Status.FAILED)
+
+    @patch('app.tasks.generate_thumbnails_task.delay')
+    def test_thumbnail_task_commits_processing(self, patched_delay):
+        """Test images are marked as processing before rendering."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+        )
+        statuses = []
+        make_thumbnail = Image.make_thumbnail
+
+        def record_status(instance):
+            statuses.append(Image.objects.get(pk=instance.pk).status)
+            return make_thumbnail(instance)
+
+        with patch.object(Image, 'make_thumbnail', record_status):
+            generate_thumbnails_task(image.id)
+        image.refresh_from_db()
+
+        self.assertEqual(statuses, [Image.Status.PROCESSING])
+        self.assertEqual(image.status, Image.Status.READY)
+
+    @patch('app.tasks.generate_thumbnails_task.delay')
+    def test_thumbnail_task_skips_image_processing(self, patched_delay):
+        """Test another delivery of the task leaves processing images."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+            status=Image.Status.PROCESSING,
+        )
+
+        generate_thumbnails_task(image.id)
+        image.refresh_from_db()
+
+        self.assertEqual(image.status, Image.Status.PROCESSING)
+        self.assertFalse(image.thumbnail_size1)
+
+    @patch('app.tasks.generate_thumbnails_task.delay')
+    def test_thumbnail_task_takes_over_stalled_image(self, patched_delay):
+        """Test an image left processing by a dead worker is rendered."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+            status=Image.Status.PROCESSING,
+        )
+        Image.objects.filter(pk=image.pk).update(
+            status_changed_at=timezone.now() - datetime.timedelta(hours=1))
+
+        generate_thumbnails_task(image.id)
+        image.refresh_from_db()
+
+        self.assertEqual(image.status, Image.Status.READY)
+
+    @patch('app.tasks.generate_thumbnails_task.delay',
+           side_effect=ConnectionError)
+    def test_upload_with_broker_down_requeued(self, patched_delay):
+        """Test uploads succeed without a broker and are queued later."""
+        payload = {'title': 'sample image', 'image': get_image_file()}
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(IMAGES_URL, payload, format='multipart')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+
+        fresh = Image.objects.create(
+            user=self.user, title='fresh', image=get_image_file(),
+            status=Image.Status.PROCESSING)
+        Image.objects.filter(pk=res.data['id']).update(
+            status_changed_at=timezone.now() - datetime.timedelta(hours=1))
+        patched_delay.reset_mock(side_effect=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            count = processing.requeue_stalled()
+
+        self.assertEqual(count, 1)
+        patched_delay.assert_called_once_with(res.data['id'])
+        fresh.refresh_from_db()
+        self.assertEqual(fresh.status, Image.Status.PROCESSING)
+
+
+class OnDemandThumbnailTests(TestCase):
+    """Test thumbnails rendered on demand from the derivative cache."""
+
+    def setUp(self):
+        self.client = APIClient()
+
+        premium = create_account_type(type='Premium')
+
+        self.user = create_user(
+            email='username@example.com',
+            password='pass123',
+            account_type=premium)
+
+        self.client.force_authenticate(self.user)
+
+        self.image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+        )
+
+        cache_root = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_root.cleanup)
+        cache_settings = override_settings(
+            DERIVATIVE_CACHE_ROOT=cache_root.name)
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+
+    def test_get_thumbnail_renders_allowed_size(self):
+        """Test getting a thumbnail in a size allowed for account type."""
+        res = self.client.get(thumb_url(self.image.id, 200))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'image/png')
+        thumb = Img.open(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual(thumb.height, 200)
+
+    @override_settings(THUMBNAIL_FORMATS=['WEBP'])
+    def test_get_thumbnail_negotiates_webp(self):
+        """Test clients accepting WebP get a WebP thumbnail."""
+        res = self.client.get(
+            thumb_url(self.image.id, 200), HTTP_ACCEPT='image/webp')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'image/webp')
+        self.assertIn('Accept', res['Vary'])
+        thumb = Img.open(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual(thumb.format, 'WEBP')
+        self.assertEqual(thumb.height, 200)
+
+    @override_settings(THUMBNAIL_FORMATS=['WEBP'])
+    def test_get_thumbnail_keeps_format_without_accept(self):
+        """Test the original format is used unless asked for explicitly."""
+        res = self.client.get(
+            thumb_url(self.image.id, 200), HTTP_ACCEPT='image/*;q=0.8')
+
+        self.assertEqual(res['Content-Type'], 'image/png')
+        self.assertIn('Accept', res['Vary'])
+
+    def test_get_thumbnail_served_from_cache(self):
+        """Test a cached thumbnail isn't rendered again."""
+        self.client.get(thumb_url(self.image.id, 400))
+
+        with patch('images.executor.render_thumbnails') as patched_render:
+            res = self.client.get(thumb_url(self.image.id, 400))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        patched_render.assert_not_called()
+
+    def test_get_thumbnail_any_size_up_to_limit(self):
+        """Test heights between the account type's sizes are rendered."""
+        res = self.client.get(thumb_url(self.image.id, 300))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        thumb = Img.open(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual(thumb.height, 300)
+
+    def test_get_thumbnail_size_not_allowed(self):
+        """Test sizes outside of account type are rejected."""
+        for size in (0, 600):
+            res = self.client.get(thumb_url(self.image.id, size))
+
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_concurrent_misses_render_once(self):
+        """Test concurrent requests for a missing thumbnail render once."""
+        render = derivatives.executor.render_thumbnails
+        calls = []
+
+        def slow_render(*args, **kwargs):
+            calls.append(args)
+            time.sleep(0.2)
+            return render(*args, **kwargs)
+
+        images = [Image.objects.get(id=self.image.id) for _ in range(3)]
+        with patch('images.executor.render_thumbnails', slow_render):
+            threads = [
+                threading.Thread(
+                    target=lambda image: derivatives.get_or_render(
+                        image, 200).close(),
+                    args=(image,))
+                for image in images
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+
+    def test_evict_removes_least_recently_used(self):
+        """Test eviction drops oldest derivatives above the size cap."""
+        with derivatives.get_or_render(self.image, 200) as file:
+            old = file.name
+        with derivatives.get_or_render(self.image, 400) as file:
+            new = file.name
+        os.utime(old, (0, 0))
+
+        derivatives.evict(max_bytes=os.path.getsize(new))
+
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+        self.assertTrue(os.path.exists(
+            os.path.join(os.path.dirname(old), '.lock')))
+
+    def test_evicted_thumbnail_rendered_again(self):
+        """Test a thumbnail evicted before it is opened is rendered again."""
+        with derivatives.get_or_render(self.image, 200) as file:
+            path = file.name
+        real_open = open
+        opened = []
+
+        def evict_then_open(name, *args, **kwargs):
+            if name == path and not opened:
+                os.remove(path)
+            opened.append(name)
+            return real_open(name, *args, **kwargs)
+
+        with patch('builtins.open', evict_then_open), \
+                patch('images.derivatives.evict') as patched_evict:
+            res = self.client.get(thumb_url(self.image.id, 200))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            Img.open(BytesIO(b''.join(res.streaming_content))).height, 200)
+        patched_evict.assert_not_called()
+
+
+class BatchUploadTests(TestCase):
+    """Test uploading many images in one request."""
+
+    def setUp(self):
+        self.client = APIClient()
+
+        premium = create_account_type(type='Premium')
+
+        self.user = create_user(
+            email='username@example.com',
+            password='pass123',
+            account_type=premium)
+
+        self.client.force_authenticate(self.user)
+
+    def test_batch_upload_files(self):
+        """Test uploading several files creates ready images."""
+        payload = {'images': [
+            get_image_file(name='first.png'),
+            get_image_file(name='second.png', color=(0, 255, 0)),
+        ]}
+        res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([item['name'] for item in res.data],
+                         ['first.png', 'second.png'])
+        images = Image.objects.filter(user=self.user).order_by('id')
+        self.assertEqual([image.title for image in images],
+                         ['first', 'second'])
+        for item, image in zip(res.data, images):
+            self.assertEqual(item['id'], image.id)
+            self.assertEqual(item['status'], Image.Status.READY)
+            self.assertEqual(image.status, Image.Status.READY)
+            self.assertIsNotNone(image.blob)
+            self.assertEqual(Img.open(image.thumbnail_size1).height, 400)
+            self.assertEqual((image.width, image.height), (800, 800))
+            self.assertEqual(image.thumbnail_size1_height, 400)
+
+    def test_batch_upload_archive(self):
+        """Test uploading a ZIP archive creates an image per entry."""
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.writestr('photos/', b'')
+            zip_file.writestr('photos/a.png', get_image_file().read())
+            zip_file.writestr('notes.txt', b'not an image')
+        archive.seek(0)
+        payload = {'archive': File(archive, name='images.zip')}
+
+        res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(res.data), 2)
+        self.assertEqual(res.data[0]['name'], 'a.png')
+        self.assertEqual(res.data[0]['status'], Image.Status.READY)
+        self.assertEqual(res.data[1]['name'], 'notes.txt')
+        self.assertIn('error', res.data[1])
+        self.assertEqual(Image.objects.filter(user=self.user).count(), 1)
+
+    def test_batch_upload_reports_invalid_entries(self):
+        """Test invalid files are reported without failing the batch."""
+        payload = {'images': [
+            get_image_file(name='good.png'),
+            File(BytesIO(b'notanimage'), name='bad.png'),
+            get_image_file(name='mislabeled.jpg'),
+        ]}
+        res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertIn('id', res.data[0])
+        self.assertIn('error', res.data[1])
+        self.assertIn('error', res.data[2])
+        self.assertEqual(Image.objects.filter(user=self.user).count(), 1)
+
+    def test_batch_upload_reports_oversized_entries(self):
+        """Test a header too large for Pillow is an entry error."""
+        payload = {'images': [
+            get_image_file(name='good.png'),
+            png_header_file(60000, 60000, name='bomb.png'),
+        ]}
+        res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertIn('id', res.data[0])
+        self.assertIn('error', res.data[1])
+        self.assertEqual(Image.objects.filter(user=self.user).count(), 1)
+
+    def test_batch_upload_archive_entry_too_large(self):
+        """Test entries over IMAGE_MAX_BYTES aren't extracted."""
+        data = get_image_file().read()
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.writestr('a.png', data)
+        archive.seek(0)
+        payload = {'archive': File(archive, name='images.zip')}
+
+        with override_settings(IMAGE_MAX_BYTES=len(data) - 1), \
+                patch('images.batch.TemporaryUploadedFile') as patched_file:
+            res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(res.data[0]['error'], 'File is too large.')
+        patched_file.assert_not_called()
+
+    def test_batch_upload_checks_account_limits(self):
+        """Test entries are held to the same limits as POST /image/."""
+        account_type = self.user.account_type
+        account_type.max_dimension = 100
+        account_type.save()
+        payload = {'images': [get_image_file(name='large.png')]}
+
+        res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('larger than 100 pixels', res.data[0]['error'])
+        self.assertFalse(Blob.objects.exists())
+
+    def test_batch_upload_failure_keeps_no_blobs(self):
+        """Test blobs acquired by a failed batch are rolled back."""
+        payload = {'images': [get_image_file(name='first.png')]}
+        with patch.object(Image.objects, 'bulk_create',
+                          side_effect=RuntimeError), \
+                self.assertRaises(RuntimeError):
+            self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertFalse(Blob.objects.exists())
+
+    def test_batch_upload_renders_after_commit(self):
+        """Test thumbnails are rendered once the images are committed."""
+        test_depth = len(connection.savepoint_ids)
+        depths = []
+
+        def make_thumbnails(images):
+            depths.append(len(connection.savepoint_ids))
+            for image in images:
+                image.status = Image.Status.READY
+
+        payload = {'images': [get_image_file(name='first.png')]}
+        with patch('images.batch.make_thumbnails', make_thumbnails):
+            res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(depths, [test_depth])
+        self.assertEqual(Image.objects.get().status, Image.Status.READY)
+
+    def test_batch_upload_nothing_valid_bad_request(self):
+        """Test a batch without a valid image returns 400."""
+        payload = {'images': [File(BytesIO(b'notanimage'), name='bad.png')]}
+        res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Image.objects.exists())
+
+    def test_batch_upload_empty_bad_request(self):
+        """Test a batch without files returns 400."""
+        res = self.client.post(BATCH_URL, {}, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(BATCH_UPLOAD_MAX_FILES=1)
+    def test_batch_upload_too_many_files(self):
+        """Test batches over BATCH_UPLOAD_MAX_FILES are rejected."""
+        payload = {'images': [
+            get_image_file(name='first.png'),
+            get_image_file(name='second.png'),
+        ]}
+        res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Image.objects.exists())
+
+    @override_settings(BATCH_UPLOAD_MAX_FILES=2)
+    @patch('images.batch.archive_entries')
+    def test_batch_upload_archive_too_many_entries(self, patched_entries):
+        """Test archive entries are counted before any is extracted."""
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            for number in range(3):
+                zip_file.writestr(f'{number}.png', get_image_file().read())
+        archive.seek(0)
+        payload = {'archive': File(archive, name='images.zip')}
+
+        res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        patched_entries.assert_not_called()
+
+    @override_settings(THUMBNAILS_ASYNC=True)
+    @patch('app.tasks.generate_thumbnails_task.delay')
+    def test_batch_upload_queues_thumbnail_tasks(self, patched_delay):
+        """Test async mode queues a thumbnail task per created image."""
+        payload = {'images': [
+            get_image_file(name='first.png'),
+            get_image_file(name='second.png'),
+        ]}
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(BATCH_URL, payload, format='multipart')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(patched_delay.call_count, 2)
+        for item in res.data:
+            self.assertEqual(item['status'], Image.Status.PENDING)
+            patched_delay.assert_any_call(item['id'])
+
+
+class ChunkedUploadTests(TestCase):
+    """Test resumable chunked uploads."""
+
+    def setUp(self):
+        self.client = APIClient()
+
+        basic = create_account_type(type='Basic')
+
+        self.user = create_user(
+            email='username@example.com',
+            password='pass123',
+            account_type=basic)
+
+        self.client.force_authenticate(self.user)
+
+        upload_root = tempfile.TemporaryDirectory()
+        self.addCleanup(upload_root.cleanup)
+        upload_settings = override_settings(
+            UPLOAD_SESSION_ROOT=upload_root.name)
+        upload_settings.enable()
+        self.addCleanup(upload_settings.disable)
+
+        self.data = get_image_file().read()
+
+    def create_session(self, **params):
+        """Create an upload session for self.data."""
+        payload = {
+            'title': 'sample image',
+            'filename': 'test.png',
+            'size': len(self.data),
+            'checksum': hashlib.sha256(self.data).hexdigest(),
+        }
+        payload.update(params)
+
+        return self.client.post(UPLOADS_URL, payload, format='json')
+
+    def put_chunk(self, session_id, start, end):
+        """Upload self.data[start:end + 1] to a session."""
+        return self.client.put(
+            upload_url(session_id),
+            self.data[start:end + 1],
+            content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f'bytes {start}-{end}/{len(self.data)}',
+        )
+
+    def test_chunked_upload_creates_image(self):
+        """Test uploading in chunks and finalizing creates an image."""
+        session_id = self.create_session().data['id']
+        middle = len(self.data) // 2
+
+        res1 = self.put_chunk(session_id, 0, middle - 1)
+        res2 = self.put_chunk(session_id, middle, len(self.data) - 1)
+        res = self.client.post(finalize_url(session_id))
+
+        self.assertEqual(res1.data['offset'], middle)
+        self.assertEqual(res2.data['offset'], len(self.data))
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        image = Image.objects.get(user=self.user)
+        self.assertEqual(image.title, 'sample image')
+        self.assertEqual(image.image.read(), self.data)
+        self.assertTrue(image.thumbnail_size1)
+
+    def test_resume_reports_offset(self):
+        """Test a session reports how much has been received."""
+        session_id = self.create_session().data['id']
+        self.put_chunk(session_id, 0, 99)
+
+        res = self.client.get(upload_url(session_id))
+
+        self.assertEqual(res.data['offset'], 100)
+
+    def test_chunk_at_wrong_offset_conflict(self):
+        """Test a chunk not continuing the upload is rejected."""
+        session_id = self.create_session().data['id']
+
+        res = self.put_chunk(session_id, 100, 199)
+
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(res.data['offset'], 0)
+
+    def test_chunk_written_outside_transaction(self):
+        """Test chunks are streamed to disk with no transaction open."""
+        session_id = self.create_session().data['id']
+        test_depth = len(connection.savepoint_ids)
+        write_chunk = uploads.write_chunk
+        depths = []
+
+        def record_depth(*args):
+            depths.append(len(connection.savepoint_ids))
+            return write_chunk(*args)
+
+        with patch('images.uploads.write_chunk', record_depth):
+            res = self.put_chunk(session_id, 0, 99)
+
+        self.assertEqual(res.data['offset'], 100)
+        self.assertEqual(depths, [test_depth])
+
+    def test_offset_moved_while_writing_conflict(self):
+        """Test a chunk racing another one doesn't advance the offset."""
+        session_id = self.create_session().data['id']
+        write_chunk = uploads.write_chunk
+
+        def race(*args):
+            UploadSession.objects.filter(pk=session_id).update(offset=100)
+            return write_chunk(*args)
+
+        with patch('images.uploads.write_chunk', race):
+            res = self.put_chunk(session_id, 0, 49)
+
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(res.data['offset'], 100)
+        self.assertEqual(
+            UploadSession.objects.get(pk=session_id).offset, 100)
+
+    def test_expired_sessions_deleted(self):
+        """Test the drain expires abandoned sessions and their files."""
+        old_id = self.create_session().data['id']
+        new_id = self.create_session().data['id']
+        old = UploadSession.objects.get(pk=old_id)
+        UploadSession.objects.filter(pk=old_id).update(
+            created_at=timezone.now() - datetime.timedelta(days=2))
+        stray = os.path.join(
+            os.path.dirname(old.path), 'missing-session.part')
+        open(stray, 'wb').close()
+        past = time.time() - 2 * 24 * 3600
+        os.utime(stray, (past, past))
+
+        drain_pending_deletions_task()
+
+        self.assertFalse(UploadSession.objects.filter(pk=old_id).exists())
+        self.assertFalse(os.path.exists(old.path))
+        self.assertFalse(os.path.exists(stray))
+        self.assertTrue(os.path.exists(
+            UploadSession.objects.get(pk=new_id).path))
+
+    def test_finalize_checksum_mismatch(self):
+        """Test finalizing corrupted upload is rejected."""
+        session_id = self.create_session(checksum='0' * 64).data['id']
+        self.put_chunk(session_id, 0, len(self.data) - 1)
+
+        res = self.client.post(finalize_url(session_id))
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(res.data['offset'], 0)
+        self.assertFalse(Image.objects.filter(user=self.user).exists())
+
+    def test_finalize_incomplete_upload(self):
+        """Test finalizing before all chunks arrived is rejected."""
+        session_id = self.create_session().data['id']
+        self.put_chunk(session_id, 0, 99)
+
+        res = self.client.post(finalize_url(session_id))
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(res.data['offset'], 100)
+
+    def test_create_session_invalid_extension(self):
+        """Test sessions are only created for supported file types."""
+        res = self.create_session(filename='test.gif')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create_session_over_image_max_bytes(self):
+        """Test sessions can't announce more than an image may have."""
+        with override_settings(IMAGE_MAX_BYTES=len(self.data) - 1):
+            res = self.create_session()
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('size', res.data)
+
+
+@override_settings(METRICS_ENABLED=True)
+class MetricsTests(TestCase):
+    """Test timing spans and the /metrics endpoint."""
+
+    def setUp(self):
+        self.client = APIClient()
+
+        enterprise = create_account_type(type='Enterprise')
+
+        self.user = create_user(
+            email='username@example.com',
+            password='pass123',
+            account_type=enterprise)
+
+        self.client.force_authenticate(self.user)
+
+    def test_metrics_record_stages_and_requests(self):
+        """Test uploads and links feed stage and request histograms."""
+        image = get_image_file(color=(7, 8, 9))
+        payload = {'title': 'sample image', 'image': image}
+        res = self.client.post(IMAGES_URL, payload, format='multipart')
+        self.client.post(
+            get_link_url(res.data['id']), {'expiring_time': 300},
+            format='json')
+
+        res = self.client.get(METRICS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        text = res.content.decode()
+        for operation, stage in (
+                ('thumbnail', 'decode'),
+                ('thumbnail', 'resize'),
+                ('thumbnail', 'encode'),
+                ('thumbnail', 'store'),
+                ('upload', 'db'),
+                ('binary', 'encode'),
+                ('binary', 'store'),
+                ('link', 'db')):
+            self.assertIn(
+                f'image_stage_seconds_count{{operation="{operation}",'
+                f'stage="{stage}"}}', text)
+        self.assertIn(
+            'http_request_duration_seconds_count{view="ImageViewSet",'
+            'action="create",status="201"}', text)
+        self.assertIn(
+            'http_request_db_queries_count{view="ImageViewSet",'
+            'action="get_link"}', text)
+
+    def test_histogram_buckets_cumulative(self):
+        """Test bucket counts are cumulative and end with +Inf."""
+        histogram = metrics.Histogram('test_seconds', 'Test.', (1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe((('stage', 'db'),), value)
+
+        text = histogram.render()
+
+        self.assertIn('test_seconds_bucket{stage="db",le="1"} 2', text)
+        self.assertIn('test_seconds_bucket{stage="db",le="5"} 3', text)
+        self.assertIn('test_seconds_bucket{stage="db",le="+Inf"} 4', text)
+        self.assertIn('test_seconds_sum{stage="db"} 14.5', text)
+        self.assertIn('test_seconds_count{stage="db"} 4', text)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_metrics_disabled(self):
+        """Test disabled metrics record nothing and aren't served."""
+        self.assertIs(
+            metrics.span('thumbnail', 'decode'),
+            metrics.span('binary', 'encode'))
+
+        res = self.client.get(METRICS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ConditionalGetTests(TestCase):
+    """Test ETag and Last-Modified validation of image list and detail."""
+
+    def setUp(self):
+        premium = create_account_type(type='Premium')
+
+        self.user = create_user(
+            email='username@example.com',
+            password='pass123',
+            account_type=premium)
+
+        token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+        self.image = Image.objects.create(
+            user=self.user, title='sample', image=get_image_file())
+
+    def test_list_not_modified_without_loading_images(self):
+        """Test a matching If-None-Match returns 304 without queries."""
+        res = self.client.get(IMAGES_URL)
+        etag = res['ETag']
+
+        with self.assertNumQueries(0):
+            res = self.client.get(IMAGES_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(res['ETag'], etag)
+        self.assertEqual(res.content, b'')
+
+    def test_detail_not_modified(self):
+        """Test retrieving an unchanged image returns 304."""
+        res = self.client.get(detail_url(self.image.id))
+        self.assertEqual(res['Cache-Control'], 'private, no-cache')
+        self.assertIn('Last-Modified', res)
+
+        res = self.client.get(
+            detail_url(self.image.id), HTTP_IF_NONE_MATCH=res['ETag'])
+
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_etag_changes_on_create(self):
+        """Test uploading an image invalidates the list ETag."""
+        etag = self.client.get(IMAGES_URL)['ETag']
+        Image.objects.create(
+            user=self.user, title='second', image=get_image_file())
+
+        res = self.client.get(IMAGES_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.data['results']), 2)
+        self.assertNotEqual(res['ETag'], etag)
+
+    def test_etag_changes_on_delete(self):
+        """Test deleting an image invalidates the list ETag."""
+        etag = self.client.get(IMAGES_URL)['ETag']
+        self.client.delete(detail_url(self.image.id))
+
+        res = self.client.get(IMAGES_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['results'], [])
+
+    @patch('app.tasks.generate_thumbnails_task.delay')
+    def test_etag_changes_on_thumbnail_completion(self, patched_delay):
+        """Test finishing thumbnails invalidates the list ETag."""
+        with override_settings(THUMBNAILS_ASYNC=True):
+            image = Image.objects.create(
+                user=self.user, title='second', image=get_image_file())
+        etag = self.client.get(IMAGES_URL)['ETag']
+
+        generate_thumbnails_task(image.id)
+        res = self.client.get(IMAGES_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['results'][0]['status'],
+                         Image.Status.READY)
+
+    def test_etag_depends_on_query(self):
+        """Test pages of the list have their own ETags."""
+        first = self.client.get(IMAGES_URL)['ETag']
+        other = self.client.get(IMAGES_URL, {'page_size': 1})['ETag']
+
+        self.assertNotEqual(first, other)
+
+    def test_etag_per_user(self):
+        """Test another user's ETag doesn't validate this user's list."""
+        other = create_user(
+            email='other@example.com',
+            password='pass123',
+            account_type=self.user.account_type)
+        client = APIClient()
+        client.force_authenticate(other)
+        etag = client.get(IMAGES_URL)['ETag']
+
+        res = self.client.get(IMAGES_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+
+class TokenCacheTests(TestCase):
+    """Test token authentication served from the cache."""
+
+    def setUp(self):
+        self.account_type = create_account_type(type='Premium')
+
+        self.user = create_user(
+            email='username@example.com',
+            password='pass123',
+            account_type=self.account_type)
+
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.client.get(IMAGES_URL)
+
+    def test_warm_token_without_queries(self):
+        """Test a cached token authenticates without database queries."""
+        etag = self.client.get(IMAGES_URL)['ETag']
+
+        with self.assertNumQueries(0):
+            res = self.client.get(IMAGES_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_shared_cache_without_queries(self):
+        """Test other processes authenticate from the shared cache."""
+        authentication._local_tokens.clear()
+
+        with self.assertNumQueries(0):
+            user, token = CachedTokenAuthentication().authenticate_credentials(
+                self.token.key)
+
+        self.assertEqual(user, self.user)
+        self.assertEqual(user.account_type, self.account_type)
+        self.assertEqual(token, self.token)
+
+    def test_deleted_token_rejected(self):
+        """Test deleting a token invalidates its cached user."""
+        self.token.delete()
+
+        res = self.client.get(IMAGES_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_user_rejected(self):
+        """Test deactivating a user invalidates their cached tokens."""
+        self.user.is_active = False
+        self.user.save()
+
+        res = self.client.get(IMAGES_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_account_type_change_applied(self):
+        """Test changing an account type invalidates its users' tokens."""
+        self.account_type.thumb_size1 = 500
+        self.account_type.save()
+
+        res = self.client.get(thumb_url(0, 500))
+
+        # The size is allowed now; there is just no such image.
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_account_type_change_leaves_tokens(self):
+        """Test saving an account type doesn't look up its users' tokens."""
+        with CaptureQueriesContext(connection) as queries:
+            self.account_type.save()
+
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if 'authtoken_token' in query['sql']])
+
+    def test_account_type_deleted(self):
+        """Test deleting an account type invalidates its users' tokens."""
+        self.account_type.delete()
+
+        with self.assertNumQueries(1):
+            user, token = CachedTokenAuthentication().authenticate_credentials(
+                self.token.key)
+
+        self.assertIsNone(user.account_type)
+
+    def test_invalid_token_not_cached(self):
+        """Test a token created after a failed lookup authenticates."""
+        key = self.token.key
+        self.token.delete()
+        self.client.get(IMAGES_URL)
+        Token.objects.create(user=self.user, key=key)
+
+        res = self.client.get(IMAGES_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+
+class MediaServingTests(TestCase):
+    """Test serving stored files with authorization and ranges."""
+
+    def setUp(self):
+        premium = create_account_type(type='Premium')
+
+        self.user = create_user(
+            email='username@example.com',
+            password='pass123',
+            account_type=premium)
+
+        token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+        self.image = Image.objects.create(
+            user=self.user, title='sample', image=get_image_file())
+        self.name = self.image.image.name
+        self.data = default_storage.open(self.name).read()
+
+    def test_owner_gets_file_cached_immutable(self):
+        """Test the owner downloads their original with long caching."""
+        res = self.client.get(media_url(self.name))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(res.streaming_content), self.data)
+        self.assertEqual(
+            res['Cache-Control'], 'private, max-age=31536000, immutable')
+        self.assertEqual(res['Accept-Ranges'], 'bytes')
+        self.assertEqual(res['Content-Type'], 'image/png')
+
+    def test_other_user_not_found(self):
+        """Test files of other users aren't served."""
+        other = create_user(
+            email='other@example.com',
+            password='pass123',
+            account_type=self.user.account_type)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=(
+            f'Token {Token.objects.create(user=other).key}'))
+
+        res = client.get(media_url(self.name))
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_anonymous_not_found(self):
+        """Test unauthenticated requests can't get private files."""
+        res = APIClient().get(media_url(self.name))
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_invalid_token_unauthorized(self):
+        """Test a bad token is rejected."""
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token invalid')
+
+        res = client.get(media_url(self.name))
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_original_needs_link_to_original(self):
+        """Test originals need an account type linking to them."""
+        basic = create_account_type(type='Basic')
+        self.user.account_type = basic
+        self.user.save()
+
+        original = self.client.get(media_url(self.name))
+        thumb = self.client.get(
+            media_url(self.image.thumbnail_size1.name))
+
+        self.assertEqual(original.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(thumb.status_code, status.HTTP_200_OK)
+
+    def test_range_request(self):
+        """Test a byte range is served as partial content."""
+        res = self.client.get(media_url(self.name), HTTP_RANGE='bytes=10-19')
+
+        self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(res.streaming_content), self.data[10:20])
+        self.assertEqual(res['Content-Length'], '10')
+        self.assertEqual(
+            res['Content-Range'], f'bytes 10-19/{len(self.data)}')
+
+    def test_suffix_range_request(self):
+        """Test a suffix range returns the end of the file."""
+        res = self.client.get(media_url(self.name), HTTP_RANGE='bytes=-5')
+
+        self.assertEqual(res.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(res.streaming_content), self.data[-5:])
+
+    def test_unsatisfiable_range(self):
+        """Test a range past the end of the file returns 416."""
+        res = self.client.get(
+            media_url(self.name),
+            HTTP_RANGE=f'bytes={len(self.data)}-')
+
+        self.assertEqual(
+            res.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(res['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_stale_if_range_sends_whole_file(self):
+        """Test a range is ignored when If-Range doesn't match."""
+        res = self.client.get(
+            media_url(self.name), HTTP_RANGE='bytes=0-9',
+            HTTP_IF_RANGE='Thu, 01 Jan 1970 00:00:00 GMT')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_not_modified_since(self):
+        """Test If-Modified-Since returns 304 for an unchanged file."""
+        last_modified = self.client.get(media_url(self.name))['Last-Modified']
+
+        res = self.client.get(
+            media_url(self.name), HTTP_IF_MODIFIED_SINCE=last_modified)
+
+        self.assertEqual(res.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    @override_settings(SENDFILE_BACKEND='nginx')
+    def test_nginx_offload(self):
+        """Test the transfer is handed to nginx after authorization."""
+        res = self.client.get(media_url(self.name))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['X-Accel-Redirect'], '/protected/' + self.name)
+        self.assertEqual(res.content, b'')
+
+    def test_shared_link_public_until_expired(self):
+        """Test binary images behind a live link are served to anyone."""
+        binary = self.image.make_binary_image()
+        link = BinaryImageLink.objects.create(
+            user=self.user,
+            image=self.image,
+            binary_image=binary.name,
+            expiring_time=300,
+        )
+
+        res = APIClient().get(media_url(binary.name))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+        link.expiration_date = timezone.now() - datetime.timedelta(seconds=1)
+        link.save()
+        res = APIClient().get(media_url(binary.name))
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
 class PeriodicTasksTest(TestCase):
     """Test for periodic tasks."""
 
@@ -318,6 +1737,88 @@ class PeriodicTasksTest(TestCase):
         self.assertEqual(
             BinaryImageLink.objects.filter(user=self.user).count(), 1)
 
+    def test_binary_image_shared_between_links(self):
+        """Test links to the same image reuse one binary file."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+        )
+        payload = {'expiring_time': int(300)}
+        url = get_link_url(image.id)
+
+        res1 = self.client.post(url, payload, format='json')
+        with patch('images.executor.render_binary') as patched_render:
+            res2 = self.client.post(url, payload, format='json')
+
+        patched_render.assert_not_called()
+        self.assertEqual(res1.data['binary_image'], res2.data['binary_image'])
+        image.refresh_from_db()
+        links = BinaryImageLink.objects.filter(image=image)
+        self.assertEqual(links.count(), 2)
+        for link in links:
+            self.assertEqual(link.binary_image.name, image.binary_image.name)
+        self.assertEqual(Img.open(image.binary_image).mode, '1')
+
+    @override_settings(SIGNED_LINKS=True)
+    def test_signed_link_served_without_queries(self):
+        """Test signed links are created and served without link rows."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+        )
+        payload = {'expiring_time': int(300)}
+
+        res = self.client.post(get_link_url(image.id), payload, format='json')
+        link = urlparse(res.data['binary_image']).path
+        with self.assertNumQueries(0):
+            link_res = self.client.get(link)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertFalse(BinaryImageLink.objects.exists())
+        self.assertEqual(link_res.status_code, status.HTTP_200_OK)
+        image.refresh_from_db()
+        self.assertEqual(
+            b''.join(link_res.streaming_content), image.binary_image.read())
+
+    @override_settings(SIGNED_LINKS=True, SENDFILE_BACKEND='nginx')
+    def test_signed_link_offloaded_to_nginx(self):
+        """Test signed links hand the transfer off with X-Accel-Redirect."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+        )
+        payload = {'expiring_time': int(300)}
+
+        res = self.client.post(get_link_url(image.id), payload, format='json')
+        link_res = self.client.get(urlparse(res.data['binary_image']).path)
+
+        image.refresh_from_db()
+        self.assertEqual(
+            link_res['X-Accel-Redirect'],
+            '/protected/' + image.binary_image.name)
+
+    @override_settings(SIGNED_LINKS=True)
+    def test_signed_link_expired_or_tampered(self):
+        """Test expired and tampered signed links are not served."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+        )
+        payload = {'expiring_time': int(300)}
+        res = self.client.post(get_link_url(image.id), payload, format='json')
+        link = urlparse(res.data['binary_image']).path
+
+        tampered_res = self.client.get(link[:-3] + 'xx/')
+        with patch('time.time', return_value=time.time() + 301):
+            expired_res = self.client.get(link)
+
+        self.assertEqual(tampered_res.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(expired_res.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_deleting_expired_binary_images_links(self):
         """Testing deleting expired binary images links."""
         BinaryImageLink.objects.create(
@@ -336,6 +1837,108 @@ class PeriodicTasksTest(TestCase):
         self.assertEqual(BinaryImageLink.objects.filter(user=self.user).count(), 0)
         self.assertFalse(BinaryImageLink.objects.filter(id=binary_id).exists())
 
+    def test_deleting_expired_links_removes_owned_files(self):
+        """Test expired links are deleted in batches with their files."""
+        past = timezone.now() - datetime.timedelta(seconds=1)
+        future = timezone.now() + datetime.timedelta(seconds=300)
+        expired = [
+            BinaryImageLink.objects.create(
+                user=self.user,
+                binary_image=get_image_file(),
+                expiration_date=past,
+            )
+            for _ in range(5)
+        ]
+        active = BinaryImageLink.objects.create(
+            user=self.user,
+            binary_image=get_image_file(),
+            expiration_date=future,
+        )
+
+        out = StringIO()
+        call_command('delete_expired_links', batch_size=2, stdout=out)
+
+        self.assertEqual(
+            list(BinaryImageLink.objects.all()), [active])
+        for link in expired:
+            self.assertFalse(
+                default_storage.exists(link.binary_image.name))
+        self.assertTrue(default_storage.exists(active.binary_image.name))
+        self.assertIn('deleted links: 5, files: 5', out.getvalue())
+
+    def test_deleting_expired_links_keeps_shared_binary(self):
+        """Test the binary file shared with the image is kept."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+        )
+        binary = image.make_binary_image()
+        BinaryImageLink.objects.create(
+            user=self.user,
+            image=image,
+            binary_image=binary.name,
+            expiration_date=timezone.now() - datetime.timedelta(seconds=1),
+        )
+
+        call_command('delete_expired_links', stdout=StringIO())
+
+        self.assertFalse(BinaryImageLink.objects.exists())
+        self.assertTrue(default_storage.exists(binary.name))
+
+    @patch('app.tasks.delete_expired_link_task.apply_async')
+    def test_link_schedules_own_expiry(self, patched_apply_async):
+        """Test a committed link queues its deletion at its expiry."""
+        with self.captureOnCommitCallbacks(execute=True):
+            link = BinaryImageLink.objects.create(
+                user=self.user,
+                binary_image=get_image_file(),
+                expiring_time=300,
+            )
+
+        args, kwargs = patched_apply_async.call_args
+        self.assertEqual(args, ((link.pk,),))
+        self.assertAlmostEqual(kwargs['countdown'], 300, delta=5)
+
+    @patch('app.tasks.delete_expired_link_task.apply_async',
+           side_effect=ConnectionError)
+    def test_link_created_when_broker_down(self, patched_apply_async):
+        """Test links are created when their expiry can't be queued."""
+        image = Image.objects.create(
+            user=self.user,
+            title='sample',
+            image=get_image_file(),
+        )
+        payload = {'expiring_time': int(300)}
+
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(
+                get_link_url(image.id), payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertTrue(BinaryImageLink.objects.exists())
+
+    def test_expiry_task_deletes_only_expired_link(self):
+        """Test the scheduled task deletes its link once it has expired."""
+        expired = BinaryImageLink.objects.create(
+            user=self.user,
+            binary_image=get_image_file(),
+            expiration_date=timezone.now() - datetime.timedelta(seconds=1),
+        )
+        active = BinaryImageLink.objects.create(
+            user=self.user,
+            binary_image=get_image_file(),
+            expiration_date=timezone.now() + datetime.timedelta(seconds=300),
+        )
+
+        delete_expired_link_task(expired.pk)
+        delete_expired_link_task(expired.pk)
+        delete_expired_link_task(active.pk)
+
+        self.assertEqual(list(BinaryImageLink.objects.all()), [active])
+        self.assertFalse(default_storage.exists(expired.binary_image.name))
+        self.assertTrue(default_storage.exists(active.binary_image.name))
+
     def test_try_to_used_deleted_link(self):
         """Testing opening a deleted link."""
         BinaryImageLink.objects.create(
@@ -351,6 +1954,7 @@ class PeriodicTasksTest(TestCase):
 
         call_command('delete_expired_links',)
 
-        res2 = self.client.get(link)
+        res2 = self.client.get(link.url)
 
         self.assertEqual(res2.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(default_storage.exists(link.name))
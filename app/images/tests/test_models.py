@@ -1,10 +1,75 @@
 """
 Tests for models.
 """
-from django.test import TestCase
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.auth import get_user_model
 
-from images import models
+from PIL import Image as Img
+from io import BytesIO
+
+import os
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from images import executor, gc, metadata, models, thumbnails
+
+
+def encoder_profile(**params):
+    """Return an encoder profile with Pillow defaults overridden."""
+    defaults = {
+        'jpeg_quality': 75,
+        'jpeg_progressive': False,
+        'png_optimize': False,
+        'png_compress_level': 6,
+        'png_quantize_colors': None,
+        'keep_exif': False,
+    }
+    defaults.update(params)
+    return SimpleNamespace(**defaults)
+
+
+def png_file(size=(100, 100)):
+    """Return a PNG image of size as an in memory file."""
+    buffer = BytesIO()
+    Img.new('RGB', size).save(buffer, 'PNG')
+
+    return ContentFile(buffer.getvalue(), name='test.png')
+
+
+def sleep_job(source, seconds):
+    """Pool job taking seconds to return them."""
+    time.sleep(seconds)
+
+    return seconds
+
+
+def allocate_job(source, size):
+    """Pool job allocating size bytes."""
+    return len(bytearray(size))
+
+
+def getpid_job(source):
+    """Pool job returning the worker's process id."""
+    return os.getpid()
+
+
+def name_job(source):
+    """Pool job returning the name of the file it was given, if any."""
+    return getattr(source, 'name', None)
+
+
+def vm_size():
+    """Return this process's virtual memory size in bytes."""
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmSize:'):
+                return int(line.split()[1]) * 1024
 
 
 class ModelTests(TestCase):
@@ -60,3 +125,334 @@ class ModelTests(TestCase):
         )
 
         self.assertEqual(str(acc), acc.title)
+
+    def test_account_type_cache_invalidated_on_save(self):
+        """Test saving an account type refreshes the cached row."""
+        acc = models.AccountType.objects.create(
+            title='Sample',
+            is_basic=True,
+            thumb_size1=200,
+        )
+        models.AccountType.objects.get_cached(acc.id)
+
+        acc.thumb_size1 = 300
+        acc.save()
+
+        with self.assertNumQueries(1):
+            cached = models.AccountType.objects.get_cached(acc.id)
+        with self.assertNumQueries(0):
+            models.AccountType.objects.get_cached(acc.id)
+        self.assertEqual(cached.thumb_size1, 300)
+
+    def test_account_type_for_user_attached_once(self):
+        """Test resolving an account type attaches it to the user."""
+        acc = models.AccountType.objects.create(
+            title='Sample',
+            is_basic=True,
+            thumb_size1=200,
+        )
+        get_user_model().objects.create_user(
+            email='test@example.com',
+            password='testpass123',
+            account_type=acc,
+        )
+        user = get_user_model().objects.get(email='test@example.com')
+        models.AccountType.objects.get_cached(acc.id)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(models.AccountType.objects.for_user(user), acc)
+            self.assertEqual(user.account_type, acc)
+
+    def test_render_thumbnails_from_one_decode(self):
+        """Test rendering every requested size from a single source."""
+        source = BytesIO()
+        Img.new('RGB', (1200, 800)).save(source, 'JPEG')
+        source.seek(0)
+
+        rendered = thumbnails.render_thumbnails(source, [200, 400], 'JPEG')
+
+        self.assertEqual(sorted(rendered), [200, 400])
+        self.assertEqual(Img.open(BytesIO(rendered[400])).size, (400, 267))
+        self.assertEqual(Img.open(BytesIO(rendered[200])).size, (200, 133))
+
+    def test_read_header_without_decoding(self):
+        """Test metadata comes from the header, pixel data isn't loaded."""
+        exif = Img.Exif()
+        exif[metadata.ORIENTATION_TAG] = 8
+        source = BytesIO()
+        Img.new('RGB', (120, 90)).save(source, 'JPEG', exif=exif.tobytes())
+        file = ContentFile(source.getvalue(), name='a.jpg')
+
+        with patch('PIL.ImageFile.ImageFile.load') as patched_load:
+            fields = metadata.read_header(file)
+
+        patched_load.assert_not_called()
+        self.assertEqual(fields, {
+            'width': 120,
+            'height': 90,
+            'format': 'JPEG',
+            'file_size': file.size,
+            'orientation': 8,
+        })
+        self.assertEqual(
+            metadata.read_header(ContentFile(b'notanimage')), {})
+
+    def test_image_format_from_file_name(self):
+        """Test resolving Pillow format names from file extensions."""
+        self.assertEqual(thumbnails.image_format('a/b.JPG'), 'JPEG')
+        self.assertEqual(thumbnails.image_format('b.png'), 'PNG')
+        self.assertIsNone(thumbnails.image_format('c.gif'))
+
+    def test_encode_progressive_jpeg_without_metadata(self):
+        """Test a profile encodes progressive JPEG and strips EXIF."""
+        img = Img.new('RGB', (100, 100))
+        exif = Img.Exif()
+        exif[0x010F] = 'Camera'
+        source = BytesIO()
+        img.save(source, 'JPEG', exif=exif.tobytes())
+        source.seek(0)
+
+        kept = thumbnails.render_thumbnails(
+            source, [50], 'JPEG', encoder_profile(keep_exif=True))[50]
+        source.seek(0)
+        stripped = thumbnails.render_thumbnails(
+            source, [50], 'JPEG', encoder_profile(jpeg_progressive=True))[50]
+
+        self.assertIn('exif', Img.open(BytesIO(kept)).info)
+        self.assertNotIn('exif', Img.open(BytesIO(stripped)).info)
+        self.assertTrue(Img.open(BytesIO(stripped)).info.get('progressive'))
+
+    def test_default_profile_drops_gps(self):
+        """Test account type defaults keep no location in derivatives."""
+        exif = Img.Exif()
+        exif[metadata.ORIENTATION_TAG] = 6
+        exif[0x8825] = {1: 'N', 2: (52.0, 13.0, 30.0)}
+        source = BytesIO()
+        Img.new('RGB', (100, 80)).save(source, 'JPEG', exif=exif.tobytes())
+        profile = models.AccountType()
+
+        source.seek(0)
+        thumb = thumbnails.render_thumbnails(
+            source, [50], 'JPEG', profile)[50]
+        source.seek(0)
+        binary = thumbnails.render_binary(
+            source, 'JPEG', encoder_profile(keep_exif=True))
+
+        for data in (thumb, binary):
+            self.assertFalse(
+                Img.open(BytesIO(data)).getexif().get_ifd(0x8825))
+
+    def test_encode_png_quantized_palette(self):
+        """Test a profile quantizes PNG thumbnails to a palette."""
+        source = BytesIO()
+        Img.radial_gradient('L').convert('RGBA').save(source, 'PNG')
+        source.seek(0)
+
+        rendered = thumbnails.render_thumbnails(
+            source, [100], 'PNG',
+            encoder_profile(png_quantize_colors=16, png_optimize=True))[100]
+
+        thumb = Img.open(BytesIO(rendered))
+        self.assertEqual(thumb.mode, 'P')
+        self.assertLessEqual(len(thumb.getcolors()), 16)
+
+    def test_encode_png_quantized_from_any_mode(self):
+        """Test greyscale with alpha and 16-bit PNGs can be quantized."""
+        profile = encoder_profile(png_quantize_colors=16)
+        sources = {
+            'LA': Img.radial_gradient('L').convert('LA'),
+            'I': Img.radial_gradient('L').convert('I').point(
+                lambda value: value * 256),
+        }
+        for mode, img in sources.items():
+            with self.subTest(mode=mode):
+                source = BytesIO()
+                img.save(source, 'PNG')
+                source.seek(0)
+
+                rendered = thumbnails.render_thumbnails(
+                    source, [100], 'PNG', profile)[100]
+
+                thumb = Img.open(BytesIO(rendered))
+                self.assertEqual(thumb.mode, 'P')
+                self.assertLessEqual(len(thumb.getcolors()), 16)
+
+    def test_profile_key_changes_with_settings(self):
+        """Test derivatives of different profiles get different names."""
+        self.assertNotEqual(
+            thumbnails.profile_key(encoder_profile()),
+            thumbnails.profile_key(encoder_profile(jpeg_quality=60)))
+
+    @override_settings(MEDIA_SHARD_DEPTH=2)
+    def test_upload_paths_sharded(self):
+        """Test uploads are spread over directories named by their key."""
+        name = models.image_file_path(None, 'photo.JPG')
+        key = os.path.basename(name).replace('-', '')
+
+        self.assertEqual(
+            name, f'uploads/images/{key[:2]}/{key[2:4]}/'
+                  f'{os.path.basename(name)}')
+        self.assertEqual(models.sharded_name(name), name)
+
+    @override_settings(MEDIA_SHARD_DEPTH=1)
+    def test_sharded_name_changes_depth(self):
+        """Test stored names are mapped to the configured depth."""
+        sha = 'ab' * 32
+
+        self.assertEqual(
+            models.sharded_name(f'uploads/thumbs/{sha}/200_x.png'),
+            f'uploads/thumbs/ab/{sha}/200_x.png')
+        self.assertEqual(
+            models.sharded_name(f'uploads/images/ab/ab/{sha}.png'),
+            f'uploads/images/ab/{sha}.png')
+        self.assertEqual(
+            models.sharded_name('static/other.png'), 'static/other.png')
+
+
+@override_settings(IMAGE_WORKERS=1)
+class ExecutorTests(TestCase):
+    """Test the image processing pool and its limits."""
+
+    def setUp(self):
+        executor.shutdown()
+        self.addCleanup(executor.shutdown)
+
+    def test_render_thumbnails_in_pool(self):
+        """Test thumbnails are rendered by a pool worker."""
+        rendered = executor.render_thumbnails(
+            png_file((400, 200)), [100], 'PNG', encoder_profile())
+
+        self.assertEqual(Img.open(BytesIO(rendered[100])).size, (100, 50))
+
+    @override_settings(IMAGE_MAX_PIXELS=5000)
+    def test_too_many_pixels_rejected(self):
+        """Test images over IMAGE_MAX_PIXELS are rejected unopened."""
+        with self.assertRaises(executor.ImageRejected):
+            executor.render_binary(png_file(), 'PNG')
+
+    @override_settings(IMAGE_MAX_PIXELS=5000, IMAGE_WORKERS=0)
+    def test_too_many_pixels_rejected_inline(self):
+        """Test the pixel limit applies without a pool too."""
+        with self.assertRaises(executor.ImageRejected):
+            executor.render_binary(png_file(), 'PNG')
+
+    @override_settings(IMAGE_MAX_BYTES=10)
+    def test_too_many_bytes_rejected(self):
+        """Test files over IMAGE_MAX_BYTES are rejected."""
+        with self.assertRaises(executor.ImageRejected):
+            executor.render_binary(png_file(), 'PNG')
+
+    @override_settings(IMAGE_JOB_TIMEOUT=1)
+    def test_slow_job_killed(self):
+        """Test jobs over the timeout are killed and the pool restarts."""
+        started = time.monotonic()
+        with self.assertRaises(executor.ImageRejected):
+            executor.submit(sleep_job, png_file(), 10)
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertIn(100, executor.render_thumbnails(
+            png_file(), [100], 'PNG'))
+
+    @override_settings(IMAGE_WORKERS=2, IMAGE_JOB_TIMEOUT=2)
+    def test_slow_job_spares_other_jobs(self):
+        """Test a timeout doesn't fail jobs running next to the slow one."""
+        results = []
+
+        def submit_slow_job():
+            try:
+                executor.submit(sleep_job, png_file(), 10)
+            except executor.ImageRejected as err:
+                results.append(str(err))
+
+        slow = threading.Thread(target=submit_slow_job)
+        slow.start()
+        time.sleep(1.5)
+        self.assertEqual(executor.submit(sleep_job, png_file(), 1), 1)
+        slow.join()
+
+        self.assertEqual(results, ['Image processing timed out.'])
+
+    def test_corrupt_image_rejected(self):
+        """Test data Pillow can't decode is rejected, not an OSError."""
+        source = BytesIO()
+        Img.effect_noise((200, 200), 50).save(source, 'JPEG')
+        truncated = ContentFile(source.getvalue()[:600], name='a.jpg')
+
+        with self.assertRaises(executor.ImageRejected):
+            executor.render_thumbnails(truncated, [100], 'JPEG')
+
+    def test_memory_hungry_job_rejected(self):
+        """Test jobs allocating past IMAGE_WORKER_MAX_RSS are rejected."""
+        limit = vm_size() + 256 * 1024 ** 2
+        with override_settings(IMAGE_WORKER_MAX_RSS=limit):
+            with self.assertRaises(executor.ImageRejected):
+                executor.submit(allocate_job, png_file(), 1024 ** 3)
+
+            self.assertEqual(
+                executor.submit(allocate_job, png_file(), 1024), 1024)
+
+    @override_settings(IMAGE_WORKER_MAX_JOBS=1)
+    def test_workers_recycled(self):
+        """Test a worker is replaced after IMAGE_WORKER_MAX_JOBS jobs."""
+        pids = {
+            executor.submit(getpid_job, png_file())
+            for _ in range(3)
+        }
+
+        self.assertEqual(len(pids), 3)
+
+    def test_file_on_disk_opened_by_worker(self):
+        """Test files on disk are sent to the pool by path, not content."""
+        data = png_file().read()
+        with TemporaryUploadedFile(
+                'test.png', None, len(data), None) as upload:
+            upload.write(data)
+            upload.seek(0)
+
+            self.assertEqual(
+                executor.submit(name_job, upload),
+                upload.temporary_file_path())
+
+        self.assertIsNone(executor.submit(name_job, png_file()))
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class StoredFileRollbackTests(TransactionTestCase):
+    """Test originals stored by rolled back uploads reach the GC."""
+
+    def setUp(self):
+        account_type = models.AccountType.objects.create(
+            title='Basic', is_basic=True, thumb_size1=200)
+        self.user = get_user_model().objects.create_user(
+            email='user@example.com',
+            password='pass123',
+            account_type=account_type,
+        )
+
+    def test_rolled_back_original_logged(self):
+        """Test a failed save leaves its original to the GC."""
+        original = png_file((120, 80))
+        sha256 = models.file_sha256(original)
+        with patch.object(models.Image, 'make_thumbnail',
+                          side_effect=executor.ImageRejected), \
+                self.assertRaises(executor.ImageRejected):
+            models.Image.objects.create(
+                user=self.user, title='sample', image=original)
+
+        self.assertFalse(models.Blob.objects.exists())
+        name = models.PendingDeletion.objects.get(
+            name__contains=sha256).name
+        self.assertTrue(default_storage.exists(name))
+
+        gc.drain()
+
+        self.assertFalse(default_storage.exists(name))
+
+    def test_committed_original_not_logged(self):
+        """Test a saved upload's original isn't logged."""
+        image = models.Image.objects.create(
+            user=self.user, title='sample', image=png_file())
+
+        self.assertFalse(models.PendingDeletion.objects.filter(
+            name=image.image.name).exists())
+        self.assertTrue(default_storage.exists(image.image.name))
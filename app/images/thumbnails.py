@@ -0,0 +1,185 @@
+"""
+Thumbnail rendering for images app.
+"""
+import hashlib
+import os
+from io import BytesIO
+from types import SimpleNamespace
+
+from PIL import Image as Img
+
+from images import metrics
+
+
+FORMATS = {
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+}
+
+REDUCING_GAP = 2
+
+# Modes Image.quantize() works on; others are converted first.
+QUANTIZE_MODES = ('L', 'P', 'RGB', 'RGBA')
+
+MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'AVIF': 'image/avif',
+}
+
+EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+    'AVIF': '.avif',
+}
+
+
+def image_format(filename):
+    """Return Pillow format name for a file name or None if unsupported."""
+    ext = os.path.splitext(filename)[1].lower()
+    return FORMATS.get(ext)
+
+
+PROFILE_FIELDS = (
+    'jpeg_quality',
+    'jpeg_progressive',
+    'png_optimize',
+    'png_compress_level',
+    'png_quantize_colors',
+    'keep_exif',
+)
+
+
+def profile_key(profile):
+    """Return a short key identifying an encoder profile's settings."""
+    if profile is None:
+        return 'default'
+    values = tuple(getattr(profile, field) for field in PROFILE_FIELDS)
+
+    return hashlib.sha1(repr(values).encode()).hexdigest()[:8]
+
+
+def profile_values(profile):
+    """Return a picklable copy of an encoder profile's settings."""
+    if profile is None:
+        return None
+
+    return SimpleNamespace(**{
+        field: getattr(profile, field) for field in PROFILE_FIELDS})
+
+
+def quantizable(img):
+    """Return img in a mode quantize() accepts (L, P, RGB or RGBA).
+
+    16-bit greyscale is scaled down to 8 bits, modes with an alpha band
+    become RGBA and any other mode RGB.
+    """
+    if img.mode in QUANTIZE_MODES:
+        return img
+    if img.mode.startswith('I'):
+        return img.convert('I').point(lambda value: value / 256).convert('L')
+    if 'A' in img.mode or 'a' in img.mode:
+        return img.convert('RGBA')
+
+    return img.convert('RGB')
+
+
+def encode(img, ftype, profile=None, info=None):
+    """Return img encoded as ftype with an encoder profile's settings.
+
+    profile is any object with the PROFILE_FIELDS attributes (usually an
+    AccountType); without it Pillow defaults are used. The ICC profile in
+    info (the source image's) is kept, EXIF only when the profile keeps it
+    as it may hold the uploader's location.
+    """
+    options = {}
+    if profile is not None:
+        keys = ('icc_profile', 'exif') if profile.keep_exif else (
+            'icc_profile',)
+        for key in keys:
+            if (info or {}).get(key):
+                options[key] = info[key]
+        if ftype == 'JPEG':
+            options['quality'] = profile.jpeg_quality
+            options['progressive'] = profile.jpeg_progressive
+            # Optimized Huffman tables come with progressive encoding.
+            options['optimize'] = profile.jpeg_progressive
+        elif ftype == 'PNG':
+            options['optimize'] = profile.png_optimize
+            options['compress_level'] = profile.png_compress_level
+            if profile.png_quantize_colors and img.mode != '1':
+                img = quantizable(img)
+                img = img.quantize(
+                    profile.png_quantize_colors,
+                    method=Img.FASTOCTREE if img.mode == 'RGBA' else None)
+
+    buffer = BytesIO()
+    img.save(buffer, ftype, **options)
+
+    return buffer.getvalue()
+
+
+def can_encode(ftype):
+    """Return whether this Pillow build can write ftype."""
+    Img.init()
+    return ftype in Img.SAVE
+
+
+def fit_size(size, box):
+    """Return size scaled down to fit in a box x box square."""
+    width, height = size
+    scale = min(box / width, box / height)
+    if scale >= 1:
+        return size
+
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def render_thumbnails(source, sizes, ftype, profile=None):
+    """Render thumbnails fitting in a box of each size from one decode.
+
+    The largest thumbnail is made first. For JPEG sources the decoder is
+    asked for a DCT-scaled draft near twice that size, so the full
+    resolution original is never materialized, and resize() uses reduce()
+    for the remaining integer downscale. Smaller sizes are then resized
+    from the previous thumbnail instead of from the original.
+
+    Returns a dict mapping each size to the thumbnail bytes encoded with
+    profile's settings (see encode()).
+    """
+    rendered = {}
+    with Img.open(source) as original:
+        img = original
+        original_size = original.size
+        for size in sorted(set(sizes), reverse=True):
+            width, height = target = fit_size(original_size, size)
+            if img is original:
+                original.draft(None, (width * REDUCING_GAP,
+                                      height * REDUCING_GAP))
+                with metrics.span('thumbnail', 'decode'):
+                    original.load()
+            with metrics.span('thumbnail', 'resize'):
+                img = img.resize(
+                    target, Img.LANCZOS, reducing_gap=REDUCING_GAP)
+            with metrics.span('thumbnail', 'encode'):
+                rendered[size] = encode(img, ftype, profile, original.info)
+
+    return rendered
+
+
+def render_binary(source, ftype, profile=None):
+    """Return encoded bytes of a 1-bit (black and white) version of source.
+
+    No metadata of source is copied: binary images are shared through
+    public links.
+    """
+    with Img.open(source) as img:
+        with metrics.span('binary', 'decode'):
+            img.load()
+        with metrics.span('binary', 'convert'):
+            binary = img.convert('1')
+        with metrics.span('binary', 'encode'):
+            return encode(binary, ftype, profile)
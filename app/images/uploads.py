@@ -0,0 +1,83 @@
+"""
+Resumable upload sessions storage for images app.
+"""
+import hashlib
+import os
+import re
+
+from django.core.files.uploadedfile import UploadedFile
+
+
+CHUNK_SIZE = 64 * 1024
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class ChunkError(ValueError):
+    """Raised for a chunk that doesn't fit the upload session."""
+
+
+class SessionUploadedFile(UploadedFile):
+    """Uploaded file backed by an upload session's file on disk.
+
+    Exposing temporary_file_path() lets image validation read the file
+    in place and lets FileSystemStorage move it instead of copying it.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def parse_content_range(header, size):
+    """Return (start, end) of a Content-Range header for a session size."""
+    match = CONTENT_RANGE.match(header or '')
+    if match is None:
+        raise ChunkError(
+            'Content-Range header must be "bytes start-end/size".')
+    start, end, total = (int(value) for value in match.groups())
+    if total != size or start > end or end >= size:
+        raise ChunkError('Content-Range does not fit the upload size.')
+
+    return start, end
+
+
+def write_chunk(path, start, end, stream):
+    """Stream a chunk into path at start without buffering it in memory.
+
+    Returns the number of bytes written, which must cover start..end.
+    """
+    expected = end - start + 1
+    written = 0
+    with open(path, 'r+b') as part:
+        part.seek(start)
+        while written < expected:
+            data = stream.read(min(CHUNK_SIZE, expected - written))
+            if not data:
+                break
+            part.write(data)
+            written += len(data)
+        if stream.read(1):
+            raise ChunkError('Chunk is longer than its Content-Range.')
+
+    if written != expected:
+        raise ChunkError('Chunk is shorter than its Content-Range.')
+
+    return written
+
+
+def file_checksum(path):
+    """Return SHA-256 hex digest of a file read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as part:
+        for data in iter(lambda: part.read(CHUNK_SIZE), b''):
+            digest.update(data)
+
+    return digest.hexdigest()
+
+
+def remove(path):
+    """Remove a session file if it still exists."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -8,11 +8,13 @@ from django.urls import (
 
 from rest_framework.routers import DefaultRouter
 
-from images.views import ImageViewSet
+from images.views import ImageViewSet, UploadSessionViewSet, signed_link
 
 router = DefaultRouter()
 router.register('image', ImageViewSet)
+router.register('upload', UploadSessionViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('link/<str:token>/', signed_link, name='signed-link'),
 ]
@@ -1,7 +1,6 @@
 """
 Views for images app.
 """
-from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import (
     viewsets,
@@ -9,19 +8,56 @@ from rest_framework import (
     status,
 )
 from rest_framework.decorators import action
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.response import Response
 
-from .serializers import ImageSerializer, BinaryImageLinkSerializer
-from .models import Image, BinaryImageLink, AccountType
-
-from PIL import Image as Img
+from .authentication import CachedTokenAuthentication
+from .pagination import ImageCursorPagination
+from .serializers import (
+    BatchUploadSerializer,
+    ImageSerializer,
+    BinaryImageLinkSerializer,
+    UploadSessionSerializer,
+)
+from .models import (
+    AccountType,
+    BinaryImageLink,
+    Blob,
+    Image,
+    UploadSession,
+    User,
+    log_rolled_back_files,
+    sharded_name,
+)
 
-from django.core.files import File
-from django.core.files.base import ContentFile
 from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.http import FileResponse, Http404, HttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils import timezone
+from django.utils.http import http_date
+
+from images import (
+    batch,
+    derivatives,
+    executor,
+    metrics,
+    processing,
+    sendfile,
+    signing,
+    thumbnails,
+    uploads,
+)
 
+import hashlib
+import itertools
 import os
-from io import BytesIO
+
+
+MEDIA_CACHE_CONTROL = 'private, max-age=31536000, immutable'
 
 
 class ImageViewSet(mixins.DestroyModelMixin,
@@ -32,18 +68,26 @@ class ImageViewSet(mixins.DestroyModelMixin,
     """View for manage images APIs."""
     queryset = Image.objects.all()
     serializer_class = ImageSerializer
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
+    pagination_class = ImageCursorPagination
 
     def get_queryset(self):
         """Retrieve images for authenticated user."""
         return self.queryset.filter(user=self.request.user).order_by('-id')
 
+    def perform_content_negotiation(self, request, force=False):
+        """Thumbnails pick an image format from Accept themselves."""
+        return super().perform_content_negotiation(
+            request, force=force or self.action == 'thumb')
+
     def get_serializer_class(self):
         if self.action == 'list':
             return ImageSerializer
         if self.action == 'get_link':
             return BinaryImageLinkSerializer
+        if self.action == 'batch':
+            return BatchUploadSerializer
 
         return self.serializer_class
 
@@ -51,52 +95,206 @@ class ImageViewSet(mixins.DestroyModelMixin,
         """Create a new image."""
         serializer.save(user=self.request.user)
 
+    def library_etag(self, request):
+        """Return a strong ETag for the user's images as seen by request.
+
+        It changes with the user's library version and with everything
+        else the response depends on, so it is computed from the
+        authenticated user and the cached library state alone, without
+        loading any image.
+        """
+        user = request.user
+        account_type = AccountType.objects.for_user(user)
+        version, modified = User.objects.library_state(user.pk)
+        key = (
+            user.pk,
+            version,
+            account_type.pk,
+            account_type.thumb_size1,
+            account_type.thumb_size2,
+            account_type.link_to_original,
+            request.accepted_media_type,
+            request.get_full_path(),
+        )
+
+        return '"%s"' % hashlib.sha1(repr(key).encode()).hexdigest()
+
+    def conditional(self, request, get_response, *args, **kwargs):
+        """Return 304 when the client's copy is current, else the response.
+
+        Responses carry the ETag and Last-Modified validators and must be
+        revalidated before reuse.
+        """
+        etag = self.library_etag(request)
+        modified = User.objects.library_state(request.user.pk)[1]
+        last_modified = int(modified.timestamp())
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = get_response(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        response['Cache-Control'] = 'private, no-cache'
+
+        return response
+
+    def list(self, request, *args, **kwargs):
+        """List images, or 304 if the library didn't change."""
+        return self.conditional(request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        """Get an image, or 304 if the library didn't change."""
+        return self.conditional(request, super().retrieve, *args, **kwargs)
+
+    @action(methods=['POST'], detail=False)
+    def batch(self, request):
+        """Upload many images, or a ZIP archive of them, at once.
+
+        Valid entries are stored as blobs and inserted with one bulk
+        query; thumbnails are then generated by a thread pool or, with
+        THUMBNAILS_ASYNC, by Celery workers. Every entry gets a result.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        files = serializer.validated_data.get('images', [])
+        archive = serializer.validated_data.get('archive')
+        count = len(files)
+        if archive is not None:
+            count += batch.count_entries(archive)
+        if count > settings.BATCH_UPLOAD_MAX_FILES:
+            msg = (f'At most {settings.BATCH_UPLOAD_MAX_FILES} images can be '
+                   f'uploaded at once.')
+            return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+
+        entries = ((file.name, file) for file in files)
+        if archive is not None:
+            entries = itertools.chain(
+                entries, batch.archive_entries(archive))
+
+        account_type = AccountType.objects.for_user(request.user)
+        results = []
+        images = []
+        # Blobs are acquired in the transaction inserting their images, so
+        # a failed request leaves no references (or stored files) behind.
+        # Thumbnails are rendered once it has committed, so blob rows
+        # aren't locked while they are.
+        try:
+            with transaction.atomic():
+                for name, file in entries:
+                    try:
+                        if isinstance(file, batch.EntryError):
+                            raise file
+                        header = batch.check_entry(name, file, account_type)
+                        file.name = name
+                        blob = Blob.objects.acquire(file)
+                    except batch.EntryError as err:
+                        results.append({'name': name, 'error': str(err)})
+                        continue
+                    finally:
+                        if hasattr(file, 'close'):
+                            file.close()
+                    images.append(Image(
+                        user=request.user,
+                        title=os.path.splitext(name)[0],
+                        blob=blob,
+                        image=blob.file.name,
+                        **header,
+                    ))
+                    results.append({'name': name})
+
+                Image.objects.bulk_create(images)
+                if settings.THUMBNAILS_ASYNC:
+                    processing.queue_thumbnails(
+                        image.id for image in images)
+                User.objects.touch_library(request.user.pk)
+        finally:
+            log_rolled_back_files()
+
+        if images and not settings.THUMBNAILS_ASYNC:
+            batch.make_thumbnails(images)
+            with transaction.atomic():
+                Image.objects.bulk_update(images, [
+                    *Image.THUMBNAIL_FIELDS, 'status', 'status_changed_at'])
+                User.objects.touch_library(request.user.pk)
+
+        created = iter(images)
+        for result in results:
+            if 'error' not in result:
+                image = next(created)
+                result.update({'id': image.id, 'status': image.status})
+
+        status_code = (
+            status.HTTP_201_CREATED if images
+            else status.HTTP_400_BAD_REQUEST)
+
+        return Response(results, status=status_code)
+
+    @action(methods=['GET'], detail=True, url_path=r'thumb/(?P<size>\d+)')
+    def thumb(self, request, pk=None, size=None):
+        """Get thumbnail rendered on demand at a size allowed for user.
+
+        Any height up to the largest thumbnail size of the account type
+        may be asked for.
+        """
+        account_type = AccountType.objects.for_user(self.request.user)
+        size = int(size)
+        max_size = account_type.max_thumb_size
+        if max_size is None or not 0 < size <= max_size:
+            msg = 'Thumbnail size not allowed for user account type.'
+            return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+
+        image = self.get_object()
+        ftype = derivatives.negotiate_format(
+            request.headers.get('Accept', ''), image)
+        try:
+            file = derivatives.get_or_render(
+                image, size, ftype, account_type)
+        except executor.ImageRejected as err:
+            return Response(str(err), status=status.HTTP_400_BAD_REQUEST)
+
+        response = FileResponse(
+            file, content_type=thumbnails.MIME_TYPES[ftype])
+        patch_vary_headers(response, ['Accept'])
+
+        return response
+
     @action(methods=['POST'], detail=True, url_path='get-link')
     def get_link(self, request, pk=None):
         """Get expiring link for binary image."""
-        user_account = AccountType.objects.filter(users=self.request.user)
-        if user_account[0].link_to_binary:
+        user_account = AccountType.objects.for_user(self.request.user)
+        if user_account.link_to_binary:
             try:
                 image = self.get_object()
-                img_img = image.image
-                expiring_link_time = int(request.data['expiring_time'])
                 host = os.environ.get('ALLOWED_HOSTS')
 
-                img = Img.open(img_img).convert('1')
-
-                binary_name, binary_extension = os.path.splitext(img_img.name)
-                binary_extension = binary_extension.lower()
-
-                binary_filename = binary_name + '_binary' + binary_extension
-
-                if binary_extension in ['.jpg', '.jpeg']:
-                    FTYPE = 'JPEG'
-                elif binary_extension == '.png':
-                    FTYPE = 'PNG'
-
-                """Save binary image."""
-                temp_binary = BytesIO()
-                img.save(temp_binary, FTYPE)
-                temp_binary.seek(0)
-
                 serializer = self.get_serializer(data=request.data)
 
                 if serializer.is_valid():
 
-                    binary_image = BinaryImageLink()
-                    binary_image.binary_image = File(
-                        ContentFile(temp_binary.read()),
-                        binary_filename)
-                    binary_image.user = self.request.user
-                    binary_image.expiring_time = expiring_link_time
-                    binary_image.save()
+                    expiring_link_time = serializer.validated_data[
+                        'expiring_time']
+                    binary_image = image.make_binary_image()
+
+                    if settings.SIGNED_LINKS:
+                        token = signing.make_token(image, expiring_link_time)
+                        binary_path = reverse('signed-link', args=[token])
+                    else:
+                        with metrics.span('link', 'db'):
+                            BinaryImageLink.objects.create(
+                                user=self.request.user,
+                                image=image,
+                                binary_image=binary_image.name,
+                                expiring_time=expiring_link_time,
+                            )
+                        binary_path = settings.MEDIA_URL + binary_image.name
 
-                    user_binaries = BinaryImageLink.objects.filter(
-                        user=self.request.user).order_by('-id')
                     bin_info = {}
-                    binary_path = str(user_binaries[0].binary_image)
                     bin_info['binary_image'] = str(
-                        'http://'+host+':8000'+settings.MEDIA_URL+binary_path)
+                        'http://'+host+':8000'+binary_path)
                     msg = bin_info
                     status_code = status.HTTP_200_OK
 
@@ -104,6 +302,10 @@ class ImageViewSet(mixins.DestroyModelMixin,
                     msg = serializer.errors
                     status_code = status.HTTP_400_BAD_REQUEST
 
+            except executor.ImageRejected as err:
+                msg = str(err)
+                status_code = status.HTTP_400_BAD_REQUEST
+
             except Exception as err:
                 msg = f'Some problems occured: {err}'
                 status_code = status.HTTP_400_BAD_REQUEST
@@ -116,3 +318,172 @@ class ImageViewSet(mixins.DestroyModelMixin,
             status_code = status.HTTP_400_BAD_REQUEST
 
             return Response(msg, status=status_code)
+
+
+def media_user(request):
+    """Return the user of a token or session authenticated request."""
+    result = CachedTokenAuthentication().authenticate(request)
+    if result is not None:
+        return result[0]
+
+    return request.user
+
+
+def can_access_media(user, name):
+    """Return whether user may download the stored file name.
+
+    Owners may get their thumbnails and binary images, and originals when
+    their account type links to originals. Binary images behind a link
+    that hasn't expired are public, as the link is meant to be shared.
+    """
+    if user.is_authenticated:
+        files = (
+            Q(thumbnail_size1=name) | Q(thumbnail_size2=name)
+            | Q(binary_image=name))
+        if AccountType.objects.for_user(user).link_to_original:
+            files |= Q(image=name)
+        if Image.objects.filter(files, user=user).exists():
+            return True
+
+    return BinaryImageLink.objects.filter(
+        binary_image=name, expiration_date__gt=timezone.now()).exists()
+
+
+def media(request, name):
+    """Serve a stored file to users allowed to see it.
+
+    Authorization is checked here; the transfer is left to the web server
+    with SENDFILE_BACKEND and streamed with Range support otherwise.
+    Stored files are never overwritten (names are UUIDs or content
+    hashes), so responses can be cached forever. URLs of files shard_media
+    has since moved keep working through the name's current layout.
+    """
+    try:
+        user = media_user(request)
+    except AuthenticationFailed as err:
+        return HttpResponse(str(err.detail), status=err.status_code)
+    if not can_access_media(user, name):
+        current = sharded_name(name)
+        if current == name or not can_access_media(user, current):
+            raise Http404('File does not exist.')
+        name = current
+
+    response = sendfile.sendfile_response(name, request)
+    if response.status_code in (200, 206):
+        response['Cache-Control'] = MEDIA_CACHE_CONTROL
+
+    return response
+
+
+def signed_link(request, token):
+    """Serve binary image of a signed link without touching the database.
+
+    Tokens embed the stored name, so those signed before shard_media moved
+    the file are served from the name's current layout.
+    """
+    name = signing.read_token(token)
+    if name is None:
+        raise Http404('Link is invalid or expired.')
+    if not default_storage.exists(name):
+        name = sharded_name(name)
+
+    return sendfile.sendfile_response(name, request)
+
+
+class UploadSessionViewSet(mixins.CreateModelMixin,
+                           mixins.RetrieveModelMixin,
+                           mixins.DestroyModelMixin,
+                           viewsets.GenericViewSet):
+    """View for resumable chunked image uploads.
+
+    Chunks are sent with PUT and a Content-Range header and streamed to
+    a file on disk, so memory use doesn't depend on the upload size.
+    """
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        """Retrieve upload sessions for authenticated user."""
+        return self.queryset.filter(user=self.request.user)
+
+    def get_serializer_class(self):
+        if self.action == 'finalize':
+            return ImageSerializer
+
+        return self.serializer_class
+
+    def perform_create(self, serializer):
+        """Create a new upload session and its empty file."""
+        session = serializer.save(user=self.request.user)
+        os.makedirs(settings.UPLOAD_SESSION_ROOT, exist_ok=True)
+        open(session.path, 'wb').close()
+
+    def perform_destroy(self, instance):
+        """Abort upload session."""
+        uploads.remove(instance.path)
+        instance.delete()
+
+    def update(self, request, pk=None):
+        """Write a chunk starting at the session's current offset.
+
+        The chunk is streamed to disk without a transaction or row lock
+        open; the offset then only advances if no other request moved it.
+        """
+        session = self.get_object()
+        try:
+            start, end = uploads.parse_content_range(
+                request.headers.get('Content-Range'), session.size)
+            if start != session.offset:
+                return Response(
+                    {'offset': session.offset},
+                    status=status.HTTP_409_CONFLICT)
+            uploads.write_chunk(session.path, start, end, request.stream)
+        except uploads.ChunkError as err:
+            return Response(
+                {'detail': str(err), 'offset': session.offset},
+                status=status.HTTP_400_BAD_REQUEST)
+        except FileNotFoundError:
+            # Aborted or expired while the chunk was on its way.
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+        sessions = self.get_queryset().filter(pk=session.pk)
+        if not sessions.filter(offset=start).update(offset=end + 1):
+            offset = sessions.values_list('offset', flat=True).first()
+            if offset is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            return Response(
+                {'offset': offset}, status=status.HTTP_409_CONFLICT)
+
+        return Response({'offset': end + 1})
+
+    @action(methods=['POST'], detail=True)
+    def finalize(self, request, pk=None):
+        """Verify a complete upload and create an image from it."""
+        session = self.get_object()
+        if session.offset != session.size:
+            msg = {'detail': 'Upload is incomplete.', 'offset': session.offset}
+            return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+
+        if uploads.file_checksum(session.path) != session.checksum:
+            session.offset = 0
+            session.save(update_fields=['offset'])
+            open(session.path, 'wb').close()
+            msg = {'detail': 'Checksum mismatch, upload again.', 'offset': 0}
+            return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+
+        with open(session.path, 'rb') as part:
+            image_file = uploads.SessionUploadedFile(
+                part, name=session.filename, size=session.size)
+            serializer = self.get_serializer(data={
+                'title': session.title,
+                'image': image_file,
+            })
+            serializer.is_valid(raise_exception=True)
+            serializer.save(user=request.user)
+
+        uploads.remove(session.path)
+        session.delete()
+
+        return Response(serializer.data, status=status.HTTP_201_CREATED)